@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Chunking and tokenizing: word-list chunk strings vs offset-based ChunkedText
+
+The legacy path rebuilds every chunk string from a word list and then
+tokenizes each chunk on its own, so the words shared by overlapping chunks
+are copied and tokenized again for each of them. chunk_text() now returns
+offsets into one buffer and ChunkedText.tokens() tokenizes that buffer in
+one pass. Both paths run on the same multi-MB documents and must produce
+the same chunks and tokens.
+
+Usage (from rag_api/):
+    python benchmarks/chunking_benchmark.py --documents 3 --mb 4
+"""
+
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main_optimized import CHUNK_OVERLAP, CHUNK_SIZE, chunk_text  # noqa: E402
+from search_index import token_occurrences, tokenize  # noqa: E402
+
+PUNCTUATION = [",", ".", ";", ":", "", "", "", "", "", ""]
+
+
+def make_document(size: int, vocabulary: list, rng: random.Random) -> str:
+    """Zipf-distributed words with punctuation and line breaks, about `size` characters"""
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    lines = []
+    length = 0
+    while length < size:
+        words = rng.choices(vocabulary, weights=weights, k=rng.randint(5, 15))
+        line = " ".join(word + rng.choice(PUNCTUATION) for word in words)
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+def legacy_chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list:
+    """The previous chunk_text(): chunk strings rebuilt from a word list"""
+    if len(text) <= chunk_size:
+        return [text]
+
+    chunks = []
+    words = text.split()
+    current_chunk = []
+    current_length = 0
+    for word in words:
+        current_chunk.append(word)
+        current_length += len(word) + 1
+        if current_length >= chunk_size:
+            chunks.append(" ".join(current_chunk))
+            overlap_words = current_chunk[-overlap:] if overlap > 0 else []
+            current_chunk = overlap_words
+            current_length = sum(len(w) + 1 for w in overlap_words)
+    if current_chunk:
+        chunks.append(" ".join(current_chunk))
+    return chunks
+
+
+def legacy_path(text: str):
+    chunks = legacy_chunk_text(text)
+    return chunks, [tokenize(chunk) for chunk in chunks]
+
+
+def offset_path(text: str):
+    chunks = chunk_text(text)
+    return chunks, chunks.tokens()
+
+
+def chunk_bytes(chunks) -> int:
+    """Memory held by the chunk text itself"""
+    if isinstance(chunks, list):
+        return sys.getsizeof(chunks) + sum(sys.getsizeof(chunk) for chunk in chunks)
+    return sys.getsizeof(chunks.text) + sum(sys.getsizeof(column) for column in (chunks.starts, chunks.ends))
+
+
+def measure(path, documents: list) -> dict:
+    # Collections triggered by the outputs kept for comparison would land in random stages
+    gc.collect()
+    gc.disable()
+    chunking = tokenizing = positions = 0.0
+    size = chunk_count = 0
+    outputs = []
+    for text in documents:
+        start = time.perf_counter()
+        chunks, tokens = path(text)
+        middle = time.perf_counter()
+        # Posting positions per chunk, as SearchIndex.add_document() builds them
+        for chunk_tokens in tokens:
+            token_occurrences(chunk_tokens)
+        end = time.perf_counter()
+        tokenizing += middle - start
+        positions += end - middle
+        size += chunk_bytes(chunks)
+        chunk_count += len(chunks)
+        outputs.append((list(chunks), tokens))
+    # Chunking alone, without tokens
+    start = time.perf_counter()
+    for text in documents:
+        (legacy_chunk_text if path is legacy_path else chunk_text)(text)
+    chunking = time.perf_counter() - start
+    gc.enable()
+    return {"chunk_s": chunking, "chunk_tokenize_s": tokenizing, "positions_s": positions,
+            "chunk_mb": size / (1024 * 1024), "chunks": chunk_count, "outputs": outputs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--documents", type=int, default=3)
+    parser.add_argument("--mb", type=float, default=4.0, help="size of each document")
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocabulary = ["".join(rng.choice(letters) for _ in range(rng.randint(2, 10))) for _ in range(args.vocabulary)]
+    print(f"Generating {args.documents} documents of {args.mb:g} MB...")
+    documents = [make_document(int(args.mb * 1024 * 1024), vocabulary, rng) for _ in range(args.documents)]
+
+    legacy = measure(legacy_path, documents)
+    offsets = measure(offset_path, documents)
+    if legacy["outputs"] != offsets["outputs"]:
+        sys.exit("Chunks or tokens differ between the two paths")
+
+    total_mb = sum(map(len, documents)) / (1024 * 1024)
+    print(f"{legacy['chunks']} chunks from {total_mb:.1f} MB (identical chunks and tokens)")
+    print(f"{'path':<10} {'chunk s':>9} {'chunk+tokens s':>15} {'positions s':>12} {'chunk MB':>9} {'MB/s':>7}")
+    for name, result in (("legacy", legacy), ("offsets", offsets)):
+        print(f"{name:<10} {result['chunk_s']:>9.3f} {result['chunk_tokenize_s']:>15.3f} "
+              f"{result['positions_s']:>12.3f} {result['chunk_mb']:>9.1f} "
+              f"{total_mb / result['chunk_tokenize_s']:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
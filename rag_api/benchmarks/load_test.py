@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Load test: /query latency while PDF reports are being rendered
+
+Runs query clients against a running server, optionally alongside clients
+that keep downloading PDF answers, and reports /query latency percentiles
+and how many requests were rejected with 503.
+
+By default every request sends a query made up afresh from a pool of
+words, so most requests miss the query and report caches and the
+latencies are those of real searches and renders. --fixed-queries cycles
+through a handful of queries instead, which after the first round are
+all cache hits. Cache hit rates over the run, taken from the server's
+/metrics, are reported next to the latencies either way.
+
+Usage:
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 --duration 20
+    python benchmarks/load_test.py --no-pdf    # baseline without report load
+    python benchmarks/load_test.py --fixed-queries    # warm caches
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+
+QUERIES = [
+    "system performance",
+    "document search",
+    "error handling",
+    "configuration settings",
+    "data processing pipeline",
+]
+
+# Varied queries are two to four of these words, so hardly any query is sent twice
+QUERY_WORDS = sorted({word for query in QUERIES for word in query.split()} | {
+    "access", "analysis", "api", "architecture", "authentication", "backup", "cache", "cluster", "database",
+    "deployment", "design", "file", "index", "latency", "log", "memory", "model", "monitoring", "network",
+    "policy", "query", "report", "request", "response", "security", "server", "service", "storage", "test",
+    "throughput", "user", "version", "workflow",
+})
+
+# /metrics counters behind the reported hit rates
+CACHE_COUNTERS = {
+    "query": ("rag_cache_hits_total", "rag_cache_misses_total"),
+    "report": ("rag_report_cache_hits_total", "rag_report_cache_misses_total"),
+}
+
+
+def varied_query(rng: random.Random) -> str:
+    return " ".join(rng.sample(QUERY_WORDS, rng.randint(2, 4)))
+
+
+def post(url: str, payload: dict, timeout: float) -> int:
+    request = urllib.request.Request(url, data=json.dumps(payload).encode('utf-8'),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def cache_counters(url: str, timeout: float) -> dict:
+    """The server's cache hit and miss counters from /metrics, empty if they cannot be read"""
+    try:
+        with urllib.request.urlopen(f"{url}/metrics", timeout=timeout) as response:
+            lines = response.read().decode('utf-8').splitlines()
+    except OSError:
+        return {}
+    names = {name for counters in CACHE_COUNTERS.values() for name in counters}
+    values = {}
+    for line in lines:
+        name, _, value = line.partition(" ")
+        if name in names:
+            values[name] = float(value)
+    return values
+
+
+def cache_hit_rates(before: dict, after: dict) -> dict:
+    """{cache: (hits, lookups)} between two cache_counters() readings"""
+    rates = {}
+    for cache, (hits, misses) in CACHE_COUNTERS.items():
+        if all(name in before and name in after for name in (hits, misses)):
+            hit_count = int(after[hits] - before[hits])
+            rates[cache] = (hit_count, hit_count + int(after[misses] - before[misses]))
+    return rates
+
+
+def run_clients(count: int, work, deadline: float) -> list:
+    threads = [threading.Thread(target=work, args=(client, deadline), daemon=True) for client in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds to run")
+    parser.add_argument("--query-clients", type=int, default=8)
+    parser.add_argument("--pdf-clients", type=int, default=4)
+    parser.add_argument("--no-pdf", action="store_true", help="skip the concurrent PDF downloads")
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-request timeout in seconds")
+    parser.add_argument("--fixed-queries", action="store_true",
+                        help="cycle through a few fixed queries, which the server then answers from its caches")
+    parser.add_argument("--seed", type=int, default=42, help="seed for the varied queries")
+    args = parser.parse_args()
+
+    lock = threading.Lock()
+    query_latencies = []
+    query_status = {}
+    pdf_status = {}
+
+    def count(counter: dict, status: int):
+        with lock:
+            counter[status] = counter.get(status, 0) + 1
+
+    def make_queries(client: int, kind: str):
+        rng = random.Random(f"{args.seed}-{kind}-{client}")
+        sent = 0
+        while True:
+            yield QUERIES[(client + sent) % len(QUERIES)] if args.fixed_queries else varied_query(rng)
+            sent += 1
+
+    def query_client(client: int, deadline: float):
+        queries = make_queries(client, "query")
+        while time.monotonic() < deadline:
+            payload = {"query": next(queries), "top_k": 3}
+            start = time.perf_counter()
+            try:
+                status = post(f"{args.url}/query", payload, args.timeout)
+            except OSError:
+                status = 0
+            elapsed = time.perf_counter() - start
+            count(query_status, status)
+            if status == 200:
+                with lock:
+                    query_latencies.append(elapsed)
+
+    def pdf_client(client: int, deadline: float):
+        queries = make_queries(client, "pdf")
+        while time.monotonic() < deadline:
+            payload = {"query": next(queries), "format": "pdf"}
+            try:
+                status = post(f"{args.url}/download-answer", payload, args.timeout)
+            except OSError:
+                status = 0
+            count(pdf_status, status)
+            if status == 503:
+                time.sleep(0.1)
+
+    counters_before = cache_counters(args.url, args.timeout)
+    deadline = time.monotonic() + args.duration
+    threads = run_clients(args.query_clients, query_client, deadline)
+    if not args.no_pdf:
+        threads += run_clients(args.pdf_clients, pdf_client, deadline)
+    for thread in threads:
+        thread.join()
+    hit_rates = cache_hit_rates(counters_before, cache_counters(args.url, args.timeout))
+
+    total = sum(query_status.values())
+    print(f"/query: {total} requests in {args.duration:.0f}s ({total / args.duration:.1f} req/s), "
+          f"status counts {dict(sorted(query_status.items()))}, {'fixed' if args.fixed_queries else 'varied'} queries")
+    for label, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+        print(f"  {label}: {percentile(query_latencies, fraction) * 1000:8.1f} ms")
+    if query_latencies:
+        print(f"  max: {max(query_latencies) * 1000:8.1f} ms")
+    if not args.no_pdf:
+        print(f"/download-answer (pdf): {sum(pdf_status.values())} requests, "
+              f"status counts {dict(sorted(pdf_status.items()))}")
+    if not hit_rates:
+        print("cache hit rates: unavailable, /metrics could not be read")
+    for cache, (hits, lookups) in hit_rates.items():
+        print(f"{cache} cache: {hits}/{lookups} hits ({hits / lookups * 100 if lookups else 0.0:.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
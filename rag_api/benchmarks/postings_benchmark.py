@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Memory/latency comparison: string-list chunk_index vs compact SearchIndex
+
+Usage:
+    python benchmarks/postings_benchmark.py --chunks 100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_index import ChunkedText, SearchIndex, index_terms, top_k  # noqa: E402
+
+# Hits fetched per query: the server shortlists top_k * RERANK_DEPTH chunks (5 * 5)
+SHORTLIST = 25
+
+
+def make_vocabulary(size: int, rng: random.Random) -> list:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(size)]
+
+
+def make_corpus(chunks: int, words_per_chunk: int, vocabulary: list, rng: random.Random) -> dict:
+    """Synthetic documents with Zipf-distributed words, 100 chunks per document"""
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    corpus = defaultdict(list)
+    for chunk_id in range(chunks):
+        words = rng.choices(vocabulary, weights=weights, k=words_per_chunk)
+        corpus[f"doc_{chunk_id // 100}.pdf"].append(" ".join(words))
+    return corpus
+
+
+def build_legacy(corpus: dict) -> dict:
+    """The previous structure: one f"{filename}_{idx}" string per occurrence"""
+    chunk_index = defaultdict(list)
+    for filename, chunks in corpus.items():
+        for chunk_idx, chunk in enumerate(chunks):
+            chunk_id = f"{filename}_{chunk_idx}"
+            for word in index_terms(chunk):
+                chunk_index[word].append(chunk_id)
+    return chunk_index
+
+
+def chunked_corpus(corpus: dict) -> dict:
+    """Each document as the ChunkedText the server's chunking stage hands to the index"""
+    return {filename: ChunkedText.from_chunks(chunks) for filename, chunks in corpus.items()}
+
+
+def build_compact(corpus: dict) -> SearchIndex:
+    index = SearchIndex()
+    for filename, chunked in corpus.items():
+        index.add_document(filename, chunked)
+    return index
+
+
+def text_bytes(corpus: dict) -> int:
+    """Memory held by the corpus's chunk strings, or by its ChunkedText buffers"""
+    return sum(sys.getsizeof(chunks.text) if isinstance(chunks, ChunkedText) else
+               sum(sys.getsizeof(chunk) for chunk in chunks) for chunks in corpus.values())
+
+
+def search_legacy(chunk_index: dict, corpus: dict, query_words: list) -> int:
+    """The previous perform_search: count matching words, fetch every candidate, sort"""
+    chunk_scores = defaultdict(float)
+    for word in query_words:
+        for chunk_id in chunk_index.get(word, ()):
+            chunk_scores[chunk_id] += 1
+    candidates = []
+    for chunk_id, score in chunk_scores.items():
+        filename, chunk_idx = chunk_id.rsplit('_', 1)
+        candidates.append((chunk_id, score, corpus[filename][int(chunk_idx)]))
+    candidates.sort(key=lambda candidate: candidate[1], reverse=True)
+    return len(candidates[:SHORTLIST])
+
+
+def search_compact(index: SearchIndex, query_words: list) -> int:
+    """BM25 through SearchIndex.score, then the shortlist's text, as the server searches"""
+    chunk_ids, scores = index.score(query_words)
+    hits = [index.get_chunk(chunk_id) for chunk_id, _ in top_k(chunk_ids, scores, SHORTLIST)]
+    return len(hits)
+
+
+def measure_build(build, corpus):
+    """Build time untraced, then retained and peak bytes from a second, traced build
+
+    tracemalloc slows every allocation down, and the compact build makes
+    many small ones, so timing a traced build would mostly time the tracer.
+    """
+    start = time.perf_counter()
+    structure = build(corpus)
+    elapsed = time.perf_counter() - start
+    del structure
+    tracemalloc.start()
+    structure = build(corpus)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return structure, elapsed, current, peak
+
+
+def measure_queries(search, queries):
+    timings = []
+    for query_words in queries:
+        start = time.perf_counter()
+        search(query_words)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        "p50_ms": timings[len(timings) // 2] * 1000,
+        "p95_ms": timings[int(len(timings) * 0.95)] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--words-per-chunk", type=int, default=80)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    print(f"Generating {args.chunks} chunks x {args.words_per_chunk} words...")
+    corpus = make_corpus(args.chunks, args.words_per_chunk, vocabulary, rng)
+    queries = [rng.sample(vocabulary[:5000], 3) for _ in range(args.queries)]
+
+    # Index and peak figures include the chunk text results are served from, which each
+    # structure receives already built: the legacy index points into the chunk strings,
+    # the compact index into each document's ChunkedText buffer.
+    legacy_text = text_bytes(corpus)
+    legacy, legacy_build, legacy_bytes, legacy_peak = measure_build(build_legacy, corpus)
+    legacy_latency = measure_queries(lambda q: search_legacy(legacy, corpus, q), queries)
+    del legacy
+
+    corpus = chunked_corpus(corpus)
+    compact_text = text_bytes(corpus)
+    compact, compact_build, compact_bytes, compact_peak = measure_build(build_compact, corpus)
+    compact_latency = measure_queries(lambda q: search_compact(compact, q), queries)
+
+    print(f"{'structure':<10} {'build s':>9} {'index MB':>10} {'peak MB':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for name, build_s, size, peak, latency in (
+        ("legacy", legacy_build, legacy_bytes + legacy_text, legacy_peak + legacy_text, legacy_latency),
+        ("compact", compact_build, compact_bytes + compact_text, compact_peak + compact_text, compact_latency),
+    ):
+        print(f"{name:<10} {build_s:>9.2f} {size / 1e6:>10.1f} {peak / 1e6:>9.1f} "
+              f"{latency['p50_ms']:>9.2f} {latency['p95_ms']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite: extraction, chunking, index build, search and HTTP load
+
+Generates a synthetic corpus of text files and PDFs in a scratch directory,
+then times each stage of the pipeline: extract_text_from_pdf, chunk_text,
+building the search index (in memory, as a full load_documents() rebuild
+and as a restart from the stored index), perform_search, and finally
+/query against a server started on the corpus under concurrent load,
+first with queries it has not seen (cold) and then with repeats (warm).
+Latencies are reported as p50/p95/p99. Results are printed and can be
+written as JSON; --baseline compares every metric with an earlier results
+file, so runs before and after a change can be compared.
+
+Usage:
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --docs 400 --pdfs 40 --pages 20 --baseline results.json
+    python benchmarks/run_benchmarks.py --skip-load       # no HTTP server
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, APP_DIR)
+
+from load_test import cache_counters, cache_hit_rates, percentile, post  # noqa: E402
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def summarize(timings: list) -> dict:
+    """Count, throughput and latency percentiles of per-operation timings in seconds"""
+    total = sum(timings)
+    return {
+        "count": len(timings),
+        "total_s": round(total, 4),
+        "per_s": round(len(timings) / total, 2) if total else 0.0,
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(timings, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 3),
+        "max_ms": round(max(timings, default=0.0) * 1000, 3),
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class Corpus:
+    """Zipf-distributed pseudo-words, so term frequencies look like real text"""
+
+    def __init__(self, vocabulary_size: int, rng: random.Random):
+        self.rng = rng
+        self.words = sorted({"".join(rng.choice(LETTERS) for _ in range(rng.randint(3, 10)))
+                             for _ in range(vocabulary_size)})
+        rng.shuffle(self.words)
+        self.cumulative = []
+        total = 0.0
+        for rank in range(len(self.words)):
+            total += 1.0 / (rank + 1)
+            self.cumulative.append(total)
+
+    def text(self, words: int) -> str:
+        tokens = self.rng.choices(self.words, cum_weights=self.cumulative, k=words)
+        lines = [" ".join(tokens[start:start + 12]) for start in range(0, len(tokens), 12)]
+        return "\n".join(lines)
+
+    def queries(self, count: int) -> list:
+        """One to three words each, mostly common words with some rare ones, plus a few phrases"""
+        queries = []
+        common = self.words[:2000]
+        for _ in range(count):
+            words = self.rng.sample(common, self.rng.randint(1, 3))
+            if self.rng.random() < 0.2:
+                words[-1] = self.rng.choice(self.words)
+            query = " ".join(words)
+            queries.append(f'"{query}"' if len(words) > 1 and self.rng.random() < 0.1 else query)
+        return queries
+
+
+def write_pdf(path: str, pages: list):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+
+    pdf = canvas.Canvas(path, pagesize=letter)
+    for page in pages:
+        text = pdf.beginText(40, 750)
+        text.setFont("Helvetica", 9)
+        for line in page.splitlines():
+            text.textLine(line)
+        pdf.drawText(text)
+        pdf.showPage()
+    pdf.save()
+
+
+def generate_corpus(data_dir: str, corpus: Corpus, args) -> dict:
+    os.makedirs(data_dir, exist_ok=True)
+    size = 0
+    for number in range(args.docs):
+        extension = ".md" if number % 4 == 0 else ".txt"
+        path = os.path.join(data_dir, f"doc_{number:05d}{extension}")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(corpus.text(args.words_per_doc))
+        size += os.path.getsize(path)
+    for number in range(args.pdfs):
+        path = os.path.join(data_dir, f"report_{number:04d}.pdf")
+        write_pdf(path, [corpus.text(args.words_per_page) for _ in range(args.pages)])
+        size += os.path.getsize(path)
+    return {"text_files": args.docs, "pdf_files": args.pdfs, "pdf_pages": args.pdfs * args.pages,
+            "size_mb": round(size / (1024 * 1024), 2)}
+
+
+def bench_extract(data_dir: str) -> tuple:
+    from document_extraction import extract_text_from_pdf
+
+    texts, timings, pages, size = {}, [], 0, 0
+    for filename in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, filename)
+        if filename.endswith(".pdf"):
+            texts[filename], elapsed = timed(extract_text_from_pdf, path)
+            timings.append(elapsed)
+            size += os.path.getsize(path)
+        else:
+            with open(path, encoding="utf-8") as f:
+                texts[filename] = f.read()
+    result = summarize(timings)
+    if timings:
+        result["mb_per_s"] = round(size / (1024 * 1024) / sum(timings), 3)
+    return texts, result
+
+
+def bench_chunk(app, texts: dict) -> tuple:
+    chunks, timings = {}, []
+    for filename, text in texts.items():
+        chunks[filename], elapsed = timed(app.chunk_text, text)
+        timings.append(elapsed)
+    result = summarize(timings)
+    total = sum(timings)
+    result["chunks"] = sum(map(len, chunks.values()))
+    result["mb_per_s"] = round(sum(map(len, texts.values())) / (1024 * 1024) / total, 2) if total else 0.0
+    return chunks, result
+
+
+def bench_build(app, chunks: dict) -> dict:
+    """In-memory index build from ready chunks, then the app's own rebuild and restart paths"""
+    index = app.new_index()
+    timings = []
+    for filename, document_chunks in chunks.items():
+        timings.append(timed(index.add_document, filename, document_chunks)[1])
+    chunk_count = sum(map(len, chunks.values()))
+    in_memory = sum(timings)
+
+    # Full rebuild: extraction, chunking, indexing and saving, with an empty extraction cache
+    shutil.rmtree(app.STORAGE_DIR, ignore_errors=True)
+    _, full_build = timed(app.load_documents, False)
+    # Restart: map the stored index; nothing changed, so nothing is extracted
+    _, restart = timed(app.load_documents, True)
+    return {
+        "documents": len(chunks),
+        "chunks": chunk_count,
+        "terms": index.term_count,
+        "in_memory_s": round(in_memory, 4),
+        "chunks_per_s": round(chunk_count / in_memory, 1) if in_memory else 0.0,
+        "full_rebuild_s": round(full_build, 4),
+        "restart_s": round(restart, 4),
+    }
+
+
+def bench_search(app, queries: list, top_k: int) -> dict:
+    for query in queries[:10]:
+        app.perform_search(query, top_k, None)
+    timings = [timed(app.perform_search, query, top_k, None)[1] for query in queries]
+    return summarize(timings)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=5) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not come up within {timeout:.0f}s")
+
+
+def load_phase(url: str, next_query, args) -> dict:
+    """Latencies of /query from concurrent clients, each sending next_query(rng) until it returns None or time is up"""
+    lock = threading.Lock()
+    timings, status_counts = [], {}
+    counters_before = cache_counters(url, args.timeout)
+    start = time.monotonic()
+    deadline = start + args.duration
+
+    def client(number: int):
+        rng = random.Random(number)
+        while time.monotonic() < deadline:
+            query = next_query(rng)
+            if query is None:
+                break
+            payload = {"query": query, "top_k": args.top_k}
+            request_start = time.perf_counter()
+            try:
+                status = post(f"{url}/query", payload, args.timeout)
+            except OSError:
+                status = 0
+            elapsed = time.perf_counter() - request_start
+            with lock:
+                status_counts[str(status)] = status_counts.get(str(status), 0) + 1
+                if status == 200:
+                    timings.append(elapsed)
+
+    threads = [threading.Thread(target=client, args=(number,), daemon=True) for number in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - start
+
+    result = summarize(timings)
+    result["per_s"] = round(len(timings) / duration, 2) if duration else 0.0
+    hits, lookups = cache_hit_rates(counters_before, cache_counters(url, args.timeout)).get("query", (0, 0))
+    result["cache_hit_ratio"] = round(hits / lookups, 4) if lookups else 0.0
+    result["status_counts"] = dict(sorted(status_counts.items()))
+    return result
+
+
+def bench_load(workdir: str, queries: list, args) -> dict:
+    """/query latency from concurrent clients against a server started on the corpus
+
+    The cold phase sends each query once, so every request is a search; the
+    warm phase then repeats the last --warm-queries of those, few enough for
+    the query cache to answer. The two are reported separately.
+    """
+    url = args.url
+    server = None
+    if url is None:
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, PYTHONPATH=APP_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""))
+        server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main_optimized:app", "--host", "127.0.0.1",
+                                   "--port", str(port), "--log-level", "warning"],
+                                  cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(url, args.timeout)
+        unsent = iter(queries)
+        sent = []
+        lock = threading.Lock()
+
+        def cold_query(rng: random.Random):
+            with lock:
+                query = next(unsent, None)
+                if query is not None:
+                    sent.append(query)
+                return query
+
+        result = {"cold": load_phase(url, cold_query, args)}
+        repeated = sent[-args.warm_queries:]
+        result["warm"] = load_phase(url, lambda rng: rng.choice(repeated), args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    result["concurrency"] = args.concurrency
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def print_results(results: dict, baseline: dict = None):
+    current = flatten(results)
+    previous = flatten(baseline) if baseline else {}
+    width = max(map(len, current), default=10)
+    header = f"{'metric':<{width}} {'value':>12}"
+    if baseline:
+        header += f" {'baseline':>12} {'change':>9}"
+    print(header)
+    for name, value in current.items():
+        line = f"{name:<{width}} {value:>12g}"
+        if name in previous:
+            old = previous[name]
+            change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+            line += f" {old:>12g} {change:>9}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=200, help="text documents to generate")
+    parser.add_argument("--words-per-doc", type=int, default=2000)
+    parser.add_argument("--pdfs", type=int, default=20, help="PDF documents to generate")
+    parser.add_argument("--pages", type=int, default=10, help="pages per PDF")
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=500, help="queries timed by perform_search")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--skip-load", action="store_true", help="skip the HTTP load stage")
+    parser.add_argument("--url", help="load-test this server instead of starting one on the corpus")
+    parser.add_argument("--load-queries", type=int, default=5000,
+                        help="distinct queries for the cold HTTP phase, which ends early once all are sent")
+    parser.add_argument("--warm-queries", type=int, default=200, help="queries the warm HTTP phase repeats")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of each HTTP load phase")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent HTTP clients")
+    parser.add_argument("--timeout", type=float, default=60.0, help="per-request and startup timeout in seconds")
+    parser.add_argument("--workdir", help="scratch directory (default: a temporary one, removed afterwards)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="earlier JSON results to compare with")
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="rag_bench_"))
+    os.makedirs(workdir, exist_ok=True)
+    static_dir = os.path.join(workdir, "static")
+    if not os.path.exists(static_dir):
+        shutil.copytree(os.path.join(APP_DIR, "static"), static_dir)
+
+    rng = random.Random(args.seed)
+    corpus = Corpus(args.vocabulary, rng)
+    data_dir = os.path.join(workdir, "data")
+    shutil.rmtree(data_dir, ignore_errors=True)
+    print(f"Generating corpus in {data_dir}...")
+    results = {"corpus": generate_corpus(data_dir, corpus, args)}
+    queries = corpus.queries(args.queries)
+
+    # The app resolves data/, storage/ and static/ against the working directory
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import main_optimized as app
+        logging.getLogger().setLevel(logging.WARNING)
+
+        print("Extracting...")
+        texts, results["extract_pdf"] = bench_extract(data_dir)
+        print("Chunking...")
+        chunks, results["chunk_text"] = bench_chunk(app, texts)
+        print("Building index...")
+        results["index_build"] = bench_build(app, chunks)
+        print("Searching...")
+        results["perform_search"] = bench_search(app, queries, args.top_k)
+        if not args.skip_load:
+            print(f"Load testing /query for up to 2x{args.duration:.0f}s with {args.concurrency} clients...")
+            load_queries = list(dict.fromkeys(corpus.queries(args.load_queries)))
+            results["http_query"] = bench_load(workdir, load_queries, args)
+        app.process_pool.shutdown()
+    finally:
+        os.chdir(previous_dir)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "arguments": vars(args),
+        },
+        "results": results,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print()
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+Dense vector retrieval for the RAG API
+
+Every chunk gets an embedding from a pluggable CPU embedder, kept as one
+row of a matrix indexed by chunk id, so dense hits, keyword postings and
+document filters all share the same ids. Rows are stored as float32,
+float16 or int8 with a per-row scale; at 512 dimensions that is 2 KB, 1 KB
+or 516 bytes per chunk. int8 is also the fastest to score, since numpy
+widens int8 rows to float32 far faster than float16 ones.
+
+Small corpora are searched exhaustively. Once a corpus is large enough,
+train() builds an IVF index: spherical k-means centroids with a sorted list
+of chunk ids per centroid. A query then only scores the rows of its
+closest few centroids. Vectors and IVF lists are saved with the keyword
+index, so a restart maps them instead of embedding every chunk again.
+
+An embedder has a ``name`` (saved with the vectors, so switching embedders
+is detected), a ``dim`` and an ``embed(texts)`` method returning a float32
+array of L2-normalised rows.
+"""
+
+import importlib
+import math
+import zlib
+from collections import Counter
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from search_index import ChunkSet, index_terms
+
+EMBEDDING_DIM = 512
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+# The IVF index is built once this many chunks are live, and rebuilt whenever
+# the corpus has doubled since; below it every row is scored
+IVF_MIN_VECTORS = 10000
+IVF_SAMPLE_PER_LIST = 64  # k-means training rows per centroid
+IVF_ITERATIONS = 8
+IVF_PROBES = 16  # Closest centroids whose lists a query scores
+
+# A filter selecting at most this many chunks is scored exactly, without the IVF lists
+EXHAUSTIVE_LIMIT = 4096
+SCORE_BLOCK_ROWS = 4096  # Rows dequantised at a time by an exhaustive search
+
+RRF_K = 60
+
+
+class HashingEmbedder:
+    """Words and their character trigrams hashed into signed dimensions (the hashing trick)
+
+    Needs no model or training data, so it works offline. Chunks sharing
+    words or word stems get similar vectors; "retrieve" and "retrieval"
+    overlap through their trigrams even though they are different terms.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+        self._features = lru_cache(maxsize=1 << 16)(self._term_features)
+
+    def _term_features(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """(dimensions, signed weights) of one term: the word itself plus its trigrams, sharing a second unit"""
+        padded = f"#{term}#"
+        grams = [padded[i:i + 3] for i in range(len(padded) - 2)]
+        hashes = [zlib.crc32(term.encode('utf-8'))] + [zlib.crc32(gram.encode('utf-8')) for gram in grams]
+        hashes = np.array(hashes, dtype=np.int64)
+        weights = np.full(len(hashes), 1.0 / len(grams), dtype=np.float32)
+        weights[0] = 1.0
+        weights[(hashes >> 31) & 1 == 1] *= -1
+        return hashes % self.dim, weights
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        # Every text's features are summed by one bincount over (row, dimension) cells
+        dimensions, weights, rows, term_weights, lengths = [], [], [], [], []
+        features = self._features
+        for row, text in enumerate(texts):
+            for term, count in Counter(index_terms(text)).items():
+                term_dimensions, feature_weights = features(term)
+                dimensions.append(term_dimensions)
+                weights.append(feature_weights)
+                rows.append(row)
+                term_weights.append(1 + math.log(count))
+                lengths.append(len(term_dimensions))
+        if not dimensions:
+            return np.zeros((len(texts), self.dim), dtype=np.float32)
+
+        lengths = np.array(lengths)
+        cells = np.concatenate(dimensions) + np.repeat(np.array(rows) * self.dim, lengths)
+        cell_weights = np.concatenate(weights) * np.repeat(np.array(term_weights, dtype=np.float32), lengths)
+        vectors = np.bincount(cells, weights=cell_weights, minlength=len(texts) * self.dim)
+        vectors = vectors.reshape(len(texts), self.dim).astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+
+def load_embedder(spec: str):
+    """Embedder named by spec: "hashing", "hashing:<dim>", or "module:factory" for a custom one"""
+    name, _, argument = spec.partition(":")
+    if name == "hashing":
+        return HashingEmbedder(int(argument) if argument else EMBEDDING_DIM)
+    factory = getattr(importlib.import_module(name), argument)
+    return factory()
+
+
+def reciprocal_rank_fusion(rankings: List[Sequence[int]], k: int = RRF_K) -> List[Tuple[int, float]]:
+    """Merge ranked lists of ids by summed 1 / (k + rank), best first"""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, 1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda entry: -entry[1])
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Rows in the storage dtype, with per-row scales for int8"""
+    if dtype != "int8":
+        return vectors.astype(DTYPES[dtype]), None
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    return np.rint(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+class DenseIndex:
+    """Embedding per chunk id, with optional IVF lists over the live rows"""
+
+    def __init__(self, embedder, dtype: str = "int8"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported embedding dtype {dtype!r}; use one of {', '.join(DTYPES)}")
+        self.embedder = embedder
+        self.embedder_name = embedder.name if embedder is not None else None
+        self.dim = embedder.dim if embedder is not None else EMBEDDING_DIM
+        self.dtype = dtype
+        self.count = 0
+        # Rows past `count` are spare capacity. A loaded index holds read-only
+        # views of the mapped file here until the first add.
+        self._vectors = np.zeros((0, self.dim), dtype=DTYPES[dtype])
+        self._scales = np.zeros(0, dtype=np.float32) if dtype == "int8" else None
+        self._live = np.zeros(0, dtype=bool)
+
+        self.centroids: Optional[np.ndarray] = None
+        self._lists: List[np.ndarray] = []  # Sorted chunk ids per centroid
+        self.trained_count = 0
+
+    @property
+    def live_count(self) -> int:
+        return int(self._live[:self.count].sum())
+
+    @property
+    def size_bytes(self) -> int:
+        return self.count * self._vectors.itemsize * self.dim
+
+    @property
+    def heap_bytes(self) -> int:
+        """Bytes of embeddings held in memory rather than read from a mapped file"""
+        return self._vectors.nbytes if self._vectors.flags.writeable else 0
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "embedder": self.embedder_name,
+            "dtype": self.dtype,
+            "vectors": self.live_count,
+            "size_mb": round(self.size_bytes / (1024 * 1024), 2),
+            "ivf_lists": len(self._lists),
+        }
+
+    def _reserve(self, rows: int):
+        needed = self.count + rows
+        if needed <= len(self._vectors) and self._vectors.flags.writeable:
+            return
+        capacity = max(needed, len(self._vectors) * 3 // 2 + 16)
+        vectors = np.zeros((capacity, self.dim), dtype=self._vectors.dtype)
+        vectors[:self.count] = self._vectors[:self.count]
+        self._vectors = vectors
+        if self._scales is not None:
+            scales = np.ones(capacity, dtype=np.float32)
+            scales[:self.count] = self._scales[:self.count]
+            self._scales = scales
+        live = np.zeros(capacity, dtype=bool)
+        live[:self.count] = self._live[:self.count]
+        self._live = live
+
+    def add(self, first_chunk: int, chunks: List[Optional[str]]):
+        """Embed chunks whose ids start at first_chunk; None marks a removed chunk"""
+        padding = first_chunk - self.count
+        self._reserve(padding + len(chunks))
+        vectors, scales = quantize(self.embedder.embed([chunk or "" for chunk in chunks]), self.dtype)
+        rows = slice(first_chunk, first_chunk + len(chunks))
+        self._vectors[rows] = vectors
+        if scales is not None:
+            self._scales[rows] = scales
+        self._live[self.count:first_chunk] = False
+        self._live[rows] = [chunk is not None for chunk in chunks]
+        self.count = first_chunk + len(chunks)
+
+        if self.centroids is not None and len(chunks):
+            # New ids are the largest so far, so appending keeps every list sorted
+            chunk_ids = np.arange(first_chunk, self.count)[self._live[rows]]
+            closest = np.argmax(self._dequantize(chunk_ids) @ self.centroids.T, axis=1)
+            for centroid in np.unique(closest).tolist():
+                self._lists[centroid] = np.concatenate([self._lists[centroid], chunk_ids[closest == centroid]])
+
+    def remove(self, chunk_ids: range):
+        self._live[chunk_ids.start:chunk_ids.stop] = False
+
+    def _dequantize(self, rows) -> np.ndarray:
+        vectors = self._vectors[rows].astype(np.float32)
+        if self._scales is not None:
+            vectors *= self._scales[rows][:, None]
+        return vectors
+
+    def search(self, text: str, chunk_set: Optional[ChunkSet] = None,
+               min_score: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+        """Cosine similarity of the text to the candidate chunks, as parallel id and score arrays
+
+        Candidates are every live chunk, or the chunks in the IVF lists of
+        the closest centroids once the index is trained, limited to the
+        chunk set when one is given. Chunks scoring below min_score are left
+        out.
+        """
+        query = self.embedder.embed([text])[0]
+        if not self.count or not query.any():
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        if chunk_set is not None and len(chunk_set) <= EXHAUSTIVE_LIMIT:
+            chunk_ids = chunk_set.ids()
+        elif self.centroids is not None:
+            probes = min(IVF_PROBES, len(self.centroids))
+            closest = np.argpartition(-(self.centroids @ query), probes - 1)[:probes]
+            chunk_ids = np.sort(np.concatenate([self._lists[centroid] for centroid in closest.tolist()]))
+            if chunk_set is not None:
+                chunk_ids = chunk_ids[chunk_set.select(chunk_ids)]
+        else:
+            chunk_ids = None
+
+        if chunk_ids is None:
+            scores = np.empty(self.count, dtype=np.float32)
+            for start in range(0, self.count, SCORE_BLOCK_ROWS):
+                rows = slice(start, min(start + SCORE_BLOCK_ROWS, self.count))
+                scores[rows] = self._dequantize(rows) @ query
+            keep = self._live[:self.count].copy()
+            if chunk_set is not None:
+                keep &= chunk_set.bitmap[:self.count]
+            keep &= scores >= min_score
+            chunk_ids = np.flatnonzero(keep)
+            return chunk_ids, scores[chunk_ids]
+
+        chunk_ids = chunk_ids[self._live[chunk_ids]]
+        scores = self._dequantize(chunk_ids) @ query
+        keep = scores >= min_score
+        return chunk_ids[keep], scores[keep]
+
+    def train(self) -> bool:
+        """Build the IVF lists if the corpus is large enough and has doubled since the last build"""
+        live = np.flatnonzero(self._live[:self.count])
+        if len(live) < IVF_MIN_VECTORS or (self.centroids is not None and len(live) < 2 * self.trained_count):
+            return False
+
+        rng = np.random.default_rng(0)
+        list_count = int(math.sqrt(len(live)))
+        sample = np.sort(rng.choice(live, min(len(live), list_count * IVF_SAMPLE_PER_LIST), replace=False))
+        data = self._dequantize(sample)
+        centroids = data[rng.choice(len(data), list_count, replace=False)]
+        for _ in range(IVF_ITERATIONS):
+            assignment = np.argmax(data @ centroids.T, axis=1)
+            order = np.argsort(assignment, kind='stable')
+            members, starts = np.unique(assignment[order], return_index=True)
+            # Centroids nobody was assigned to keep their position
+            centroids[members] = np.add.reduceat(data[order], starts, axis=0)
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        assignment = np.empty(len(live), dtype=np.int64)
+        for start in range(0, len(live), SCORE_BLOCK_ROWS):
+            rows = live[start:start + SCORE_BLOCK_ROWS]
+            assignment[start:start + len(rows)] = np.argmax(self._dequantize(rows) @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind='stable')  # Stable, so each list stays sorted by chunk id
+        bounds = np.searchsorted(assignment[order], np.arange(list_count + 1))
+        self._lists = [live[order[bounds[i]:bounds[i + 1]]] for i in range(list_count)]
+        self.centroids = centroids
+        self.trained_count = len(live)
+        return True
+
+    def saved_sections(self, remap: np.ndarray, live_chunks: np.ndarray) -> Tuple[dict, List[Tuple[str, np.ndarray]]]:
+        """(manifest entry, [(section name, data)]) for the rows of the live chunks, renumbered by remap"""
+        sections = [("dense_vectors", np.ascontiguousarray(self._vectors[live_chunks]))]
+        if self._scales is not None:
+            sections.append(("dense_scales", self._scales[live_chunks]))
+        if self.centroids is not None:
+            lists = [remap[members] for members in self._lists]
+            lists = [members[members >= 0] for members in lists]
+            offsets = np.cumsum([0] + [len(members) for members in lists]).astype(np.uint64)
+            sections += [("dense_centroids", self.centroids.astype(np.float32)),
+                         ("dense_lists", np.concatenate(lists).astype(np.uint32)),
+                         ("dense_list_offsets", offsets)]
+        entry = {"embedder": self.embedder_name, "dim": self.dim, "dtype": self.dtype,
+                 "trained_count": self.trained_count}
+        return entry, sections
+
+    @classmethod
+    def mapped(cls, entry: dict, section: Callable[[str], Optional[memoryview]]) -> "DenseIndex":
+        """Dense index over sections of a mapped index file; attach an embedder before use"""
+        dense = cls(None, entry["dtype"])
+        dense.embedder_name = entry["embedder"]
+        dense.dim = entry["dim"]
+        dense._vectors = np.frombuffer(section("dense_vectors"), dtype=DTYPES[dense.dtype]).reshape(-1, dense.dim)
+        dense.count = len(dense._vectors)
+        if dense.dtype == "int8":
+            dense._scales = np.frombuffer(section("dense_scales"), dtype=np.float32)
+        dense._live = np.ones(dense.count, dtype=bool)
+        centroids = section("dense_centroids")
+        if centroids is not None:
+            dense.centroids = np.frombuffer(centroids, dtype=np.float32).reshape(-1, dense.dim)
+            lists = np.frombuffer(section("dense_lists"), dtype=np.uint32)
+            offsets = np.frombuffer(section("dense_list_offsets"), dtype=np.uint64).tolist()
+            dense._lists = [lists[start:stop] for start, stop in zip(offsets, offsets[1:])]
+            dense.trained_count = entry["trained_count"]
+        return dense
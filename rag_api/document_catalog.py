@@ -0,0 +1,86 @@
+"""
+Document catalog for the RAG API
+
+Per-document figures (file size, content hash, upload time, chunk and
+term counts, approximate index bytes, indexing status) with running
+totals, so /health, /documents and /system-stats read them instead of
+scanning data/ or the index on every call. A writer builds the catalog for the next index
+generation from the previous one, recomputing entries only for files
+whose content hash changed. It is published with the index snapshot and
+saved in the index manifest, so other worker processes and restarts get
+it along with the index. Files whose text could not be extracted are
+listed too, with no chunks and the error, so the catalog matches data/.
+"""
+
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+
+class DocumentEntry(NamedTuple):
+    file_hash: str
+    size_bytes: int
+    uploaded: float  # Seconds since the epoch
+    chunk_count: int
+    term_count: int  # Distinct terms
+    index_bytes: int  # Approximate share of the index: chunk text, chunk table rows and postings
+    status: str = "indexed"  # "indexed", "empty" (no text to index) or "failed" (extraction failed)
+    error: Optional[str] = None  # Why extraction failed
+
+
+class DocumentCatalog:
+    """Catalog entries by filename, with totals kept up to date as entries change"""
+
+    def __init__(self, entries: Optional[Dict[str, DocumentEntry]] = None):
+        self.entries: Dict[str, DocumentEntry] = {}
+        self.total_size_bytes = 0
+        self.total_chunks = 0
+        self.total_index_bytes = 0
+        for filename, entry in (entries or {}).items():
+            self.put(filename, entry)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.entries)
+
+    def get(self, filename: str) -> Optional[DocumentEntry]:
+        return self.entries.get(filename)
+
+    def copy(self) -> "DocumentCatalog":
+        catalog = DocumentCatalog()
+        catalog.entries = dict(self.entries)
+        catalog.total_size_bytes = self.total_size_bytes
+        catalog.total_chunks = self.total_chunks
+        catalog.total_index_bytes = self.total_index_bytes
+        return catalog
+
+    def put(self, filename: str, entry: DocumentEntry):
+        self.remove(filename)
+        self.entries[filename] = entry
+        self.total_size_bytes += entry.size_bytes
+        self.total_chunks += entry.chunk_count
+        self.total_index_bytes += entry.index_bytes
+
+    def remove(self, filename: str) -> Optional[DocumentEntry]:
+        entry = self.entries.pop(filename, None)
+        if entry is not None:
+            self.total_size_bytes -= entry.size_bytes
+            self.total_chunks -= entry.chunk_count
+            self.total_index_bytes -= entry.index_bytes
+        return entry
+
+    def failures(self) -> Dict[str, Tuple[str, Optional[str]]]:
+        """(file hash, error) of each file whose extraction failed"""
+        return {filename: (entry.file_hash, entry.error)
+                for filename, entry in self.entries.items() if entry.status == "failed"}
+
+    def to_manifest(self) -> Dict[str, List]:
+        """Entries with their hashes, as failed files are not among the manifest's indexed files"""
+        return {filename: list(entry) for filename, entry in self.entries.items()}
+
+    @classmethod
+    def from_manifest(cls, entries: Dict[str, List]) -> "DocumentCatalog":
+        return cls({filename: DocumentEntry(*values) for filename, values in entries.items()})
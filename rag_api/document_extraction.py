@@ -0,0 +1,290 @@
+"""
+Document text extraction for the RAG API
+
+Kept apart from main_optimized so process-pool workers can import it
+without creating the FastAPI app or loading the index. PyPDF2 is imported
+only where a PDF is read, so a server that maps a stored index never loads
+it.
+"""
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Large PDFs are split into page ranges so one file can use several workers
+SPLIT_PDF_SIZE = 5 * 1024 * 1024  # Only count pages of PDFs above this size
+PAGES_PER_TASK = 50
+POLL_INTERVAL = 0.5  # Seconds between timeout checks while waiting on workers
+
+
+class ExtractionCache:
+    """Extracted text and chunks stored on disk, keyed by file content SHA-256
+
+    Files that yield no text are cached too, so a broken PDF is parsed once
+    rather than on every reload. Entries record the chunking settings they
+    were made with and are ignored if those change.
+    """
+
+    def __init__(self, cache_dir: str, chunk_size: int, overlap: int):
+        self.cache_dir = cache_dir
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, file_hash: str) -> str:
+        return os.path.join(self.cache_dir, f"{file_hash}.json")
+
+    def get(self, file_hash: str) -> Optional[dict]:
+        """Cached {"text", "starts", "ends"} entry for this content, or None on a miss
+
+        "text" is the chunk buffer (None for a file without text) and each
+        chunk is text[starts[i]:ends[i]].
+        """
+        try:
+            with open(self._path(file_hash), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        # Entries written before chunks were kept as offsets hold chunk strings instead
+        if (entry.get("chunk_size"), entry.get("overlap")) != (self.chunk_size, self.overlap) or "starts" not in entry:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, file_hash: str, chunks):
+        """Remember a search_index.ChunkedText for this content, or None for a file without text"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = {"chunk_size": self.chunk_size, "overlap": self.overlap,
+                 "text": chunks.text if chunks is not None else None,
+                 "starts": list(chunks.starts) if chunks is not None else [],
+                 "ends": list(chunks.ends) if chunks is not None else []}
+        tmp_path = f"{self._path(file_hash)}.{os.getpid()}.tmp"  # Server processes may share the cache
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._path(file_hash))
+        except OSError as e:
+            logger.error(f"Error writing extraction cache entry {file_hash}: {e}")
+
+    def prune(self, keep_hashes):
+        """Delete entries for content no longer in data/"""
+        if not os.path.isdir(self.cache_dir):
+            return
+        keep = {f"{file_hash}.json" for file_hash in keep_hashes}
+        for name in os.listdir(self.cache_dir):
+            if name not in keep:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+
+def timed_pdf_pages(file_path: str, start: int = 0, stop: Optional[int] = None) -> Tuple[str, int, float]:
+    """(text, pages read, seconds taken) for pages [start, stop) of a PDF"""
+    import PyPDF2
+
+    started = time.perf_counter()
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        page_count = len(pdf_reader.pages)
+        stop = page_count if stop is None else min(stop, page_count)
+        parts = []
+        for page_number in range(start, stop):
+            page_text = pdf_reader.pages[page_number].extract_text()
+            if page_text:
+                parts.append(page_text)
+        return "\n".join(parts), max(stop - start, 0), time.perf_counter() - started
+
+
+def extract_pdf_pages(file_path: str, start: int = 0, stop: Optional[int] = None) -> str:
+    """Extract the text of pages [start, stop) of a PDF"""
+    return timed_pdf_pages(file_path, start, stop)[0]
+
+
+def extract_text_from_pdf(file_path: str) -> str:
+    """Extract text from PDF file with error handling"""
+    try:
+        return extract_pdf_pages(file_path).strip()
+    except Exception as e:
+        logger.error(f"Error extracting text from PDF {file_path}: {e}")
+        return ""
+
+
+def read_document(file_path: str) -> Optional[str]:
+    """Extract the text of a single supported document, or None if it has none"""
+    filename = os.path.basename(file_path)
+
+    if filename.endswith('.pdf'):
+        content = extract_text_from_pdf(file_path)
+        if content.strip():
+            logger.info(f"Loaded PDF document: {filename}")
+            return content
+
+    elif filename.endswith(('.txt', '.md')):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+            logger.info(f"Loaded text document: {filename}")
+            return content
+
+    elif filename.endswith('.docx'):
+        logger.info(f"Skipping DOCX file (not supported yet): {filename}")
+
+    return None
+
+
+def timed_extract_document(file_path: str) -> Tuple[Optional[str], int, float]:
+    """extract_document() plus the PDF pages read and the seconds taken (0 pages for other files)"""
+    started = time.perf_counter()
+    try:
+        if file_path.endswith('.pdf'):
+            text, pages, seconds = timed_pdf_pages(file_path)
+            text = text.strip()
+            if text:
+                logger.info(f"Loaded PDF document: {os.path.basename(file_path)}")
+            return text, pages, seconds
+        return read_document(file_path) or "", 0, time.perf_counter() - started
+    except Exception as e:
+        logger.error(f"Error loading {os.path.basename(file_path)}: {e}")
+        return None, 0, time.perf_counter() - started
+
+
+def extract_document(file_path: str) -> Optional[str]:
+    """Extract one file in-process: "" if it has no text, None if extraction failed"""
+    return timed_extract_document(file_path)[0]
+
+
+def pdf_page_ranges(file_path: str) -> List[Tuple[int, Optional[int]]]:
+    """Page ranges to extract separately; small PDFs are a single task"""
+    if os.path.getsize(file_path) < SPLIT_PDF_SIZE:
+        return [(0, None)]
+    try:
+        import PyPDF2
+
+        page_count = len(PyPDF2.PdfReader(file_path).pages)
+    except Exception:
+        return [(0, None)]
+    return [(start, start + PAGES_PER_TASK) for start in range(0, page_count, PAGES_PER_TASK)] or [(0, None)]
+
+
+def _terminate_workers(executor: ProcessPoolExecutor):
+    """Kill workers stuck on a timed-out file so they do not outlive the batch"""
+    terminate = getattr(executor, "terminate_workers", None)  # Python 3.14+
+    if terminate is not None:
+        terminate()
+        return
+    for process in list((executor._processes or {}).values()):
+        process.terminate()
+
+
+def extract_documents(file_paths: List[str], workers: Optional[int] = None,
+                      timeout: Optional[float] = None,
+                      page_timer: Optional[Callable[[int, float], None]] = None
+                      ) -> Iterator[Tuple[str, Optional[str]]]:
+    """Yield (file_path, text) for each file as soon as its extraction finishes
+
+    Text files are read in-process. PDFs are parsed in a process pool of
+    `workers` processes (0 extracts serially in-process). Text is "" for a
+    file without extractable text and None when extraction failed; a PDF
+    whose task runs longer than `timeout` seconds is abandoned and also
+    yielded with None, so one bad file cannot stall the batch.
+    page_timer, if given, is called with (pages, seconds) for each PDF page
+    range extracted.
+    """
+    def extract_in_process(file_path: str) -> Optional[str]:
+        text, pages, seconds = timed_extract_document(file_path)
+        if page_timer is not None and pages:
+            page_timer(pages, seconds)
+        return text
+
+    pdf_paths = [file_path for file_path in file_paths if file_path.endswith('.pdf')]
+    for file_path in file_paths:
+        if not file_path.endswith('.pdf'):
+            yield file_path, extract_in_process(file_path)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if not pdf_paths or workers <= 0:
+        for file_path in pdf_paths:
+            yield file_path, extract_in_process(file_path)
+        return
+
+    tasks = []  # (file_path, part number, first page, stop page)
+    parts: Dict[str, List[Optional[str]]] = {}
+    for file_path in pdf_paths:
+        ranges = pdf_page_ranges(file_path)
+        parts[file_path] = [None] * len(ranges)
+        tasks.extend((file_path, part, start, stop) for part, (start, stop) in enumerate(ranges))
+    workers = min(workers, len(tasks))
+
+    def start_pool(task_list):
+        pool = ProcessPoolExecutor(max_workers=workers)
+        return pool, {pool.submit(timed_pdf_pages, path, start, stop): (path, part, start, stop)
+                      for path, part, start, stop in task_list}
+
+    def drop(file_path: str):
+        """Forget the remaining tasks of a file that failed or timed out"""
+        parts.pop(file_path, None)
+        for future, task in list(pending.items()):
+            if task[0] == file_path:
+                del pending[future]
+
+    executor, pending = start_pool(tasks)
+    running_since = {}
+
+    try:
+        while pending:
+            done, _ = wait(pending, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future not in pending:
+                    continue
+                file_path, part, _, _ = pending.pop(future)
+                try:
+                    parts[file_path][part], pages, seconds = future.result()
+                except Exception as e:
+                    logger.error(f"Error extracting text from PDF {file_path}: {e}")
+                    drop(file_path)
+                    yield file_path, None
+                    continue
+
+                if page_timer is not None and pages:
+                    page_timer(pages, seconds)
+                if all(text is not None for text in parts[file_path]):
+                    text = "\n".join(text for text in parts.pop(file_path) if text).strip()
+                    if text:
+                        logger.info(f"Loaded PDF document: {os.path.basename(file_path)}")
+                    yield file_path, text
+
+            if timeout is None:
+                continue
+
+            # Futures count as running once handed to a worker, so this is per-task wall time
+            now = time.monotonic()
+            timed_out = {pending[future][0] for future in pending
+                         if future.running() and now - running_since.setdefault(future, now) > timeout}
+            if not timed_out:
+                continue
+
+            for file_path in timed_out:
+                logger.error(f"Timed out after {timeout:.0f}s extracting {file_path}")
+                drop(file_path)
+                yield file_path, None
+
+            # A stuck worker cannot be interrupted, so replace the pool and requeue the rest.
+            # Futures are abandoned rather than cancelled: the broken pool fails them itself.
+            _terminate_workers(executor)
+            executor.shutdown(wait=False)
+            executor, pending = start_pool(list(pending.values()))
+            running_since.clear()
+    finally:
+        if pending:
+            _terminate_workers(executor)
+        executor.shutdown(wait=not pending)
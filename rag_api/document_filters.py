@@ -0,0 +1,96 @@
+"""
+Document filters for scoped searches
+
+A filter selects documents by exact filename or glob pattern, by file type
+and by upload time. It is compiled against the search index into a
+ChunkSet of the selected documents' chunks, once per corpus state, and the
+scorer cuts postings down to that set before anything is scored.
+"""
+
+import fnmatch
+import os
+from datetime import datetime
+from typing import Iterable, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+from search_index import ChunkSet, SearchIndex
+
+GLOB_CHARACTERS = set("*?[")
+
+
+def is_glob(name: str) -> bool:
+    return not GLOB_CHARACTERS.isdisjoint(name)
+
+
+class DocumentFilter(NamedTuple):
+    """Documents a search is limited to
+
+    A document must match one of the names or patterns (when any are
+    given), have one of the file types (when any are given) and have been
+    uploaded within the time bounds.
+    """
+    names: Tuple[str, ...] = ()
+    patterns: Tuple[str, ...] = ()
+    file_types: Tuple[str, ...] = ()
+    uploaded_after: Optional[float] = None
+    uploaded_before: Optional[float] = None
+
+    @classmethod
+    def build(cls, documents: Union[str, List[str], None] = None, file_types: Optional[List[str]] = None,
+              uploaded_after: Optional[datetime] = None,
+              uploaded_before: Optional[datetime] = None) -> Optional["DocumentFilter"]:
+        """Filter from request fields, or None when nothing is filtered
+
+        `documents` is a filename or a list of them; names containing glob
+        characters (* ? [) are matched as patterns. File types are
+        extensions, with or without the leading dot.
+        """
+        if isinstance(documents, str):
+            documents = [documents]
+        documents = [name for name in documents or () if name]
+        file_types = {extension.lower() if extension.startswith(".") else "." + extension.lower()
+                      for extension in file_types or () if extension}
+        document_filter = cls(
+            names=tuple(sorted({name for name in documents if not is_glob(name)})),
+            patterns=tuple(sorted({name for name in documents if is_glob(name)})),
+            file_types=tuple(sorted(file_types)),
+            uploaded_after=uploaded_after.timestamp() if uploaded_after is not None else None,
+            uploaded_before=uploaded_before.timestamp() if uploaded_before is not None else None,
+        )
+        return document_filter if document_filter != cls() else None
+
+    def key(self) -> str:
+        """Stable text form, for cache keys"""
+        return repr(tuple(self))
+
+    def document_ids(self, index: SearchIndex) -> Iterable[int]:
+        """Ids of the live documents the filter accepts"""
+        if self.names and not self.patterns:
+            # Exact names are looked up rather than compared with every document
+            candidates = [(index.doc_ids[name], name) for name in self.names if name in index.doc_ids]
+        else:
+            candidates = [(doc_id, name) for doc_id, name in enumerate(index.doc_names) if name is not None]
+            if self.names or self.patterns:
+                names = set(self.names)
+                candidates = [(doc_id, name) for doc_id, name in candidates if name in names or
+                              any(fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns)]
+
+        if self.file_types:
+            candidates = [(doc_id, name) for doc_id, name in candidates
+                          if os.path.splitext(name)[1].lower() in self.file_types]
+
+        if self.uploaded_after is not None or self.uploaded_before is not None:
+            uploaded = np.array(index.doc_uploaded, dtype=np.float64)
+            doc_ids = np.array([doc_id for doc_id, _ in candidates], dtype=np.int64)
+            keep = np.ones(len(doc_ids), dtype=bool)
+            if self.uploaded_after is not None:
+                keep &= uploaded[doc_ids] >= self.uploaded_after
+            if self.uploaded_before is not None:
+                keep &= uploaded[doc_ids] < self.uploaded_before
+            return doc_ids[keep].tolist()
+        return [doc_id for doc_id, _ in candidates]
+
+    def chunk_set(self, index: SearchIndex) -> ChunkSet:
+        """Chunks of the accepted documents, compiled once per corpus state"""
+        return index.cached_chunk_set(self, lambda: self.document_ids(index))
@@ -0,0 +1,185 @@
+"""
+Execution layer for CPU-bound work in the RAG API
+
+Request handlers run on the asyncio event loop, so searches, report
+rendering and indexing are handed to executors instead. Each queue admits
+a bounded number of tasks (queued plus running); once it is full new work
+is rejected with a 503 so overload shows up as fast failures rather than
+an event loop that stops answering. Work that callers do not wait for,
+such as indexing an upload, is tracked by job id so its status can be
+polled. Handlers that change files before their work runs reserve a slot
+first, so a full queue rejects the request before anything has changed.
+"""
+
+import asyncio
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Executor, Future
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Union
+
+from fastapi import HTTPException
+
+
+class QueueFullError(HTTPException):
+    """Raised when an execution queue is at capacity"""
+
+    def __init__(self, queue_name: str, retry_after: int = 1):
+        super().__init__(
+            status_code=503,
+            detail=f"Server busy: {queue_name} queue is full, retry shortly",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class BoundedQueue:
+    """Admits at most `max_pending` tasks into an executor at a time"""
+
+    def __init__(self, name: str, executor: Executor, max_pending: int):
+        self.name = name
+        self.executor = executor
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _release(self, _future):
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+        self._slots.release()
+
+    def submit(self, fn: Callable, *args) -> Future:
+        """Queue fn(*args) without waiting for it, or raise QueueFullError if the queue is full"""
+        self._acquire()
+        return self._start(fn, *args)
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """Run fn(*args) in the executor, or raise QueueFullError if the queue is full"""
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def reserve(self) -> "Reservation":
+        """Claim a slot now for work submitted later, or raise QueueFullError if the queue is full
+
+        For work with side effects that must not happen unless it is
+        accepted: reserve, make the change, then submit through the
+        reservation. A slot that is never submitted to is given back when
+        the reservation's `with` block ends.
+        """
+        self._acquire()
+        return Reservation(self)
+
+    def _acquire(self):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise QueueFullError(self.name)
+
+    def _start(self, fn: Callable, *args) -> Future:
+        with self._lock:
+            self.pending += 1
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        # The slot is freed when the work finishes, even if the caller stops waiting
+        future.add_done_callback(self._release)
+        return future
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "pending": self.pending,
+                "max_pending": self.max_pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+
+class Reservation:
+    """A slot claimed in a BoundedQueue, used by one submit() or given back"""
+
+    def __init__(self, queue: BoundedQueue):
+        self.queue = queue
+        self.used = False
+
+    def submit(self, fn: Callable, *args) -> Future:
+        """Queue fn(*args) in the reserved slot; never raises QueueFullError"""
+        if self.used:
+            raise RuntimeError(f"{self.queue.name} queue reservation already used")
+        self.used = True
+        return self.queue._start(fn, *args)
+
+    async def run(self, fn: Callable, *args) -> Any:
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def release(self):
+        if not self.used:
+            self.used = True
+            self.queue._slots.release()
+
+    def __enter__(self) -> "Reservation":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class JobTracker:
+    """Status of background work submitted to a queue, looked up by job id
+
+    Only the most recent `max_jobs` finished jobs are remembered.
+    """
+
+    def __init__(self, max_jobs: int = 100):
+        self.max_jobs = max_jobs
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, queue: Union[BoundedQueue, Reservation], fn: Callable, *args, **details) -> str:
+        """Queue fn(*args) and return its job id; raises QueueFullError like the queue"""
+        job_id = uuid.uuid4().hex
+        job = {"job_id": job_id, "status": "queued", "submitted_at": datetime.now().isoformat(),
+               "started_at": None, "finished_at": None, "result": None, "error": None, **details}
+
+        def run():
+            self._update(job_id, status="running", started_at=datetime.now().isoformat())
+            try:
+                result = fn(*args)
+            except Exception as e:
+                self._update(job_id, status="failed", error=str(e), finished_at=datetime.now().isoformat())
+                raise
+            self._update(job_id, status="completed", result=result, finished_at=datetime.now().isoformat())
+            return result
+
+        with self._lock:
+            self._jobs[job_id] = job
+        try:
+            queue.submit(run)
+        except QueueFullError:
+            with self._lock:
+                del self._jobs[job_id]
+            raise
+        self._trim()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def _trim(self):
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if job["finished_at"] is not None]
+            for job_id in finished[:max(0, len(self._jobs) - self.max_jobs)]:
+                del self._jobs[job_id]
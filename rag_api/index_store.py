@@ -0,0 +1,588 @@
+"""
+On-disk format for the search index
+
+An index is written to a single file under ``storage/`` named after a hash
+of the corpus (every file name and its SHA-256) and a generation number.
+Loading memory-maps the file: the term table, postings and chunk table stay
+as read-only views into the mapping and chunk text is decoded only when a
+chunk is returned, so startup never touches PyPDF2 and several server
+processes mapping the same file share one copy of it in the page cache.
+
+Every write produces a new generation file; ``storage/CURRENT`` names the
+published one and is replaced atomically, so readers switch generations
+without ever seeing a partly written index. Writers from different
+processes take turns through an exclusive lock on ``storage/index.lock``.
+The one process that watches ``data/`` for changes holds
+``storage/watcher.lock`` for as long as it runs.
+
+Layout (native byte order, sections 8-byte aligned)::
+
+    MAGIC
+    terms                sorted terms, concatenated (utf-8)
+    term_offsets         uint64 per term + 1, into terms
+    term_start           uint64 per term, first posting index
+    term_count           uint32 per term, number of postings
+    posting_ids          uint32 chunk ids, grouped by term
+    posting_freqs        uint32 term frequencies, parallel to posting_ids
+    positions            varint delta-encoded token positions, grouped by term; a posting's
+                         freq says how many it has, so no per-posting offsets are stored
+    term_position_start  uint64 per term + 1, into positions
+    chunk_doc            uint32 per chunk
+    chunk_offset         uint32 per chunk
+    chunk_length         uint32 per chunk
+    chunk_starts         uint64 per chunk, into text
+    chunk_ends           uint64 per chunk, into text
+    text                 utf-8 text of each document, chunks overlapping within it
+    dense_*              embeddings and IVF lists, when dense retrieval is on
+                         (see dense_index.DenseIndex.saved_sections)
+    manifest             JSON (documents, file hashes, document catalog, section offsets)
+    uint64 manifest offset, uint64 manifest length, MAGIC
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from dense_index import DenseIndex
+from search_index import ChunkedText, ChunkTexts, SearchIndex
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"RAGIDX01"
+FORMAT_VERSION = 9
+TRAILER = struct.Struct("<QQ8s")
+INDEX_PATTERN = "index_*.bin"
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = "index.lock"
+WATCHER_LOCK_FILE = "watcher.lock"
+
+
+class MappedTerms:
+    """Sorted term table read from the mapped index file
+
+    Terms are found by binary search over the mapped bytes; UTF-8 byte order
+    matches the code point order the terms were sorted in.
+    """
+
+    def __init__(self, text: memoryview, offsets: memoryview):
+        self._text = text
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, row: int) -> str:
+        return str(self._key(row), 'utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        for row in range(len(self)):
+            yield self[row]
+
+    def _key(self, row: int) -> bytes:
+        return self._text[self._offsets[row]:self._offsets[row + 1]].tobytes()
+
+    def lower_bound(self, term: str, low: int = 0) -> int:
+        """Row of the first term not sorting below `term`, searching from row `low` on
+
+        The search gallops forward from `low` before bisecting, so a nearby
+        answer costs a few comparisons rather than a search of the whole table.
+        """
+        key = term.encode('utf-8')
+        high = len(self)
+        step = 1
+        while low + step < high and self._key(low + step) < key:
+            low += step + 1
+            step *= 2
+        high = min(high, low + step)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def encoded(self, rows: range) -> Tuple[memoryview, List[int]]:
+        """UTF-8 bytes of a run of rows and each term's length in bytes, without decoding them"""
+        offsets = np.asarray(self._offsets[rows.start:rows.stop + 1], dtype=np.int64)
+        return self._text[offsets[0]:offsets[-1]], np.diff(offsets).tolist()
+
+    def find(self, term: str) -> Optional[int]:
+        """Row of the term in the mapped columns, or None if it is not indexed"""
+        row = self.lower_bound(term)
+        if row < len(self) and self._key(row) == term.encode('utf-8'):
+            return row
+        return None
+
+
+class MappedChunkText:
+    """Chunk text read from the mapped index file, with in-memory edits on top
+
+    The file holds each document's text once; a chunk is a (start, end)
+    byte range of it, so overlapping chunks share their bytes.
+    """
+
+    def __init__(self, text: memoryview, starts: memoryview, ends: memoryview):
+        self._text = text
+        self._starts = starts
+        self._ends = ends
+        self._stored = len(starts)
+        self._removed = set()
+        self._appended = ChunkTexts()  # Documents added since the file was written
+
+    def __len__(self) -> int:
+        return self._stored + len(self._appended)
+
+    def __getitem__(self, chunk_id: int) -> Optional[str]:
+        if chunk_id >= self._stored:
+            return self._appended[chunk_id - self._stored]
+        if chunk_id in self._removed:
+            return None
+        return str(self._text[self._starts[chunk_id]:self._ends[chunk_id]], 'utf-8')
+
+    def __iter__(self):
+        for chunk_id in range(len(self)):
+            yield self[chunk_id]
+
+    def extend(self, chunked: ChunkedText):
+        self._appended.extend(chunked)
+
+    def clear(self, chunk_ids: range):
+        if chunk_ids and chunk_ids.start >= self._stored:
+            self._appended.clear(range(chunk_ids.start - self._stored, chunk_ids.stop - self._stored))
+        else:
+            self._removed.update(chunk_ids)
+
+    def document(self, chunk_ids: range) -> ChunkedText:
+        if chunk_ids and chunk_ids.start >= self._stored:
+            return self._appended.document(range(chunk_ids.start - self._stored, chunk_ids.stop - self._stored))
+        data, starts, ends = self.document_bytes(chunk_ids)
+        text = str(data, 'utf-8')
+        if len(text) != len(data):
+            # Character offsets of every boundary, decoding the stretches between them in order
+            boundaries = sorted(set(starts) | set(ends))
+            char_offsets = {}
+            position = previous = 0
+            for boundary in boundaries:
+                position += len(str(data[previous:boundary], 'utf-8'))
+                char_offsets[boundary] = position
+                previous = boundary
+            starts = [char_offsets[start] for start in starts]
+            ends = [char_offsets[end] for end in ends]
+        return ChunkedText(text, starts, ends)
+
+    def document_bytes(self, chunk_ids: range) -> Tuple[memoryview, List[int], List[int]]:
+        """A document's stored text and its chunks' byte offsets into it, without decoding"""
+        if chunk_ids and chunk_ids.start >= self._stored:
+            return self._appended.document_bytes(range(chunk_ids.start - self._stored,
+                                                       chunk_ids.stop - self._stored))
+        if not chunk_ids:
+            return memoryview(b""), [], []
+        starts = self._starts[chunk_ids.start:chunk_ids.stop].tolist()
+        ends = self._ends[chunk_ids.start:chunk_ids.stop].tolist()
+        low, high = min(starts), max(ends)
+        return (self._text[low:high], [start - low for start in starts], [end - low for end in ends])
+
+    @property
+    def heap_size(self) -> int:
+        return self._appended.heap_size
+
+
+def file_sha256(file_path: str) -> str:
+    """Hash a file's content without reading it into memory at once"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_file_stats(path: str) -> Dict[str, list]:
+    """Previously seen [size, mtime_ns, sha256] per data file"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_file_stats(path: str, file_stats: Dict[str, list]):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(file_stats, f)
+    os.replace(tmp_path, path)
+
+
+def cached_file_sha256(file_path: str, file_stats: Dict[str, list]) -> str:
+    """SHA-256 of a file, reusing the recorded hash while its size and mtime are unchanged"""
+    stat = os.stat(file_path)
+    filename = os.path.basename(file_path)
+    recorded = file_stats.get(filename)
+    if recorded and recorded[0] == stat.st_size and recorded[1] == stat.st_mtime_ns:
+        return recorded[2]
+    file_hash = file_sha256(file_path)
+    file_stats[filename] = [stat.st_size, stat.st_mtime_ns, file_hash]
+    return file_hash
+
+
+def corpus_key(file_hashes: Dict[str, str]) -> str:
+    """Identify a corpus by the names and content hashes of its files"""
+    digest = hashlib.sha256()
+    for filename in sorted(file_hashes):
+        digest.update(f"{filename}\0{file_hashes[filename]}\n".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def index_path(storage_dir: str, file_hashes: Dict[str, str], generation: int) -> str:
+    return os.path.join(storage_dir, f"index_{corpus_key(file_hashes)}_{generation:06d}.bin")
+
+
+class StorageLock:
+    """Exclusive lock on storage/ held while a process writes a new generation
+
+    The lock belongs to the open file, so it must not be taken twice by the
+    same process; the server only writes from its single indexing thread.
+    With another `lock_file` it guards something else the server processes
+    share, such as which of them watches data/.
+    """
+
+    def __init__(self, storage_dir: str, lock_file: str = LOCK_FILE):
+        self.path = os.path.join(storage_dir, lock_file)
+        self._file = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Take the lock, waiting for it unless `blocking` is False; returns whether it was taken"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, 'a+b')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    self._close()
+                    return False
+                return True
+            self._file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                    return True
+                except OSError:  # LK_LOCK gives up after about 10 seconds
+                    if not blocking:
+                        self._close()
+                        return False
+                    time.sleep(0.1)
+        except BaseException:
+            self._close()
+            raise
+
+    def release(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._close()
+
+    def _close(self):
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def publish_generation(storage_dir: str, path: str, generation: int):
+    """Point storage/CURRENT at an index file; readers see either the old or the new pointer"""
+    current_path = os.path.join(storage_dir, CURRENT_FILE)
+    tmp_path = f"{current_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"generation": generation, "index": os.path.basename(path)}, f)
+    os.replace(tmp_path, current_path)
+
+
+def read_generation(storage_dir: str) -> Optional[Tuple[int, str]]:
+    """(generation, index path) of the published index, or None if nothing was published"""
+    try:
+        with open(os.path.join(storage_dir, CURRENT_FILE), 'r', encoding='utf-8') as f:
+            current = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return current["generation"], os.path.join(storage_dir, current["index"])
+
+
+def generation_stamp(storage_dir: str) -> Optional[tuple]:
+    """Cheap fingerprint of storage/CURRENT that changes whenever a generation is published"""
+    try:
+        stat = os.stat(os.path.join(storage_dir, CURRENT_FILE))
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _align(f):
+    f.write(b"\0" * (-f.tell() % 8))
+
+
+def _as_bytes(values):
+    """Typed memoryviews (postings still backed by the mapped file) are written as raw bytes"""
+    return values.cast('B') if isinstance(values, memoryview) else values
+
+
+def _write_section(f, sections: dict, name: str, data):
+    _align(f)
+    start = f.tell()
+    f.write(_as_bytes(data))
+    sections[name] = [start, f.tell() - start]
+
+
+def _write_blocks(f, sections: dict, name: str, blocks: Iterable):
+    _align(f)
+    start = f.tell()
+    for data in blocks:
+        f.write(_as_bytes(data))
+    sections[name] = [start, f.tell() - start]
+
+
+def _cumulative(lengths: List[int]) -> np.ndarray:
+    """Start of each item and the end of the last, for items of these lengths laid end to end"""
+    starts = np.zeros(len(lengths) + 1, dtype=np.uint64)
+    np.cumsum(lengths, dtype=np.uint64, out=starts[1:])
+    return starts
+
+
+def _posting_blocks(index: SearchIndex) -> Iterator[tuple]:
+    """The index's postings in term order, a block per run of unchanged mapped terms or per other term
+
+    Each block is (UTF-8 terms, term byte lengths, posting counts, chunk
+    ids, freqs, encoded positions, position byte counts).
+    """
+    mapped = index.mapped_postings
+    if mapped is not None:
+        terms, (term_start, term_count, chunk_ids, freqs, term_position_start, positions) = mapped
+    for block in index.saved_postings():
+        if isinstance(block, range):
+            first, last = block.start, block.stop - 1
+            text, term_lengths = terms.encoded(block)
+            postings = slice(term_start[first], term_start[last] + term_count[last])
+            position_starts = term_position_start[first:last + 2].tolist()
+            yield (text, term_lengths, term_count[first:last + 1].tolist(), chunk_ids[postings], freqs[postings],
+                   positions[position_starts[0]:position_starts[-1]],
+                   [stop - start for start, stop in zip(position_starts, position_starts[1:])])
+        else:
+            term, postings = block
+            encoded = term.encode('utf-8')
+            yield (encoded, [len(encoded)], [len(postings)], postings.chunk_ids, postings.freqs, postings.positions,
+                   [len(postings.positions)])
+
+
+def save_index(index: SearchIndex, storage_dir: str, file_hashes: Dict[str, str], generation: int,
+               catalog: Optional[Dict[str, list]] = None) -> str:
+    """Write a compacted copy of the index as the given generation and return its path
+
+    `catalog` is document_catalog.DocumentCatalog.to_manifest(), kept in the
+    manifest so the catalog loads with the index.
+
+    Removed documents leave gaps in the chunk id space; live chunks are
+    renumbered contiguously on the way out, which keeps postings sorted.
+    Postings of a loaded index that did not change are copied from the
+    mapped file in runs, so a save after a few documents changed only
+    handles the terms they contain one by one.
+    The file is not visible to readers until publish_generation() is called.
+    """
+    os.makedirs(storage_dir, exist_ok=True)
+    path = index_path(storage_dir, file_hashes, generation)
+
+    live_docs = [(doc_id, name) for doc_id, name in enumerate(index.doc_names) if name is not None]
+    remap = np.full(len(index.chunk_text), -1, dtype=np.int64)
+    doc_of_chunk = np.zeros(len(index.chunk_text), dtype=np.uint32)
+    documents = []
+    next_chunk = 0
+    for new_doc_id, (doc_id, name) in enumerate(live_docs):
+        chunk_ids = index.doc_chunks[doc_id]
+        remap[chunk_ids.start:chunk_ids.stop] = np.arange(next_chunk, next_chunk + len(chunk_ids))
+        doc_of_chunk[chunk_ids.start:chunk_ids.stop] = new_doc_id
+        documents.append({"filename": name, "first_chunk": next_chunk, "chunk_count": len(chunk_ids),
+                          "uploaded": index.doc_uploaded[doc_id]})
+        next_chunk += len(chunk_ids)
+    compacted = next_chunk != len(index.chunk_text)
+    live_chunks = np.flatnonzero(remap >= 0)
+
+    blocks = list(_posting_blocks(index))
+    term_lengths, term_count, position_lengths = [], [], []
+    for block in blocks:
+        term_lengths += block[1]
+        term_count += block[2]
+        position_lengths += block[6]
+    sections = {}
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        _write_blocks(f, sections, "terms", (block[0] for block in blocks))
+        _write_section(f, sections, "term_offsets", _cumulative(term_lengths))
+        _write_section(f, sections, "term_start", _cumulative(term_count)[:-1])
+        _write_section(f, sections, "term_count", np.array(term_count, dtype=np.uint32))
+
+        if compacted:
+            _write_blocks(f, sections, "posting_ids",
+                          (remap[np.frombuffer(block[3], dtype=np.uint32)].astype(np.uint32) for block in blocks))
+        else:
+            _write_blocks(f, sections, "posting_ids", (block[3] for block in blocks))
+        _write_blocks(f, sections, "posting_freqs", (block[4] for block in blocks))
+        # Chunk renumbering keeps posting order, so encoded positions are copied as they are
+        _write_blocks(f, sections, "positions", (block[5] for block in blocks))
+        _write_section(f, sections, "term_position_start", _cumulative(position_lengths))
+
+        _write_section(f, sections, "chunk_doc", doc_of_chunk[live_chunks])
+        _write_section(f, sections, "chunk_offset",
+                       np.array(index.chunk_offset, dtype=np.uint32)[live_chunks])
+        _write_section(f, sections, "chunk_length",
+                       np.array(index.chunk_length, dtype=np.uint32)[live_chunks])
+
+        # Each document's text is written once, with its chunks as byte ranges of it
+        chunk_starts = array('Q')
+        chunk_ends = array('Q')
+        _align(f)
+        start = f.tell()
+        for doc_id, _ in live_docs:
+            data, starts, ends = index.chunk_text.document_bytes(index.doc_chunks[doc_id])
+            base = f.tell() - start
+            chunk_starts.extend(base + offset for offset in starts)
+            chunk_ends.extend(base + offset for offset in ends)
+            f.write(data)
+        sections["text"] = [start, f.tell() - start]
+        _write_section(f, sections, "chunk_starts", chunk_starts)
+        _write_section(f, sections, "chunk_ends", chunk_ends)
+
+        dense = None
+        if index.dense is not None:
+            dense, dense_sections = index.dense.saved_sections(remap, live_chunks)
+            for name, data in dense_sections:
+                _write_section(f, sections, name, data)
+
+        manifest = {
+            "version": FORMAT_VERSION,
+            "generation": generation,
+            "byteorder": sys.byteorder,
+            "k1": index.k1,
+            "b": index.b,
+            "files": file_hashes,
+            "catalog": catalog or {},
+            "documents": documents,
+            "total_length": index.total_length,
+            "dense": dense,
+            "sections": sections,
+        }
+        manifest_bytes = json.dumps(manifest).encode('utf-8')
+        manifest_offset = f.tell()
+        f.write(manifest_bytes)
+        f.write(TRAILER.pack(manifest_offset, len(manifest_bytes), MAGIC))
+
+    os.replace(tmp_path, path)
+    logger.info(f"Saved search index to {path} ({os.path.getsize(path) / (1024 * 1024):.2f} MB)")
+    return path
+
+
+def read_manifest(path: str) -> Optional[dict]:
+    """Read just the manifest of an index file, or None if it is not a valid index"""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-TRAILER.size, os.SEEK_END)
+            manifest_offset, manifest_length, magic = TRAILER.unpack(f.read(TRAILER.size))
+            if magic != MAGIC:
+                return None
+            f.seek(manifest_offset)
+            manifest = json.loads(f.read(manifest_length))
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != FORMAT_VERSION or manifest.get("byteorder") != sys.byteorder:
+        return None
+    return manifest
+
+
+def load_index(path: str) -> Optional[Tuple[SearchIndex, dict]]:
+    """Memory-map an index file, returning the index and its manifest"""
+    manifest = read_manifest(path)
+    if manifest is None:
+        return None
+
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buffer = memoryview(mapping)
+    sections = manifest["sections"]
+
+    def section(name: str, fmt: str = 'B') -> memoryview:
+        start, length = sections[name]
+        view = buffer[start:start + length]
+        return view.cast(fmt) if fmt != 'B' else view
+
+    index = SearchIndex(k1=manifest["k1"], b=manifest["b"])
+    index.mapped_bytes = len(mapping)
+    for doc_id, document in enumerate(manifest["documents"]):
+        index.doc_names.append(document["filename"])
+        index.doc_uploaded.append(document["uploaded"])
+        index.doc_ids[document["filename"]] = doc_id
+        index.doc_chunks[doc_id] = range(document["first_chunk"],
+                                         document["first_chunk"] + document["chunk_count"])
+
+    # The chunk table is copied out by the index only once a document is added
+    for name in ("chunk_doc", "chunk_offset", "chunk_length"):
+        setattr(index, name, section(name, 'I'))
+    index.chunk_text = MappedChunkText(section("text"), section("chunk_starts", 'Q'), section("chunk_ends", 'Q'))
+    index.live_chunks = len(index.chunk_doc)
+    index.total_length = manifest["total_length"]
+
+    terms = MappedTerms(section("terms"), section("term_offsets", 'Q'))
+    index.attach_mapped_postings(terms, section("term_start", 'Q'), section("term_count", 'I'),
+                                 section("posting_ids", 'I'), section("posting_freqs", 'I'),
+                                 section("term_position_start", 'Q'), section("positions"))
+    if manifest["dense"] is not None:
+        index.dense = DenseIndex.mapped(manifest["dense"], lambda name: section(name) if name in sections else None)
+
+    index.refresh_statistics()
+    return index, manifest
+
+
+def find_latest_index(storage_dir: str) -> Optional[str]:
+    """Most recently written index file, used as the base for incremental catch-up"""
+    candidates = glob.glob(os.path.join(storage_dir, INDEX_PATTERN))
+    return max(candidates, key=os.path.getmtime) if candidates else None
+
+
+def remove_stale_indexes(storage_dir: str, keep: str):
+    """Delete index files other than `keep`
+
+    Processes still mapping an older generation keep reading it until they
+    switch; where the platform refuses to delete a mapped file it is left
+    for a later call.
+    """
+    for path in glob.glob(os.path.join(storage_dir, INDEX_PATTERN)):
+        if os.path.abspath(path) != os.path.abspath(keep):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
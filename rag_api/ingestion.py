@@ -0,0 +1,326 @@
+"""
+Background ingestion of files copied into the data directory
+
+A watcher notices files being added, modified or deleted, through
+watchfiles (inotify on Linux) when it is installed and usable and by
+polling the directory otherwise. Changes are debounced: a file is picked
+up once its events have been quiet for `debounce` seconds, so a copy in
+progress is read once, when it is complete, and a burst of files is
+handled together. Settled changes then pass through three stages, each
+run by its own threads and fed by a bounded queue, so a large burst waits
+in the watcher instead of piling up in memory:
+
+    extraction  hash the file; skip it if unchanged, reuse cached chunks or extract its text
+    chunking    split freshly extracted text into chunks
+    indexing    apply every change that is ready as one new index generation
+
+The stage functions come from the server; this module moves changes
+between them, keeps at most one change per file in flight so a file's
+changes are applied in order, and records progress and lag for /metrics.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import metrics
+
+try:
+    import watchfiles
+except ImportError:  # Installed with uvicorn[standard]; polling works without it
+    watchfiles = None
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("extraction", "chunking", "indexing")
+# Lag includes the debounce delay and extraction, so it is measured in seconds to minutes
+LAG_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+QUEUE_POLL_SECONDS = 0.5  # How often blocked stage threads check for shutdown
+
+
+class FileChange:
+    """A settled change to one file, filled in as it moves through the stages"""
+
+    __slots__ = ("filename", "detected", "file_hash", "content", "chunks", "outcome", "error")
+
+    def __init__(self, filename: str, detected: float):
+        self.filename = filename
+        self.detected = detected  # time.monotonic() of its first event since the file was last handled
+        self.file_hash: Optional[str] = None  # None for a deleted file
+        self.content: Optional[str] = None  # Extracted text, until it is chunked
+        self.chunks = None  # Chunks to index; None for a file without text
+        # "indexed", "removed", "unchanged", "failed" (extraction failed) or "error" (a stage raised)
+        self.outcome: Optional[str] = None
+        self.error: Optional[str] = None  # Why extraction failed, for a "failed" outcome
+
+
+class IngestionPipeline:
+    """Watches a directory and feeds changed files through extraction, chunking and indexing
+
+    extract(change) sets the file hash and either the chunks, the text to
+    chunk, or an outcome of "unchanged" or "failed"; chunk(change) turns the
+    text into chunks; apply(changes) indexes a batch and sets each outcome.
+    """
+
+    def __init__(self, directory: str, extensions: Tuple[str, ...], extract: Callable[[FileChange], None],
+                 chunk: Callable[[FileChange], None], apply: Callable[[List[FileChange]], None],
+                 debounce: float = 1.0, max_delay: float = 10.0, poll_interval: float = 2.0,
+                 queue_size: int = 64, extraction_workers: int = 2, batch_size: int = 256):
+        self.directory = directory
+        self.extensions = extensions
+        self.extract = extract
+        self.chunk = chunk
+        self.apply = apply
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.extraction_workers = extraction_workers
+        self.batch_size = batch_size
+        self.backend: Optional[str] = None  # "watchfiles" or "polling" once started
+
+        self._queues = {stage: queue.Queue(queue_size) for stage in STAGES}
+        self._pending: Dict[str, float] = {}  # Filename -> first event time, waiting to settle
+        self._last_event = 0.0
+        self._in_flight: Dict[str, float] = {}  # Filename -> detection time, from dispatch until handled
+        self._active: Dict[str, int] = defaultdict(int)  # Changes each stage is working on
+        self._events = 0
+        self._outcomes: Dict[str, int] = defaultdict(int)
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+        self.stage_seconds = metrics.Histogram(
+            "rag_ingest_stage_seconds", "Time per file in each ingestion stage (per batch for indexing)", ["stage"])
+        self.lag_seconds = metrics.Histogram(
+            "rag_ingest_lag_seconds", "Time from a file's first change event until the change is searchable",
+            buckets=LAG_BUCKETS)
+
+    def start(self):
+        """Start watching and the stage threads"""
+        os.makedirs(self.directory, exist_ok=True)
+        targets = [("watch", self._watch), ("dispatch", self._dispatch), ("chunking", self._chunk_worker),
+                   ("indexing", self._index_worker)]
+        targets += [(f"extraction-{number}", self._extract_worker) for number in range(self.extraction_workers)]
+        for name, target in targets:
+            thread = threading.Thread(target=target, name=f"ingest-{name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 2.0):
+        """Stop the threads, waiting up to `timeout` seconds for them to exit"""
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def note(self, filenames: Iterable[str]):
+        """Record change events for files in the directory"""
+        now = time.monotonic()
+        with self._condition:
+            for filename in filenames:
+                self._events += 1
+                self._pending.setdefault(filename, now)
+            self._last_event = now
+            self._condition.notify_all()
+
+    # Watching
+
+    def _watched(self, _change, path: str) -> bool:
+        return path.endswith(self.extensions) and os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.directory)
+
+    def _watch(self):
+        """Feed events to the debouncer from watchfiles, or by polling if it cannot be used"""
+        if watchfiles is not None:
+            try:
+                self.backend = "watchfiles"
+                # watchfiles only groups raw events here; settling is left to the dispatcher
+                for changes in watchfiles.watch(self.directory, watch_filter=self._watched, debounce=200, step=50,
+                                                stop_event=self._stop, recursive=False, raise_interrupt=False):
+                    self.note(os.path.basename(path) for _, path in changes)
+                return
+            except Exception as e:
+                logger.warning(f"Cannot watch {self.directory} for changes ({e}), polling it instead")
+        self.backend = "polling"
+        self._poll()
+
+    def _poll(self):
+        seen = self._scan()
+        while not self._stop.wait(self.poll_interval):
+            current = self._scan()
+            changed = [filename for filename in seen.keys() | current.keys() if seen.get(filename) != current.get(filename)]
+            if changed:
+                self.note(changed)
+            seen = current
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        """(size, mtime) of every watched file"""
+        stats = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(self.extensions) and entry.is_file():
+                        stat = entry.stat()
+                        stats[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        except OSError as e:
+            logger.error(f"Error scanning {self.directory}: {e}")
+        return stats
+
+    # Stages
+
+    def _settled(self, now: float) -> Tuple[List[str], float]:
+        """(files ready to dispatch, seconds until more may be); caller holds the condition"""
+        if not self._pending:
+            return [], QUEUE_POLL_SECONDS
+        quiet_for = now - self._last_event
+        waited = now - min(self._pending.values())
+        if quiet_for < self.debounce and waited < self.max_delay:
+            return [], min(self.debounce - quiet_for, self.max_delay - waited)
+        # A file still in flight waits for that change to finish, which notifies the condition
+        return [filename for filename in self._pending if filename not in self._in_flight], QUEUE_POLL_SECONDS
+
+    def _dispatch(self):
+        """Pass settled files on to extraction, one change per file at a time"""
+        while not self._stop.is_set():
+            with self._condition:
+                ready, wait = self._settled(time.monotonic())
+                if not ready:
+                    self._condition.wait(wait)
+                    continue
+                changes = []
+                for filename in ready:
+                    detected = self._pending.pop(filename)
+                    self._in_flight[filename] = detected
+                    changes.append(FileChange(filename, detected))
+            for change in changes:
+                self._put("extraction", change)
+
+    def _put(self, stage: str, change: FileChange):
+        """Queue a change for a stage, waiting while the stage is full"""
+        while not self._stop.is_set():
+            try:
+                self._queues[stage].put(change, timeout=QUEUE_POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def _take(self, stage: str) -> Optional[FileChange]:
+        """Next change for a stage, or None once the pipeline is stopping"""
+        while not self._stop.is_set():
+            try:
+                change = self._queues[stage].get(timeout=QUEUE_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            with self._condition:
+                self._active[stage] += 1
+            return change
+        return None
+
+    def _run_stage(self, stage: str, function: Callable, change: FileChange) -> bool:
+        started = time.perf_counter()
+        try:
+            function(change)
+        except Exception as e:
+            logger.error(f"Error in ingestion {stage} of {change.filename}: {e}")
+            self._finish(change, "error")
+            return False
+        finally:
+            self.stage_seconds.observe(time.perf_counter() - started, stage)
+            with self._condition:
+                self._active[stage] -= 1
+        return True
+
+    def _extract_worker(self):
+        while True:
+            change = self._take("extraction")
+            if change is None:
+                return
+            if not self._run_stage("extraction", self.extract, change):
+                continue
+            if change.outcome == "unchanged":
+                self._finish(change, change.outcome)
+            else:
+                self._put("chunking" if change.content is not None else "indexing", change)
+
+    def _chunk_worker(self):
+        while True:
+            change = self._take("chunking")
+            if change is None:
+                return
+            if self._run_stage("chunking", self.chunk, change):
+                self._put("indexing", change)
+
+    def _index_worker(self):
+        """Apply every change that is ready, so a burst becomes one index generation"""
+        while True:
+            change = self._take("indexing")
+            if change is None:
+                return
+            batch = [change]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queues["indexing"].get_nowait())
+                except queue.Empty:
+                    break
+            with self._condition:
+                self._active["indexing"] += len(batch) - 1
+
+            started = time.perf_counter()
+            try:
+                self.apply(batch)
+            except Exception as e:
+                logger.error(f"Error indexing {len(batch)} changed files: {e}")
+                for change in batch:
+                    change.outcome = "error"
+            self.stage_seconds.observe(time.perf_counter() - started, "indexing")
+            with self._condition:
+                self._active["indexing"] -= len(batch)
+            for change in batch:
+                self._finish(change, change.outcome or "error")
+            logger.info(f"Ingested {len(batch)} changed files from {self.directory}")
+
+    def _finish(self, change: FileChange, outcome: str):
+        if outcome in ("indexed", "removed", "failed"):
+            self.lag_seconds.observe(time.monotonic() - change.detected)
+        with self._condition:
+            self._outcomes[outcome] += 1
+            self._in_flight.pop(change.filename, None)
+            self._condition.notify_all()
+
+    # Reporting
+
+    def stats(self) -> Dict[str, object]:
+        now = time.monotonic()
+        with self._condition:
+            waiting = list(self._pending.values()) + list(self._in_flight.values())
+            return {
+                "backend": self.backend,
+                "events": self._events,
+                "pending": {"debounce": len(self._pending),
+                            **{stage: self._queues[stage].qsize() + self._active[stage] for stage in STAGES}},
+                "oldest_change_seconds": round(now - min(waiting), 3) if waiting else 0.0,
+                "files": dict(self._outcomes),
+            }
+
+    def render_metrics(self) -> List[str]:
+        """Exposition lines for /metrics"""
+        stats = self.stats()
+        return (
+            metrics.gauge("rag_ingest_watching", "Whether the data directory is watched, by backend",
+                          [({"backend": stats["backend"] or "off"}, 1)]) +
+            metrics.gauge("rag_ingest_events_total", "File change events seen in the data directory",
+                          [({}, stats["events"])], "counter") +
+            metrics.gauge("rag_ingest_files_total", "Settled file changes handled, by outcome",
+                          [({"outcome": outcome}, count) for outcome, count in sorted(stats["files"].items())],
+                          "counter") +
+            metrics.gauge("rag_ingest_pending_files", "Changed files waiting in or passing through each stage",
+                          [({"stage": stage}, count) for stage, count in stats["pending"].items()]) +
+            metrics.gauge("rag_ingest_oldest_change_seconds", "Age of the oldest change not yet searchable",
+                          [({}, stats["oldest_change_seconds"])]) +
+            self.stage_seconds.render() + self.lag_seconds.render()
+        )
@@ -1,33 +1,45 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks
+from fastapi import FastAPI, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Optional, Dict, Any, Tuple, Iterator, Union, Literal, NamedTuple
 import os
 from dotenv import load_dotenv
 import uvicorn
 import logging
 import json
 import re
-from pathlib import Path
-import PyPDF2
-import io
 from datetime import datetime
-import zipfile
 import tempfile
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 import asyncio
 from collections import defaultdict
 import hashlib
+import base64
+import heapq
+from itertools import accumulate, islice
+from bisect import bisect_left
 import time
-from functools import lru_cache
 import threading
 
+from search_index import (MIN_TERM_LENGTH, ChunkedText, SearchIndex, pair_distance, phrase_starts, term_offsets,
+                          top_k as top_k_chunks)
+import index_store
+from index_store import cached_file_sha256, file_sha256
+from document_extraction import ExtractionCache, extract_documents, timed_extract_document
+from document_catalog import DocumentCatalog, DocumentEntry
+from document_filters import DocumentFilter
+from dense_index import DenseIndex, load_embedder, reciprocal_rank_fusion
+from result_cache import ResultCache
+from snippets import make_snippet
+from reports import encode_blocks, generate_pdf_report, json_report, text_report
+from executors import BoundedQueue, JobTracker, QueueFullError
+from ingestion import FileChange, IngestionPipeline
+import metrics
+from metrics import StageTimer
+from fastapi.concurrency import run_in_threadpool
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
 # Load environment variables
 load_dotenv()
 
@@ -57,8 +69,27 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # Pydantic models for request/response
 class QueryRequest(BaseModel):
     query: str
-    top_k: Optional[int] = 3
-    document_filter: Optional[str] = None
+    top_k: int = Field(3, ge=1)  # Results to return; sizes the ranking shortlist, so it must be positive
+    # A filename or list of filenames; names with * ? [ are glob patterns
+    document_filter: Optional[Union[str, List[str]]] = None
+    file_types: Optional[List[str]] = None
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+    # "dense" and "hybrid" (keyword and dense rankings fused) need DENSE_RETRIEVAL=1
+    retrieval: Literal["keyword", "dense", "hybrid"] = "keyword"
+    # "compact" answers with query-focused snippets instead of whole chunks
+    response_mode: Literal["full", "compact"] = "full"
+    # With paginate, results come top_k at a time; pass a response's next_cursor for the next page
+    paginate: bool = False
+    cursor: Optional[str] = None
+
+class SearchHit(BaseModel):
+    chunk_id: int
+    filename: str
+    chunk_index: int  # Full text at /documents/{filename}/chunks/{chunk_index}
+    score: float
+    snippet: str
+    highlights: List[Tuple[int, int]]  # [start, end) character offsets of query matches in the snippet
 
 class QueryResponse(BaseModel):
     answer: str
@@ -67,6 +98,16 @@ class QueryResponse(BaseModel):
     query_time: float
     total_documents_searched: int
     document_specific_answers: Dict[str, str]
+    results: List[SearchHit] = []
+    next_cursor: Optional[str] = None  # Set on paginated responses with more results to come
+
+class BatchQueryRequest(BaseModel):
+    queries: List[QueryRequest]
+
+class BatchQueryResponse(BaseModel):
+    results: List[QueryResponse]
+    cache_hits: int
+    total_time: float
 
 class DocumentUploadResponse(BaseModel):
     message: str
@@ -74,6 +115,9 @@ class DocumentUploadResponse(BaseModel):
     filename: str
     file_size_mb: float
     supported_formats: List[str]
+    status: str
+    sha256: str
+    job_id: Optional[str] = None
 
 class SystemInfoResponse(BaseModel):
     status: str
@@ -94,174 +138,740 @@ class DownloadRequest(BaseModel):
     include_metadata: bool = True
 
 # Global variables for the optimized RAG system
-documents_data = {}
-document_chunks = {}
-chunk_index = defaultdict(list)
 index_initialized = False
 system_start_time = datetime.now()
 query_history = []
-query_cache = {}
-cache_lock = threading.Lock()
+index_lock = threading.Lock()  # Serializes swapping snapshots in; searches never take it
 
 # Performance settings
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
 CACHE_SIZE = 1000
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
 MAX_CACHE_AGE = 3600  # 1 hour
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "100"))  # Rendered downloads kept
+REPORT_CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+REPORT_BLOCK_SIZE = 64 * 1024  # Characters per write of a streamed TXT or JSON download
+PAGINATION_DEPTH = int(os.getenv("PAGINATION_DEPTH", "100"))  # Ranked hits kept for paging through a query
+CANDIDATE_CACHE_SIZE = int(os.getenv("CANDIDATE_CACHE_SIZE", "200"))
+CANDIDATE_CACHE_MAX_BYTES = int(os.getenv("CANDIDATE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+STORAGE_DIR = "storage"
+SUPPORTED_EXTENSIONS = ('.txt', '.pdf', '.md', '.docx')
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", str(os.cpu_count() or 1)))
+EXTRACTION_TIMEOUT = float(os.getenv("EXTRACTION_TIMEOUT", "120"))  # Seconds per PDF task
+EXTRACTION_CACHE_DIR = os.path.join(STORAGE_DIR, "extracted")
+FILE_STATS_PATH = os.path.join(STORAGE_DIR, "file_hashes.json")
 
-def extract_text_from_pdf(file_path: str) -> str:
-    """Extract text from PDF file with error handling"""
-    try:
-        with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page in pdf_reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-            return text.strip()
-    except Exception as e:
-        logger.error(f"Error extracting text from PDF {file_path}: {e}")
-        return ""
+# Ranking settings
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+RERANK_DEPTH = 5  # Candidates per requested result that get phrase bonuses
+EXACT_PHRASE_BONUS = 5.0
+WORD_PAIR_BONUS = 2.0
+PROXIMITY_WINDOW = 5  # A query word pair this many tokens out of place still earns a reduced bonus
+PHRASE_PATTERN = re.compile(r'"([^"]+)"')  # Quoted phrases must match exactly
+# word* matches terms starting with word, word~ (or word~1, word~2) terms within a few edits
+QUERY_TERM_PATTERN = re.compile(r'\b(\w+)\b(\*|~(\d)?)?')
+MAX_TERM_EXPANSIONS = int(os.getenv("MAX_TERM_EXPANSIONS", "20"))  # Indexed terms scored per query word
+MAX_EDITS = 2
+FUZZY_PREFIX_LENGTH = int(os.getenv("FUZZY_PREFIX_LENGTH", "1"))  # Leading characters a typo match must share
+MAX_BATCH_QUERIES = int(os.getenv("MAX_BATCH_QUERIES", "100"))
+SNIPPET_TOKENS = int(os.getenv("SNIPPET_TOKENS", "30"))  # Words in a result snippet
 
-def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
-    """Split text into overlapping chunks for better search"""
+# Execution settings: CPU-bound work runs off the event loop in bounded queues
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "4"))
+SEARCH_QUEUE_SIZE = int(os.getenv("SEARCH_QUEUE_SIZE", "64"))  # Queued plus running searches
+PROCESS_WORKERS = int(os.getenv("PROCESS_WORKERS", "2"))  # Report rendering and single-file extraction
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", "8"))
+INDEXING_QUEUE_SIZE = int(os.getenv("INDEXING_QUEUE_SIZE", "16"))
+
+# Ingestion settings: files copied into data/ are indexed in the background
+WATCH_DATA_DIR = os.getenv("WATCH_DATA_DIR", "1").lower() in ("1", "true", "yes")
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", "1.0"))  # Seconds a file must be quiet before it is read
+WATCH_MAX_DELAY = float(os.getenv("WATCH_MAX_DELAY", "10"))  # Longest a continuous burst holds changes back
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", "2.0"))  # Used when inotify is unavailable
+WATCH_TAKEOVER_INTERVAL = float(os.getenv("WATCH_TAKEOVER_INTERVAL", "5"))  # How often idle workers check on the watcher
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "64"))  # Files waiting per ingestion stage
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))  # Most files published as one generation
+
+# Dense retrieval settings; embeddings are computed while indexing, so this is off by default
+DENSE_RETRIEVAL = os.getenv("DENSE_RETRIEVAL", "").lower() in ("1", "true", "yes")
+EMBEDDER = os.getenv("EMBEDDER", "hashing")  # "hashing", "hashing:<dim>" or "module:factory"
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "int8")  # int8, float16 or float32
+DENSE_MIN_SIMILARITY = float(os.getenv("DENSE_MIN_SIMILARITY", "0.1"))  # Weaker dense hits count as no match
+
+# Upload settings
+MAX_UPLOAD_MB = float(os.getenv("MAX_UPLOAD_MB", "100"))
+UPLOAD_BLOCK_SIZE = 1024 * 1024  # Bytes copied to disk per read
+
+embedder = load_embedder(EMBEDDER) if DENSE_RETRIEVAL else None
+
+def new_index() -> SearchIndex:
+    """An empty index with the configured BM25 settings, embedding chunks if dense retrieval is on"""
+    index = SearchIndex(k1=BM25_K1, b=BM25_B)
+    if embedder is not None:
+        index.dense = DenseIndex(embedder, EMBEDDING_DTYPE)
+    return index
+
+class IndexSnapshot(NamedTuple):
+    """An index generation as searches see it; nothing modifies it once it is published
+    
+    A search pins the snapshot that is current when it starts and runs to
+    the end on it. Writers edit a private copy into the next generation and
+    publish() it with one reference swap, so searches never see a partly
+    updated index and never wait for an update.
+    """
+    index: SearchIndex
+    document_hashes: Dict[str, str]  # Every supported file in data/ -> content SHA-256
+    generation: int  # Generation of storage/CURRENT the index was loaded from
+    stamp: Optional[tuple]  # index_store.generation_stamp() when that generation was loaded
+    path: Optional[str]  # Index file the snapshot maps; None if it could not be saved
+    catalog: DocumentCatalog  # Figures for each file in document_hashes
+    memory: Dict[str, int]  # index.memory_usage() when the snapshot was made
+
+snapshot = IndexSnapshot(new_index(), {}, 0, None, None, DocumentCatalog(), {"heap": 0, "mapped": 0})
+extraction_cache = ExtractionCache(EXTRACTION_CACHE_DIR, CHUNK_SIZE, CHUNK_OVERLAP)
+query_cache = ResultCache(max_entries=CACHE_SIZE, max_bytes=CACHE_MAX_BYTES, ttl=MAX_CACHE_AGE)
+# Rendered /download-answer files as lists of byte blocks, tagged like the answers they were made from
+report_cache = ResultCache(max_entries=REPORT_CACHE_SIZE, max_bytes=REPORT_CACHE_MAX_BYTES, ttl=MAX_CACHE_AGE)
+# Ranked hits of paginated queries per index generation, which later pages are sliced from
+candidate_cache = ResultCache(max_entries=CANDIDATE_CACHE_SIZE, max_bytes=CANDIDATE_CACHE_MAX_BYTES,
+                              ttl=MAX_CACHE_AGE)
+
+# Processes are only started on first use, so importing the module stays cheap
+process_pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS)
+search_queue = BoundedQueue("search", ThreadPoolExecutor(SEARCH_WORKERS, thread_name_prefix="search"),
+                            SEARCH_QUEUE_SIZE)
+render_queue = BoundedQueue("render", process_pool, RENDER_QUEUE_SIZE)
+# A single indexing thread applies uploads, deletes and rebuilds one at a time
+indexing_queue = BoundedQueue("indexing", ThreadPoolExecutor(1, thread_name_prefix="indexing"),
+                              INDEXING_QUEUE_SIZE)
+indexing_jobs = JobTracker()
+# Uploads and deletes waiting to be applied, with the futures their jobs wait on
+queued_writes: List[Tuple[FileChange, bool, Future]] = []
+queued_writes_lock = threading.Lock()
+
+# Prometheus metrics served by /metrics
+QUERY_STAGE_SECONDS = metrics.Histogram("rag_query_stage_seconds",
+                                        "Time per search batch spent in each query stage", ["stage"])
+SEARCH_SECONDS = metrics.Histogram("rag_search_seconds", "Time to answer a search batch, cache misses only")
+SEARCHES = metrics.Counter("rag_searches_total", "Searches run against the index", ["retrieval"])
+INDEX_DOCUMENT_SECONDS = metrics.Histogram("rag_index_document_seconds",
+                                           "Time to swap one document's chunks into the index")
+EXTRACTION_PAGE_SECONDS = metrics.Histogram("rag_extraction_page_seconds", "PDF text extraction time per page")
+
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> ChunkedText:
+    """Split text into overlapping chunks for better search
+    
+    A chunk takes words until they reach chunk_size characters (counting a
+    space after each), and the next chunk starts `overlap` words before its
+    end. Chunks come back as offsets into one copy of the text with runs of
+    whitespace collapsed to single spaces, so each chunk reads as its words
+    joined by spaces.
+    """
     if len(text) <= chunk_size:
-        return [text]
+        return ChunkedText(text, [0], [len(text)])
     
-    chunks = []
     words = text.split()
-    current_chunk = []
-    current_length = 0
+    buffer = " ".join(words)
+    # Offset of each word in the buffer, and of one word past the last
+    word_starts = list(accumulate((len(word) + 1 for word in words), initial=0))
+    starts, ends = [], []
+    first = stop = 0
     
-    for i, word in enumerate(words):
-        current_chunk.append(word)
-        current_length += len(word) + 1
-        
-        if current_length >= chunk_size:
-            chunk_text = " ".join(current_chunk)
-            chunks.append(chunk_text)
-            
-            # Keep overlap words for next chunk
-            overlap_words = current_chunk[-overlap:] if overlap > 0 else []
-            current_chunk = overlap_words
-            current_length = sum(len(w) + 1 for w in overlap_words)
+    while True:
+        # A chunk ends with the first word that brings it to chunk_size, and always takes a new word
+        stop = bisect_left(word_starts, word_starts[first] + chunk_size, max(first, stop) + 1)
+        if stop > len(words):
+            break
+        starts.append(word_starts[first])
+        ends.append(word_starts[stop] - 1)
+        first = max(first, stop - overlap) if overlap > 0 else stop
     
-    # Add remaining text as final chunk
-    if current_chunk:
-        chunks.append(" ".join(current_chunk))
+    # Remaining words form the final chunk
+    if first < len(words):
+        starts.append(word_starts[first])
+        ends.append(len(buffer))
     
-    return chunks
+    return ChunkedText(buffer, starts, ends)
 
-def build_search_index():
-    """Build an optimized search index for fast retrieval"""
-    global document_chunks, chunk_index
-    
-    document_chunks = {}
-    chunk_index = defaultdict(list)
+def invalidate_cache(terms: Optional[set] = None, filename: Optional[str] = None):
+    """Drop cached answers a corpus change could affect (all of them if no terms are given)"""
+    if terms is None:
+        query_cache.clear()
+        report_cache.clear()
+        candidate_cache.clear()
+        return
     
-    for filename, content in documents_data.items():
-        chunks = chunk_text(content)
-        document_chunks[filename] = chunks
-        
-        # Index each chunk
-        for chunk_idx, chunk in enumerate(chunks):
-            chunk_id = f"{filename}_{chunk_idx}"
-            words = re.findall(r'\b\w+\b', chunk.lower())
-            
-            # Index by word
-            for word in words:
-                if len(word) > 2:  # Skip short words
-                    chunk_index[word].append(chunk_id)
-    
-    logger.info(f"Built search index with {len(chunk_index)} unique words")
+    tags = {f"term:{term}" for term in terms}
+    tags.update(f"prefix:{term[:length]}" for term in terms for length in range(MIN_TERM_LENGTH, len(term) + 1))
+    tags.update(("fuzzy", "dense"))
+    if filename is not None:
+        tags.add(f"doc:{filename}")
+    report_cache.invalidate(tags)
+    candidate_cache.invalidate(tags)
+    stale = query_cache.invalidate(tags)
+    if stale:
+        logger.info(f"Invalidated {stale} cached queries for {filename}")
+
+def cache_tags(index: SearchIndex, query: str, sources: List[str], retrieval: str = "keyword") -> set:
+    """Invalidation tags for a cached answer: its query terms and answering documents
+
+    A word that may have been expanded also depends on every term it is a
+    prefix of, and typo-tolerant matches on any term at all. Dense hits can
+    come from any document, so they depend on every change.
+    """
+    tags = {f"doc:{source}" for source in sources}
+    if retrieval != "keyword":
+        tags.add("dense")
+    for word, mode, _ in parse_query_terms(query):
+        tags.add(f"term:{word}")
+        known = mode == "exact" and index.document_frequency(word)
+        if not known:
+            tags.add(f"prefix:{word}")
+            tags.add("fuzzy")
+    return tags
 
-def get_cache_key(query: str, top_k: int, document_filter: str) -> str:
+def search_for(request: QueryRequest) -> Tuple[str, int, Optional[DocumentFilter], str]:
+    """(query, top_k, document filter, retrieval) for a query request"""
+    if request.retrieval != "keyword" and embedder is None:
+        raise HTTPException(status_code=400,
+                            detail=f"{request.retrieval} retrieval needs the server started with DENSE_RETRIEVAL=1")
+    document_filter = DocumentFilter.build(request.document_filter, request.file_types,
+                                           request.uploaded_after, request.uploaded_before)
+    return request.query, request.top_k, document_filter, request.retrieval
+
+def get_cache_key(query: str, top_k: int, document_filter: Optional[DocumentFilter],
+                  retrieval: str = "keyword") -> str:
     """Generate cache key for query"""
-    key_data = f"{query.lower().strip()}_{top_k}_{document_filter or 'all'}"
+    key_data = f"{query.lower().strip()}_{top_k}_{document_filter.key() if document_filter else 'all'}_{retrieval}"
     return hashlib.md5(key_data.encode()).hexdigest()
 
-@lru_cache(maxsize=CACHE_SIZE)
-def cached_search(query: str, top_k: int, document_filter: str) -> tuple:
-    """Cached search function for better performance"""
-    return perform_search(query, top_k, document_filter)
-
-def perform_search(query: str, top_k: int, document_filter: str) -> tuple:
+def perform_search(query: str, top_k: int, document_filter: Optional[DocumentFilter],
+                   retrieval: str = "keyword", index: Optional[SearchIndex] = None) -> tuple:
     """Perform optimized search with ranking"""
-    if not document_chunks:
-        return [], "No documents available", {}, 0
+    return perform_batch_search([(query, top_k, document_filter, retrieval)], index)[0]
+
+def perform_batch_search(searches: List[Tuple[str, int, Optional[DocumentFilter], str]],
+                         index: Optional[SearchIndex] = None) -> List[tuple]:
+    """Run several searches with one pass over the postings of their combined terms
     
+    Each search is (query, top_k, document_filter, retrieval); results come back in the
+    same order with the same shape as perform_search(). They run on `index`, by
+    default the one served when the batch starts.
+    """
     start_time = time.time()
-    query_lower = query.lower().strip()
-    query_words = [word for word in re.findall(r'\b\w+\b', query_lower) if len(word) > 2]
-    
-    if not query_words:
-        return [], "Please provide a more specific query.", {}, 0
-    
-    # Find relevant chunks
-    chunk_scores = defaultdict(float)
-    relevant_chunks = set()
-    
-    # Get chunks containing query words
-    for word in query_words:
-        if word in chunk_index:
-            for chunk_id in chunk_index[word]:
-                chunk_scores[chunk_id] += 1
-                relevant_chunks.add(chunk_id)
-    
-    # Filter by document if specified
-    if document_filter:
-        relevant_chunks = {chunk_id for chunk_id in relevant_chunks 
-                          if chunk_id.startswith(document_filter)}
-    
-    # Calculate final scores with bonuses
-    final_scores = []
-    for chunk_id in relevant_chunks:
-        score = chunk_scores[chunk_id]
-        
-        # Bonus for exact phrase matches
-        if query_lower in chunk_id:
-            score += 5
-        
-        # Bonus for consecutive word matches
-        for i in range(len(query_words) - 1):
-            phrase = f"{query_words[i]} {query_words[i+1]}"
-            if phrase in chunk_id:
-                score += 2
-        
-        # Get chunk content
-        filename, chunk_idx = chunk_id.rsplit('_', 1)
-        chunk_idx = int(chunk_idx)
+    timer = StageTimer()
+    ranked = rank_batch(searches, snapshot.index if index is None else index, timer)
+    answers = [build_answer(query, top_results, message, start_time)
+               for (query, *_), (top_results, message) in zip(searches, ranked)]
+    timer.mark("answer")
+    record_stages(searches, timer)
+    return answers
+
+def rank_batch(searches: List[Tuple[str, int, Optional[DocumentFilter], str]], index: SearchIndex,
+               timer: Optional[StageTimer] = None) -> List[Tuple[list, Optional[str]]]:
+    """Ranked (chunk id, score, content, filename, chunk index, positions) hits for each search
+    
+    A search without hits comes back as ([], message) with the message to
+    show instead of an answer.
+    """
+    timer = timer or StageTimer()
+    ranked = []
+    for (query, top_k, _, retrieval), (shortlist, message) in zip(searches, shortlist_batch(searches, index, timer)):
+        top_results = list(islice(iter_reranked(query, shortlist, retrieval == "keyword"), top_k))
+        if message is None and not top_results:
+            message = f"No relevant information found for '{query}' in the documents."
+        ranked.append((top_results, message))
+    timer.mark("rerank")
+    return ranked
+
+def record_stages(searches: List[Tuple[str, int, Optional[DocumentFilter], str]], timer: StageTimer):
+    """Add a finished search batch to the query metrics"""
+    for stage, seconds in timer.stages.items():
+        QUERY_STAGE_SECONDS.observe(seconds, stage)
+    SEARCH_SECONDS.observe(timer.elapsed)
+    for *_, retrieval in searches:
+        SEARCHES.inc(retrieval)
+
+def parse_query_terms(query: str) -> List[Tuple[str, str, int]]:
+    """(word, mode, max edits) for each searchable query word
+
+    Mode is "prefix" for word*, "fuzzy" for word~ and "exact" otherwise.
+    """
+    terms = []
+    for word, operator, edits in QUERY_TERM_PATTERN.findall(query.lower()):
+        if len(word) < MIN_TERM_LENGTH:
+            continue
+        if operator == "*":
+            terms.append((word, "prefix", 0))
+        elif operator:
+            terms.append((word, "fuzzy", min(int(edits), MAX_EDITS) if edits else auto_edits(word)))
+        else:
+            terms.append((word, "exact", auto_edits(word)))
+    return terms
+
+def auto_edits(word: str) -> int:
+    """Typos tolerated in a word of this length"""
+    return 1 if len(word) <= 5 else MAX_EDITS
+
+def expand_query_terms(index: SearchIndex, query: str) -> Dict[str, List[Tuple[str, float]]]:
+    """Indexed (term, weight) alternatives for each query word that is not matched as typed
+
+    word* and word~ always expand. A plain word the index does not contain
+    is completed as a prefix if any term starts with it, and otherwise
+    matched against terms within a few edits, so "optimiz" and "retreival"
+    still find something. Each word feeds at most MAX_TERM_EXPANSIONS terms
+    to the scorer.
+    """
+    expansions = {}
+    for word, mode, max_edits in parse_query_terms(query):
+        if word in expansions or (mode == "exact" and index.document_frequency(word)):
+            continue
+        alternatives = []
+        if mode != "fuzzy":
+            alternatives = [(term, 1.0) for term in index.prefix_terms(word, MAX_TERM_EXPANSIONS)]
+        if mode == "fuzzy" or (mode == "exact" and not alternatives):
+            alternatives = [(term, 1.0 / (1 + edits))
+                            for term, edits in index.fuzzy_terms(word, max_edits, MAX_TERM_EXPANSIONS,
+                                                                 FUZZY_PREFIX_LENGTH)]
+        expansions[word] = alternatives
+    return expansions
+
+def word_positions(index: SearchIndex, chunk_id: int, words: List[str],
+                   expansions: Dict[str, List[Tuple[str, float]]]) -> Dict[str, List[int]]:
+    """Token positions of each query word in a chunk, counting an expanded word wherever its terms occur"""
+    positions = index.chunk_positions(chunk_id, {word for word in words if word not in expansions})
+    for word, alternatives in expansions.items():
+        found = index.chunk_positions(chunk_id, [term for term, _ in alternatives])
+        if found:
+            positions[word] = sorted(set().union(*found.values()))
+    return positions
+
+def quoted_phrases(query: str) -> List[List[Tuple[str, int]]]:
+    """Term offsets of each "quoted phrase" in the query that contains an indexed word"""
+    phrases = [term_offsets(phrase) for phrase in PHRASE_PATTERN.findall(query)]
+    return [phrase for phrase in phrases if phrase]
+
+def shortlist_batch(searches: List[Tuple[str, int, Optional[DocumentFilter], str]], index: SearchIndex,
+                    timer: Optional[StageTimer] = None) -> List[Tuple[list, Optional[str]]]:
+    """(shortlist, message) per search; the shortlist is in descending score order
+    
+    Shortlist entries are (chunk id, score, filename, chunk index, content,
+    positions of each query word in the chunk). Keyword shortlists carry
+    BM25 scores and get phrase bonuses from the positions. Dense and hybrid
+    shortlists are already in final order (cosine similarity, or fused
+    reciprocal-rank score) and are not re-ranked; their positions only
+    place snippets. Time spent is charged to the timer's stages.
+    """
+    timer = timer or StageTimer()
+    if not index.chunk_count:
+        return [([], "No documents available") for _ in searches]
+    
+    query_words = [[word for word, _, _ in parse_query_terms(query)] for query, *_ in searches]
+    timer.mark("tokenize")
+    
+    # The index is a published snapshot that nothing modifies, so no lock is needed
+    expansions = [expand_query_terms(index, query) for query, *_ in searches]
+    phrases = [quoted_phrases(query) for query, *_ in searches]
+    timer.mark("tokenize")
+    # BM25 over the postings of every query word, each posting list read once per batch;
+    # filtered searches only score postings inside their documents' chunks
+    chunk_sets = [document_filter.chunk_set(index) if document_filter else None
+                  for _, _, document_filter, _ in searches]
+    timer.mark("filter")
+    scored = index.score_batch([words if retrieval != "dense" else []
+                                for words, (*_, retrieval) in zip(query_words, searches)], chunk_sets,
+                               phrases, expansions, timer.stages)
+    timer.mark()
+    shortlists = [[(chunk_id, score) + index.get_chunk(chunk_id) +
+                   (word_positions(index, chunk_id, words, expanded),)
+                   for chunk_id, score in top_k_chunks(chunk_ids, scores, top_k * RERANK_DEPTH)]
+                  if retrieval != "dense" else []
+                  for (chunk_ids, scores), (_, top_k, _, retrieval), words, expanded
+                  in zip(scored, searches, query_words, expansions)]
+    timer.mark("shortlist")
+    dense_shortlists = [dense_shortlist(index, query, top_k * RERANK_DEPTH, chunk_set, words, expanded)
+                        if retrieval != "keyword" else []
+                        for (query, top_k, _, retrieval), chunk_set, words, expanded
+                        in zip(searches, chunk_sets, query_words, expansions)]
+    if any(retrieval != "keyword" for *_, retrieval in searches):
+        timer.mark("dense")
+    
+    results = []
+    for (query, _, _, retrieval), words, shortlist, dense_hits in zip(searches, query_words, shortlists,
+                                                                      dense_shortlists):
+        if retrieval == "dense":
+            results.append((dense_hits, None))
+            continue
+        if retrieval == "hybrid":
+            shortlist = fuse_shortlists(query, shortlist, dense_hits)
+        results.append((shortlist, None if words or dense_hits else "Please provide a more specific query."))
+    timer.mark("rerank")
+    return results
+
+def dense_shortlist(index: SearchIndex, query: str, limit: int, chunk_set, words: List[str],
+                    expansions: Dict[str, List[Tuple[str, float]]]) -> list:
+    """Shortlist entries for the chunks closest to the query embedding"""
+    chunk_ids, scores = index.dense.search(query, chunk_set, DENSE_MIN_SIMILARITY)
+    return [(chunk_id, score) + index.get_chunk(chunk_id) + (word_positions(index, chunk_id, words, expansions),)
+            for chunk_id, score in top_k_chunks(chunk_ids, scores, limit)]
+
+def fuse_shortlists(query: str, keyword_shortlist: list, dense_shortlist: list) -> list:
+    """One shortlist from the phrase-reranked keyword hits and the dense hits, by reciprocal rank fusion"""
+    entries = {entry[0]: entry for entry in dense_shortlist + keyword_shortlist}
+    keyword_order = [hit[0] for hit in iter_reranked(query, keyword_shortlist)]
+    dense_order = [entry[0] for entry in dense_shortlist]
+    return [(chunk_id, score) + entries[chunk_id][2:]
+            for chunk_id, score in reciprocal_rank_fusion([keyword_order, dense_order])]
+
+def phrase_bonus(query_terms: List[Tuple[str, int]], positions: Dict[str, List[int]]) -> float:
+    """Bonus for the query words appearing in order, and for each query word pair appearing close together"""
+    bonus = 0.0
+    
+    # Bonus for exact phrase matches
+    if len(query_terms) > 1 and phrase_starts(query_terms, positions):
+        bonus += EXACT_PHRASE_BONUS
+    
+    # Bonus for consecutive word matches, decaying as the pair drifts apart
+    for (first, first_offset), (second, second_offset) in zip(query_terms, query_terms[1:]):
+        distance = pair_distance(positions.get(first), positions.get(second), second_offset - first_offset)
+        if distance is not None and distance <= PROXIMITY_WINDOW:
+            bonus += WORD_PAIR_BONUS / distance
+    
+    return bonus
+
+def iter_reranked(query: str, shortlist: list, rerank: bool = True) -> Iterator[tuple]:
+    """Re-rank a BM25 shortlist with phrase bonuses, yielding hits in final order
+    
+    Hits are (chunk id, score, content, filename, chunk index, positions).
+    Bonuses are bounded, so a hit is yielded as soon as no chunk further down
+    the shortlist can overtake it rather than after the whole list is scored.
+    With rerank=False the shortlist is already in final order and only
+    reshaped into hits.
+    """
+    if not rerank:
+        for chunk_id, score, filename, chunk_idx, chunk_content, positions in shortlist:
+            yield chunk_id, score, chunk_content, filename, chunk_idx, positions
+        return
+    
+    query_terms = term_offsets(query)
+    max_bonus = (EXACT_PHRASE_BONUS if len(query_terms) > 1 else 0) + WORD_PAIR_BONUS * max(len(query_terms) - 1, 0)
+    candidates = []  # Heap of (-final score, shortlist position, hit); ties keep BM25 order
+    
+    # Re-rank the shortlist with phrase bonuses from the query words' positions in each chunk
+    for position, (chunk_id, score, filename, chunk_idx, chunk_content, positions) in enumerate(shortlist):
+        score += phrase_bonus(query_terms, positions)
+        heapq.heappush(candidates, (-score, position, (chunk_id, score, chunk_content, filename, chunk_idx, positions)))
         
-        if filename in document_chunks and chunk_idx < len(document_chunks[filename]):
-            chunk_content = document_chunks[filename][chunk_idx]
-            final_scores.append((chunk_id, score, chunk_content, filename))
+        # Everything still unscored has at most its BM25 score plus every bonus
+        if position + 1 < len(shortlist):
+            ceiling = shortlist[position + 1][1] + max_bonus
+            while candidates and -candidates[0][0] >= ceiling:
+                yield heapq.heappop(candidates)[2]
     
-    # Sort by score and get top results
-    final_scores.sort(key=lambda x: x[1], reverse=True)
-    top_results = final_scores[:top_k]
+    while candidates:
+        yield heapq.heappop(candidates)[2]
+
+def build_answer(query: str, top_results: list, message: Optional[str], start_time: float) -> tuple:
+    """Assemble ranked hits into (sources, answer, document_specific_answers, query_time, results)
     
-    if not top_results:
-        return [], f"No relevant information found for '{query}' in the documents.", {}, 0
+    Every hit from a document goes into its document-specific answer, best
+    first; results carry each hit's snippet and highlights.
+    """
+    if message is not None:
+        return [], message, {}, 0, []
     
     # Build answer
     sources = []
     answer_parts = []
-    document_specific_answers = {}
+    document_parts = defaultdict(list)
+    results = []
     
-    for chunk_id, score, content, filename in top_results:
+    for chunk_id, score, content, filename, chunk_idx, positions in top_results:
         sources.append(filename)
         answer_parts.append(f"📄 **{filename}**\n{content}")
-        document_specific_answers[filename] = content
+        document_parts[filename].append(content)
+        results.append(hit_result(chunk_id, score, content, filename, chunk_idx, positions))
     
     answer = "\n\n---\n\n".join(answer_parts)
+    document_specific_answers = {filename: "\n\n".join(parts) for filename, parts in document_parts.items()}
     query_time = time.time() - start_time
     
-    return sources, answer, document_specific_answers, query_time
+    return sources, answer, document_specific_answers, query_time, results
+
+def hit_result(chunk_id: int, score: float, content: str, filename: str, chunk_idx: int,
+               positions: Dict[str, List[int]]) -> Dict[str, Any]:
+    """Response fields for one hit, with a snippet placed by the query words' positions in the chunk"""
+    snippet, highlights = make_snippet(content, [position for found in positions.values() for position in found],
+                                       SNIPPET_TOKENS)
+    return {
+        "chunk_id": chunk_id,
+        "filename": filename,
+        "chunk_index": chunk_idx,
+        "score": round(score, 4),
+        "snippet": snippet,
+        "highlights": highlights
+    }
+
+def compact_response(response: Dict[str, Any]) -> Dict[str, Any]:
+    """A response with snippets in place of whole chunks, for compact response mode"""
+    if not response["results"]:
+        return response
+    document_parts = defaultdict(list)
+    for hit in response["results"]:
+        document_parts[hit["filename"]].append(hit["snippet"])
+    return {
+        **response,
+        "answer": "\n\n---\n\n".join(f"📄 **{hit['filename']}**\n{hit['snippet']}" for hit in response["results"]),
+        "document_specific_answers": {filename: "\n\n".join(parts) for filename, parts in document_parts.items()}
+    }
+
+def shape_response(request: QueryRequest, response: Dict[str, Any]) -> QueryResponse:
+    return QueryResponse(**(compact_response(response) if request.response_mode == "compact" else response))
+
+def scan_data_files(data_dir: str) -> Dict[str, str]:
+    """Content hash of every supported file in the data directory
+
+    Files whose size and mtime match the last scan reuse their recorded
+    hash instead of being read again.
+    """
+    file_stats = index_store.load_file_stats(FILE_STATS_PATH)
+    file_hashes = {
+        filename: cached_file_sha256(os.path.join(data_dir, filename), file_stats)
+        for filename in sorted(os.listdir(data_dir))
+        if filename.endswith(SUPPORTED_EXTENSIONS) and os.path.isfile(os.path.join(data_dir, filename))
+    }
+    file_stats = {filename: stats for filename, stats in file_stats.items() if filename in file_hashes}
+    try:
+        index_store.save_file_stats(FILE_STATS_PATH, file_stats)
+    except OSError as e:
+        logger.error(f"Error saving file hashes: {e}")
+    return file_hashes
+
+def cached_chunks(file_hash: str) -> Tuple[bool, Optional[ChunkedText]]:
+    """(hit, chunks) from the extraction cache; chunks is None for files without text"""
+    entry = extraction_cache.get(file_hash)
+    if entry is None:
+        return False, None
+    if entry["text"] is None:
+        return True, None
+    return True, ChunkedText(entry["text"], entry["starts"], entry["ends"])
+
+def chunk_and_cache(file_hash: str, content: str) -> Optional[ChunkedText]:
+    """Chunk freshly extracted text and remember the chunks for this file content"""
+    chunks = chunk_text(content) if content else None
+    extraction_cache.put(file_hash, chunks)
+    return chunks
+
+def forget_file(index: SearchIndex, document_hashes: Dict[str, str], failures: Dict[str, Tuple[str, str]],
+                filename: str, file_hash: str, error: str) -> set:
+    """Drop a file whose extraction failed so the next load retries it, noting the failure for the catalog"""
+    document_hashes.pop(filename, None)
+    failures[filename] = (file_hash, error)
+    return index.remove_document(filename)
+
+def map_index(path: str, stamp: Optional[tuple] = None) -> Optional[IndexSnapshot]:
+    """Memory-map a stored index as a snapshot"""
+    try:
+        loaded = index_store.load_index(path)
+    except Exception as e:
+        logger.error(f"Error loading stored index {path}: {e}")
+        return None
+    
+    if loaded is None:
+        return None
+    index, manifest = loaded
+    if (index.k1, index.b) != (BM25_K1, BM25_B):
+        logger.info("Stored index was built with different BM25 settings, rebuilding")
+        return None
+    if embedder is None:
+        index.dense = None
+    elif index.dense is None or index.dense.embedder_name != embedder.name:
+        logger.info(f"Stored index has no {embedder.name} embeddings, rebuilding")
+        return None
+    else:
+        index.dense.embedder = embedder
+    catalog = DocumentCatalog.from_manifest(manifest["catalog"])
+    return IndexSnapshot(index, dict(manifest["files"]), manifest["generation"], stamp, path, catalog,
+                         index.memory_usage())
+
+def load_persisted_index() -> Optional[IndexSnapshot]:
+    """Map the published index generation, or the latest index file to catch up from"""
+    current = index_store.read_generation(STORAGE_DIR)
+    path = current[1] if current else index_store.find_latest_index(STORAGE_DIR)
+    if path is None:
+        return None
+    
+    loaded = map_index(path, index_store.generation_stamp(STORAGE_DIR))
+    if loaded is not None:
+        logger.info(f"Loaded stored index {path} with {loaded.index.document_count} documents")
+    return loaded
+
+def publish(next_snapshot: IndexSnapshot):
+    """Serve a finished snapshot; searches that pinned the previous one finish on it"""
+    global snapshot
+    with index_lock:
+        snapshot = next_snapshot
+
+def working_copy(current: IndexSnapshot) -> Tuple[SearchIndex, Dict[str, str]]:
+    """A private copy of a snapshot's index and file hashes for a writer to edit into the next generation
+
+    Mapping the snapshot's file again is cheap and shares its pages; edits
+    copy out only the parts they change. Without a file to map (the
+    snapshot could not be saved), its documents are indexed again from the
+    extraction cache, and any the cache no longer has are dropped so the
+    next load extracts them.
+    """
+    document_hashes = dict(current.document_hashes)
+    if current.path is not None:
+        loaded = map_index(current.path)
+        if loaded is not None:
+            return loaded.index, document_hashes
+    
+    index = new_index()
+    for filename, file_hash in list(document_hashes.items()):
+        hit, chunks = cached_chunks(file_hash)
+        if not hit:
+            del document_hashes[filename]
+        elif chunks is not None:
+            index.add_document(filename, chunks, upload_time(filename))
+    return index, document_hashes
 
-def load_documents():
-    """Load documents with optimized processing"""
-    global documents_data, index_initialized
+def index_is_stale() -> bool:
+    """Whether another process has published a generation since this one last looked"""
+    return index_store.generation_stamp(STORAGE_DIR) != snapshot.stamp
+
+def is_newer(generation: int) -> bool:
+    """Whether a stored generation is newer than the served snapshot
+    
+    A snapshot that could not be saved took the next generation number
+    without publishing it, so a stored generation with that number is
+    another process's index, written since.
+    """
+    return generation > snapshot.generation or (generation == snapshot.generation and snapshot.path is None)
+
+def sync_index():
+    """Switch to the published generation if another worker process wrote a newer one"""
+    global snapshot
+    
+    stamp = index_store.generation_stamp(STORAGE_DIR)
+    current = index_store.read_generation(STORAGE_DIR)
+    if current is None or not is_newer(current[0]):
+        with index_lock:
+            snapshot = snapshot._replace(stamp=stamp)
+        return
+    
+    # Mapped before the swap so searches keep running on the old generation meanwhile
+    loaded = map_index(current[1], stamp)
+    if loaded is None:
+        return
+    with index_lock:
+        if not is_newer(loaded.generation):
+            return
+        snapshot = loaded
+    invalidate_cache()
+    logger.info(f"Switched to index generation {loaded.generation} "
+                f"({loaded.index.document_count} documents)")
+
+def document_entry(index: SearchIndex, filename: str, file_hash: str, error: Optional[str] = None) -> DocumentEntry:
+    """Catalog entry for a file just indexed, found to have no text, or whose extraction failed with `error`"""
+    chunk_ids = index.doc_chunks.get(index.doc_ids.get(filename), ())
+    term_count, index_bytes = index.document_footprint(filename) or (0, 0)
+    try:
+        size = os.path.getsize(os.path.join("data", filename))
+    except OSError:
+        size = 0
+    status = "failed" if error is not None else "indexed" if chunk_ids else "empty"
+    return DocumentEntry(file_hash, size, upload_time(filename), len(chunk_ids), term_count, index_bytes,
+                         status, error)
+
+def update_catalog(base: DocumentCatalog, index: SearchIndex, document_hashes: Dict[str, str],
+                   failures: Dict[str, Tuple[str, str]]) -> DocumentCatalog:
+    """The catalog for an edited index: base entries for unchanged files, new ones for the rest
+    
+    Files in `failures` (filename to file hash and error) are listed as
+    failed. They are not in document_hashes, so the next load retries them;
+    until then, or until they are deleted, their failed entries are kept.
+    """
+    catalog = base.copy()
+    for filename in [filename for filename in catalog if filename not in document_hashes]:
+        if catalog.get(filename).status != "failed" or not os.path.exists(os.path.join("data", filename)):
+            catalog.remove(filename)
+    for filename, (file_hash, error) in failures.items():
+        catalog.put(filename, document_entry(index, filename, file_hash, error))
+    for filename, file_hash in document_hashes.items():
+        entry = catalog.get(filename)
+        if entry is None or entry.file_hash != file_hash or entry.status == "failed":
+            catalog.put(filename, document_entry(index, filename, file_hash))
+    return catalog
+
+def persist_index(index: SearchIndex, document_hashes: Dict[str, str], base: Optional[DocumentCatalog] = None,
+                  failures: Optional[Dict[str, Tuple[str, str]]] = None) -> IndexSnapshot:
+    """Save a finished index as the next generation, returning the snapshot to serve
+
+    Other worker processes pick the generation up before their next search.
+    The snapshot maps the saved file instead of holding the edited index, so
+    every process serves the same shared pages. An index that cannot be
+    saved is served from memory, still as the next generation so cursors
+    and cached reports for the previous one lapse, while other processes
+    keep the previous generation. The document catalog is carried over
+    from `base` (the served snapshot's by default), with `failures`
+    (filename to file hash and error) listed as failed. Caller holds the
+    storage lock.
+    """
+    catalog = update_catalog(snapshot.catalog if base is None else base, index, document_hashes, failures or {})
+    current = index_store.read_generation(STORAGE_DIR)
+    generation = max(snapshot.generation, current[0] if current else 0) + 1
+    if index.dense is not None and index.dense.train():
+        logger.info(f"Built {len(index.dense.centroids)} IVF lists over "
+                    f"{index.dense.trained_count} embeddings")
+    try:
+        path = index_store.save_index(index, STORAGE_DIR, document_hashes, generation, catalog.to_manifest())
+        index_store.publish_generation(STORAGE_DIR, path, generation)
+        index_store.remove_stale_indexes(STORAGE_DIR, keep=path)
+    except Exception as e:
+        logger.error(f"Error saving search index: {e}")
+        return IndexSnapshot(index, document_hashes, generation, snapshot.stamp, None, catalog,
+                             index.memory_usage())
+    
+    stamp = index_store.generation_stamp(STORAGE_DIR)
+    loaded = map_index(path, stamp)
+    if loaded is not None:
+        return loaded
+    return IndexSnapshot(index, document_hashes, generation, stamp, None, catalog, index.memory_usage())
+
+def upload_time(filename: str) -> float:
+    """When a file arrived in data/, as reported by /documents"""
+    try:
+        return os.path.getctime(os.path.join("data", filename))
+    except OSError:
+        return time.time()
+
+def index_file(index: SearchIndex, document_hashes: Dict[str, str], filename: str, file_hash: str,
+               chunks: Optional[ChunkedText]) -> Tuple[set, set]:
+    """Swap one file's chunks into a working index, returning (old terms, new terms)"""
+    started = time.perf_counter()
+    old_terms = index.remove_document(filename)
+    new_terms = set()
+    if chunks is not None:
+        new_terms = index.add_document(filename, chunks, upload_time(filename))
+    document_hashes[filename] = file_hash
+    INDEX_DOCUMENT_SECONDS.observe(time.perf_counter() - started)
+    return old_terms, new_terms
+
+def record_extraction(pages: int, seconds: float):
+    """Add a PDF page range's extraction time to the per-page metric"""
+    if pages:
+        EXTRACTION_PAGE_SECONDS.observe(seconds / pages, count=pages)
+
+def load_documents(use_stored_index: bool = True):
+    """Load documents with optimized processing
+    
+    The new generation is built on a private index while searches keep
+    running on the published snapshot, then swapped in at once.
+    """
+    global index_initialized
     
     try:
         data_dir = "data"
@@ -269,86 +879,306 @@ def load_documents():
             logger.info("No data directory found")
             return
         
-        documents_data = {}
-        for filename in os.listdir(data_dir):
-            file_path = os.path.join(data_dir, filename)
+        # Worker processes starting together queue here; the first one builds
+        # and publishes the index and the rest map it
+        with index_store.StorageLock(STORAGE_DIR):
+            file_hashes = scan_data_files(data_dir)
+            stored = load_persisted_index() if use_stored_index else None
+            if stored is not None:
+                index, document_hashes = stored.index, dict(stored.document_hashes)
+            else:
+                index, document_hashes = new_index(), {}
+            failures = {}
             
-            try:
-                if filename.endswith('.pdf'):
-                    content = extract_text_from_pdf(file_path)
-                    if content.strip():
-                        documents_data[filename] = content
-                        logger.info(f"Loaded PDF document: {filename}")
-                        
-                elif filename.endswith(('.txt', '.md')):
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                        documents_data[filename] = content
-                        logger.info(f"Loaded text document: {filename}")
-                        
-                elif filename.endswith('.docx'):
-                    logger.info(f"Skipping DOCX file (not supported yet): {filename}")
-                    
-            except Exception as e:
-                logger.error(f"Error loading {filename}: {e}")
+            # Only files that are new or whose content changed since the stored index get extracted
+            removed = [filename for filename in document_hashes if filename not in file_hashes]
+            changed = [filename for filename, file_hash in file_hashes.items()
+                       if document_hashes.get(filename) != file_hash]
+            
+            for filename in removed:
+                index.remove_document(filename)
+                del document_hashes[filename]
+            
+            # Content seen before comes from the extraction cache
+            to_extract = []
+            for filename in changed:
+                hit, chunks = cached_chunks(file_hashes[filename])
+                if hit:
+                    index_file(index, document_hashes, filename, file_hashes[filename], chunks)
+                else:
+                    to_extract.append(os.path.join(data_dir, filename))
+            
+            # PDFs are parsed in a process pool; each file is indexed as soon as it is extracted
+            for file_path, content in extract_documents(to_extract, EXTRACTION_WORKERS, EXTRACTION_TIMEOUT,
+                                                         record_extraction):
+                filename = os.path.basename(file_path)
+                file_hash = file_hashes[filename]
+                try:
+                    if content is None:
+                        forget_file(index, document_hashes, failures, filename, file_hash, "Text extraction failed")
+                    else:
+                        index_file(index, document_hashes, filename, file_hash, chunk_and_cache(file_hash, content))
+                except Exception as e:
+                    logger.error(f"Error loading {filename}: {e}")
+                    forget_file(index, document_hashes, failures, filename, file_hash, str(e))
+            
+            extraction_cache.prune(file_hashes.values())
+            
+            index.refresh_statistics()
+            # Every load retries the failed files, so `failures` lists all of them
+            if stored is None or document_hashes != stored.document_hashes or failures != stored.catalog.failures():
+                stored = persist_index(index, document_hashes, stored.catalog if stored is not None else None,
+                                       failures)
+            publish(stored)
         
-        # Build search index
-        build_search_index()
+        invalidate_cache()
         index_initialized = True
-        logger.info(f"Loaded {len(documents_data)} documents and built search index")
+        logger.info(f"Loaded {stored.index.document_count} documents "
+                    f"({len(to_extract)} extracted, {len(changed) - len(to_extract)} from cache, "
+                    f"{len(removed)} removed), "
+                    f"{stored.index.term_count} unique words")
         
     except Exception as e:
         logger.error(f"Error loading documents: {e}")
 
-def generate_pdf_report(query: str, answer: str, sources: List[str], metadata: Dict[str, Any]) -> bytes:
-    """Generate PDF report of the query and answer"""
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter)
-    styles = getSampleStyleSheet()
-    
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=16,
-        spaceAfter=20,
-        textColor=colors.darkblue
-    )
+def receive_upload(source, data_dir: str, max_bytes: int) -> Tuple[str, str, int]:
+    """Copy an upload into a temporary file in data_dir block by block
     
-    content_style = ParagraphStyle(
-        'CustomContent',
-        parent=styles['Normal'],
-        fontSize=11,
-        spaceAfter=12,
-        leftIndent=20
-    )
+    Returns (temporary path, SHA-256, size). The content is hashed while it
+    is written, and the copy stops as soon as it exceeds max_bytes.
+    """
+    fd, part_path = tempfile.mkstemp(dir=data_dir, suffix=".part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as buffer:
+            for block in iter(lambda: source.read(UPLOAD_BLOCK_SIZE), b''):
+                size += len(block)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413,
+                                        detail=f"File exceeds the {MAX_UPLOAD_MB:g} MB upload limit")
+                digest.update(block)
+                buffer.write(block)
+    except BaseException:
+        os.remove(part_path)
+        raise
+    return part_path, digest.hexdigest(), size
+
+def extract_change(change: FileChange):
+    """Ingestion extraction stage: hash a changed file, then take its chunks from the cache or extract its text"""
+    file_path = os.path.join("data", change.filename)
+    try:
+        change.file_hash = file_sha256(file_path)
+    except FileNotFoundError:
+        return  # Deleted
+    # A change another worker already indexed (its upload, say) is not extracted again
+    if index_is_stale():
+        sync_index()
+    if snapshot.document_hashes.get(change.filename) == change.file_hash:
+        change.outcome = "unchanged"
+        return
     
-    story = []
-    story.append(Paragraph("RAG System Query Report", title_style))
-    story.append(Spacer(1, 20))
-    story.append(Paragraph(f"<b>Query:</b> {query}", content_style))
-    story.append(Spacer(1, 15))
-    story.append(Paragraph("<b>Answer:</b>", content_style))
-    story.append(Paragraph(answer.replace('\n', '<br/>'), content_style))
-    story.append(Spacer(1, 15))
+    hit, change.chunks = cached_chunks(change.file_hash)
+    if hit:
+        return
+    future = process_pool.submit(timed_extract_document, file_path)
+    try:
+        change.content, pages, seconds = future.result(timeout=EXTRACTION_TIMEOUT)
+        record_extraction(pages, seconds)
+    except Exception as e:
+        logger.error(f"Error extracting {change.filename}: {e}")
+        change.error = str(e) or type(e).__name__
+    if change.content is None:
+        change.outcome = "failed"
+        change.error = change.error or "Text extraction failed"
+
+def chunk_change(change: FileChange):
+    """Ingestion chunking stage"""
+    change.chunks = chunk_and_cache(change.file_hash, change.content)
+    change.content = None
+
+def apply_changes(changes: List[FileChange]):
+    """Ingestion indexing stage: publish a batch of changed files as one generation
     
-    if sources:
-        story.append(Paragraph(f"<b>Sources:</b> {', '.join(sources)}", content_style))
-        story.append(Spacer(1, 15))
+    Runs on the indexing thread like uploads and deletes, which may already
+    have applied a change; those changes count as unchanged.
+    """
+    global index_initialized
     
-    if metadata:
-        story.append(Paragraph("<b>Metadata:</b>", content_style))
-        for key, value in metadata.items():
-            story.append(Paragraph(f"• {key}: {value}", content_style))
+    with index_store.StorageLock(STORAGE_DIR):
+        sync_index()
+        for change in changes:
+            # A deleted file is unchanged if it was not indexed, unless the catalog lists it as failed
+            if (change.outcome is None and snapshot.document_hashes.get(change.filename) == change.file_hash
+                    and (change.file_hash is not None or change.filename not in snapshot.catalog)):
+                change.outcome = "unchanged"
+        pending = [change for change in changes if change.outcome != "unchanged"]
+        if not pending:
+            return
+        
+        index, document_hashes = working_copy(snapshot)
+        failures = {}
+        changed_terms = []
+        for change in pending:
+            if change.outcome == "failed":
+                terms = forget_file(index, document_hashes, failures, change.filename, change.file_hash,
+                                    change.error)
+            elif change.file_hash is None:
+                terms = index.remove_document(change.filename)
+                document_hashes.pop(change.filename, None)
+                change.outcome = "removed"
+            else:
+                old_terms, new_terms = index_file(index, document_hashes, change.filename, change.file_hash,
+                                                  change.chunks)
+                terms = old_terms | new_terms
+                change.outcome = "indexed"
+            changed_terms.append((change.filename, terms))
+        index.refresh_statistics()
+        publish(persist_index(index, document_hashes, failures=failures))
+    
+    for filename, terms in changed_terms:
+        invalidate_cache(terms, filename)
+    index_initialized = True
+
+def queue_write(filename: str, remove: bool = False) -> Future:
+    """Queue indexing a file in data/ as it is now, or dropping it if it is gone or `remove` is set
+    
+    Run apply_queued_writes() on the indexing queue to apply it; the future
+    resolves to whether the file is indexed once the change is published.
+    """
+    write = Future()
+    with queued_writes_lock:
+        queued_writes.append((FileChange(filename, time.monotonic()), remove, write))
+    return write
+
+def apply_queued_writes(write: Future) -> bool:
+    """Indexing job for a queued upload or delete, returning whether the file is now indexed
     
-    doc.build(story)
-    buffer.seek(0)
-    return buffer.getvalue()
+    Writes queue up while the indexing thread is busy. The first of their
+    jobs to run takes every write queued by then and publishes them all as
+    one generation, so a burst of uploads rewrites the index file once
+    rather than once per file; the jobs of the writes it took find them
+    done and just report the result.
+    """
+    with queued_writes_lock:
+        batch = list(queued_writes)
+        queued_writes.clear()
+    
+    ready = []
+    for change, remove, future in batch:
+        try:
+            if not remove:
+                extract_change(change)
+            if change.content is not None:
+                chunk_change(change)
+            ready.append((change, future))
+        except Exception as e:
+            logger.error(f"Error extracting {change.filename}: {e}")
+            future.set_exception(e)
+    if ready:
+        try:
+            apply_changes([change for change, _ in ready])
+        except Exception as e:
+            for _, future in ready:
+                future.set_exception(e)
+        else:
+            for change, future in ready:
+                future.set_result(change.filename in snapshot.index)
+            logger.info(f"Indexed {len(ready)} uploaded or deleted files as generation {snapshot.generation}")
+    return write.result()
+
+def add_document(filename: str) -> bool:
+    """Index (or re-index) a single file from data/ without touching the rest of the corpus
+    
+    Only this file is extracted and chunked; its postings are swapped into a
+    copy of the served index, published as the next generation, and only the
+    cached answers its terms could affect are dropped. Writes other uploads
+    and deletes queued meanwhile go into the same generation. Runs on the
+    indexing thread like every index write; returns whether the file is
+    indexed (a file without text, or whose extraction failed, is not).
+    """
+    return apply_queued_writes(queue_write(filename))
+
+def remove_document(filename: str) -> bool:
+    """Drop a single document from the index, whether or not its file is still in data/
+    
+    Returns whether it was indexed. A file left in data/ is indexed again by
+    the next full load or the watcher's next look at it.
+    """
+    indexed = filename in snapshot.index
+    apply_queued_writes(queue_write(filename, remove=True))
+    return indexed
+
+def replace_document(filename: str) -> bool:
+    """Re-index a document whose file contents changed"""
+    return add_document(filename)
+
+def queue_changes(changes: List[FileChange]):
+    """Hand a batch to the indexing thread and wait for it, retrying while that queue is full"""
+    while True:
+        try:
+            return indexing_queue.submit(apply_changes, changes).result()
+        except QueueFullError:
+            time.sleep(1)
+
+ingestion = IngestionPipeline("data", SUPPORTED_EXTENSIONS, extract_change, chunk_change, queue_changes,
+                              debounce=WATCH_DEBOUNCE, max_delay=WATCH_MAX_DELAY,
+                              poll_interval=WATCH_POLL_INTERVAL, queue_size=INGEST_QUEUE_SIZE,
+                              extraction_workers=PROCESS_WORKERS, batch_size=INGEST_BATCH_SIZE)
+
+# Held by the one worker process running the ingestion pipeline
+watcher_lock = index_store.StorageLock(STORAGE_DIR, index_store.WATCHER_LOCK_FILE)
+watching = False
+stop_watching = threading.Event()
+
+def watch_data_dir() -> bool:
+    """Start the ingestion pipeline unless another worker process runs it; returns whether it started
+    
+    Every worker serves the same data/ and storage/, so a second watcher
+    would only extract and commit each change again, each commit a new
+    generation that empties every worker's caches.
+    """
+    global watching
+    
+    if not watcher_lock.acquire(blocking=False):
+        return False
+    watching = True
+    ingestion.start()
+    logger.info(f"Watching data/ from worker process {os.getpid()}")
+    return True
+
+def take_over_watching():
+    """In a worker that is not watching data/: start watching once the watching worker exits"""
+    while not stop_watching.wait(WATCH_TAKEOVER_INTERVAL):
+        if watch_data_dir():
+            # Changes made since the last watcher stopped raised no events here
+            sync_index()
+            current = snapshot
+            present = {filename for filename in os.listdir("data") if filename.endswith(SUPPORTED_EXTENSIONS)}
+            ingestion.note(present | set(current.document_hashes) | set(current.catalog.entries))
+            return
 
+@app.on_event("startup")
 def initialize_rag_system():
     """Initialize the optimized RAG system"""
     global index_initialized
     load_documents()
     index_initialized = True
+    if WATCH_DATA_DIR and not watch_data_dir():
+        threading.Thread(target=take_over_watching, name="watch-takeover", daemon=True).start()
+
+@app.on_event("shutdown")
+def shutdown_executors():
+    """Stop the ingestion pipeline and the worker pools without waiting for abandoned work"""
+    global watching
+    
+    stop_watching.set()
+    ingestion.stop()
+    if watching:
+        watching = False
+        watcher_lock.release()
+    for queue in (search_queue, render_queue, indexing_queue):
+        queue.executor.shutdown(wait=False, cancel_futures=True)
 
 @app.get("/")
 async def root():
@@ -357,25 +1187,21 @@ async def root():
 
 @app.get("/health", response_model=SystemInfoResponse)
 async def health_check():
-    """Enhanced health check endpoint"""
-    data_dir = "data"
-    total_documents = 0
-    if os.path.exists(data_dir):
-        total_documents = len([f for f in os.listdir(data_dir) 
-                             if f.endswith(('.txt', '.pdf', '.md', '.docx'))])
-    
+    """Enhanced health check endpoint, answered from the served snapshot without touching data/"""
+    current = snapshot
     uptime = datetime.now() - system_start_time
     uptime_str = f"{uptime.days}d {uptime.seconds // 3600}h {(uptime.seconds % 3600) // 60}m"
     
-    memory_usage = f"{len(documents_data)} documents, {len(chunk_index)} indexed words"
+    index = current.index
+    memory_usage = f"{index.document_count} documents, {index.term_count} indexed words"
     
     return SystemInfoResponse(
         status="healthy",
         rag_system_initialized=index_initialized,
         openai_configured=True,
         documents_loaded=index_initialized,
-        total_documents=total_documents,
-        index_size_mb=0.0,
+        total_documents=len(current.catalog),
+        index_size_mb=round(sum(current.memory.values()) / (1024 * 1024), 2),
         system_uptime=uptime_str,
         memory_usage=memory_usage,
         supported_formats=[".txt", ".pdf", ".md", ".docx"],
@@ -392,138 +1218,412 @@ async def health_check():
         ]
     )
 
-@app.post("/query", response_model=QueryResponse)
-async def query_rag_system(request: QueryRequest):
-    """Optimized query the RAG system with caching"""
-    global documents_data, index_initialized, query_history
+def record_query(request: QueryRequest, cache_key: str, result: tuple, index: SearchIndex) -> Dict[str, Any]:
+    """Cache a fresh search result, add it to the query history and return the response fields
+    
+    `index` is the one the search ran on. If a newer snapshot was published
+    meanwhile, the result is returned but not cached, as the invalidation
+    that came with the swap may already have happened.
+    """
+    global query_history
+    sources, answer, document_specific_answers, query_time, results = result
+    
+    # Store in cache; the full response serves both response modes
+    response = {
+        'answer': answer,
+        'sources': sources,
+        'confidence': 0.9,
+        'query_time': query_time,
+        'total_documents_searched': index.document_count,
+        'document_specific_answers': document_specific_answers,
+        'results': results
+    }
+    if index is snapshot.index:
+        query_cache.put(cache_key, response, tags=cache_tags(index, request.query, sources, request.retrieval))
     
+    # Store query in history
+    query_history.append({
+        "query": request.query,
+        "timestamp": datetime.now().isoformat(),
+        "sources": sources,
+        "query_time": query_time
+    })
+    
+    # Keep only last 100 queries
+    if len(query_history) > 100:
+        query_history = query_history[-100:]
+    
+    return response
+
+async def ensure_index_loaded():
+    """Load the index on first use and fail if there is nothing to search"""
     if not index_initialized:
-        load_documents()
+        await indexing_queue.run(load_documents)
+    elif index_is_stale():
+        await search_queue.run(sync_index)
     
-    if not documents_data:
+    if not snapshot.index.document_count:
         raise HTTPException(status_code=500, detail="No documents available. Please upload documents first.")
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def ndjson_event(event: str, data: Dict[str, Any]) -> str:
+    return json.dumps({"event": event, **data}) + "\n"
+
+STREAM_FORMATS = {
+    "sse": (sse_event, "text/event-stream"),
+    "ndjson": (ndjson_event, "application/x-ndjson"),
+}
+
+async def stream_query(request: QueryRequest, stream_format: str) -> StreamingResponse:
+    """Send ranked chunks one event at a time instead of one assembled answer
     
-    try:
-        # Check cache first
-        cache_key = get_cache_key(request.query, request.top_k, request.document_filter)
+    Events are "meta" (sent at once), one "chunk" per hit as soon as its rank
+    is settled, and "done" with the sources and timing. The full answer is
+    still built and cached afterwards so a later plain /query is a cache hit.
+    """
+    start_time = time.time()
+    search = search_for(request)
+    cache_key = get_cache_key(*search)
+    index = snapshot.index
+    encode, media_type = STREAM_FORMATS[stream_format]
+    loop = asyncio.get_running_loop()
+    hits = asyncio.Queue()
+    
+    def rank_into_queue():
+        """Runs in the search pool, handing each hit to the event loop once its rank is settled"""
+        message = None
+        try:
+            timer = StageTimer()
+            (shortlist, message), = shortlist_batch([search], index, timer)
+            sent = 0
+            for hit in islice(iter_reranked(request.query, shortlist, search[3] == "keyword"), request.top_k):
+                loop.call_soon_threadsafe(hits.put_nowait, ("chunk", hit))
+                sent += 1
+            if message is None and not sent:
+                message = f"No relevant information found for '{request.query}' in the documents."
+            timer.mark("rerank")
+            record_stages([search], timer)
+            loop.call_soon_threadsafe(hits.put_nowait, ("end", message))
+        except Exception as e:
+            logger.error(f"Error streaming query: {e}")
+            loop.call_soon_threadsafe(hits.put_nowait, ("error", str(e)))
+    
+    # Submitted before the response starts, so a full queue is still a plain 503
+    search_queue.submit(rank_into_queue)
+    
+    async def events():
+        yield encode("meta", {"query": request.query, "total_documents_searched": index.document_count})
+        top_results = []
+        kind = None
+        while kind != "end":
+            # Hits that arrived together go out in one write
+            pending = [await hits.get()]
+            while not hits.empty():
+                pending.append(hits.get_nowait())
+            
+            events_text = []
+            for kind, item in pending:
+                if kind == "error":
+                    yield "".join(events_text) + encode("error", {"detail": f"Error processing query: {item}"})
+                    return
+                if kind == "chunk":
+                    top_results.append(item)
+                    hit = hit_result(*item)
+                    if request.response_mode == "full":
+                        hit["content"] = item[2]
+                    events_text.append(encode("chunk", {"rank": len(top_results), **hit}))
+            if events_text:
+                yield "".join(events_text)
         
-        with cache_lock:
-            if cache_key in query_cache:
-                cached_result = query_cache[cache_key]
-                if time.time() - cached_result['timestamp'] < MAX_CACHE_AGE:
-                    logger.info(f"Cache hit for query: {request.query[:50]}...")
-                    return QueryResponse(**cached_result['data'])
+        response = record_query(request, cache_key, build_answer(request.query, top_results, item, start_time), index)
+        yield encode("done", {
+            "sources": response["sources"],
+            "message": item,
+            "confidence": response["confidence"],
+            "query_time": response["query_time"]
+        })
+    
+    return StreamingResponse(events(), media_type=media_type,
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def answer_query(request: QueryRequest) -> Dict[str, Any]:
+    """The full response for a query, from the cache or a fresh search"""
+    # Check cache first
+    search = search_for(request)
+    cache_key = get_cache_key(*search)
+    cached_result = query_cache.get(cache_key)
+    if cached_result is not None:
+        logger.info(f"Cache hit for query: {request.query[:50]}...")
+        return cached_result
+    
+    # Perform search on the snapshot served now, even if a newer one is published meanwhile
+    index = snapshot.index
+    result = await search_queue.run(perform_search, *search, index)
+    
+    return record_query(request, cache_key, result, index)
+
+def encode_cursor(candidates_key: str, generation: int, offset: int) -> str:
+    """Opaque continuation token: which ranked candidate list, its index generation and where the next page starts"""
+    return base64.urlsafe_b64encode(json.dumps([candidates_key, generation, offset]).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[str, int, int]:
+    try:
+        candidates_key, generation, offset = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if (isinstance(candidates_key, str) and isinstance(generation, int) and isinstance(offset, int)
+                and offset >= 0):
+            return candidates_key, generation, offset
+    except (ValueError, TypeError):
+        pass
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def rank_candidates(search: Tuple[str, int, Optional[DocumentFilter], str],
+                    index: SearchIndex) -> Tuple[list, Optional[str]]:
+    """(hits, message) for the first PAGINATION_DEPTH results of a search"""
+    timer = StageTimer()
+    search = (search[0], PAGINATION_DEPTH) + search[2:]
+    ranked, = rank_batch([search], index, timer)
+    record_stages([search], timer)
+    return ranked
+
+async def query_page(request: QueryRequest, cursor: Optional[Tuple[str, int, int]]) -> Dict[str, Any]:
+    """One page of a paginated query, sliced from its ranked candidates
+    
+    The first page ranks PAGINATION_DEPTH hits once and caches them for the
+    index generation it ran on; later pages only build their answer from
+    the next top_k of them. A cursor from an older generation is refused
+    with 410, as the ranking it continues no longer exists.
+    """
+    start_time = time.time()
+    search = search_for(request)
+    candidates_key = get_cache_key(search[0], PAGINATION_DEPTH, *search[2:])
+    current = snapshot
+    offset = 0
+    if cursor is not None:
+        cursor_key, generation, offset = cursor
+        if cursor_key != candidates_key:
+            raise HTTPException(status_code=400, detail="Cursor belongs to a different query")
+        if generation != current.generation:
+            raise HTTPException(status_code=410, detail="Documents changed since this cursor was issued, "
+                                                        "start again from the first page")
+    
+    cache_key = f"{candidates_key}_{current.generation}"
+    candidates = candidate_cache.get(cache_key)
+    if candidates is None:
+        candidates = await search_queue.run(rank_candidates, search, current.index)
+        if current is snapshot:
+            sources = list(dict.fromkeys(hit[3] for hit in candidates[0]))
+            candidate_cache.put(cache_key, candidates, tags=cache_tags(current.index, request.query, sources,
+                                                                       request.retrieval))
+    
+    hits, message = candidates
+    next_offset = offset + request.top_k
+    sources, answer, document_specific_answers, _, results = build_answer(request.query, hits[offset:next_offset],
+                                                                          message, start_time)
+    next_cursor = encode_cursor(candidates_key, current.generation, next_offset) if next_offset < len(hits) else None
+    return {
+        'answer': answer,
+        'sources': sources,
+        'confidence': 0.9,
+        'query_time': time.time() - start_time,
+        'total_documents_searched': current.index.document_count,
+        'document_specific_answers': document_specific_answers,
+        'results': results,
+        'next_cursor': next_cursor
+    }
+
+@app.post("/query", response_model=QueryResponse)
+async def query_rag_system(request: QueryRequest, stream: Optional[str] = None):
+    """Optimized query the RAG system with caching
+    
+    With ?stream=sse or ?stream=ndjson the ranked chunks are streamed as
+    they are sent instead of returned as one answer.
+    """
+    if stream is not None and stream not in STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported stream format. Use 'sse' or 'ndjson'")
+    paginated = request.paginate or request.cursor is not None
+    if stream is not None and paginated:
+        raise HTTPException(status_code=400, detail="Streamed queries cannot be paginated")
+    cursor = decode_cursor(request.cursor) if request.cursor is not None else None
+    await ensure_index_loaded()
+    
+    try:
+        if stream is not None:
+            return await stream_query(request, stream)
+        if paginated:
+            return shape_response(request, await query_page(request, cursor))
         
-        # Perform search
-        sources, answer, document_specific_answers, query_time = perform_search(
-            request.query, 
-            request.top_k, 
-            request.document_filter
-        )
+        return shape_response(request, await answer_query(request))
         
-        # Store in cache
-        with cache_lock:
-            query_cache[cache_key] = {
-                'data': {
-                    'answer': answer,
-                    'sources': sources,
-                    'confidence': 0.9,
-                    'query_time': query_time,
-                    'total_documents_searched': len(documents_data),
-                    'document_specific_answers': document_specific_answers
-                },
-                'timestamp': time.time()
-            }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing query: {e}")
+        raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
+
+@app.post("/query/batch", response_model=BatchQueryResponse)
+async def query_batch(request: BatchQueryRequest):
+    """Answer several queries in one request, sharing term lookups across the batch"""
+    if len(request.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400,
+                            detail=f"A batch may contain at most {MAX_BATCH_QUERIES} queries")
+    await ensure_index_loaded()
+    
+    try:
+        start_time = time.time()
+        responses: List[Optional[Dict[str, Any]]] = [None] * len(request.queries)
         
-        # Store query in history
-        query_history.append({
-            "query": request.query,
-            "timestamp": datetime.now().isoformat(),
-            "sources": sources,
-            "query_time": query_time
-        })
+        # Cached answers are reused; repeated queries in the batch are searched once
+        misses: Dict[str, List[int]] = {}
+        for position, query in enumerate(request.queries):
+            cache_key = get_cache_key(*search_for(query))
+            cached_result = query_cache.get(cache_key)
+            if cached_result is not None:
+                responses[position] = cached_result
+            else:
+                misses.setdefault(cache_key, []).append(position)
+        cache_hits = len(request.queries) - sum(len(positions) for positions in misses.values())
         
-        # Keep only last 100 queries
-        if len(query_history) > 100:
-            query_history = query_history[-100:]
+        if misses:
+            pending = [(cache_key, request.queries[positions[0]]) for cache_key, positions in misses.items()]
+            index = snapshot.index
+            results = await search_queue.run(
+                perform_batch_search,
+                [search_for(query) for _, query in pending],
+                index
+            )
+            for (cache_key, query), result in zip(pending, results):
+                response = record_query(query, cache_key, result, index)
+                for position in misses[cache_key]:
+                    responses[position] = response
         
-        return QueryResponse(
-            answer=answer,
-            sources=sources,
-            confidence=0.9,
-            query_time=query_time,
-            total_documents_searched=len(documents_data),
-            document_specific_answers=document_specific_answers
+        return BatchQueryResponse(
+            results=[shape_response(query, response) for query, response in zip(request.queries, responses)],
+            cache_hits=cache_hits,
+            total_time=time.time() - start_time
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error processing query: {e}")
-        raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
+        logger.error(f"Error processing query batch: {e}")
+        raise HTTPException(status_code=500, detail=f"Error processing query batch: {str(e)}")
 
 @app.post("/upload-documents", response_model=DocumentUploadResponse)
 async def upload_documents(file: UploadFile = File(...)):
-    """Upload a document to the RAG system"""
-    global documents_data, index_initialized
+    """Upload a document and queue it for indexing"""
+    filename = os.path.basename(file.filename or "")
+    if not filename:
+        raise HTTPException(status_code=400, detail="Uploaded file has no filename")
     
     try:
         data_dir = "data"
         os.makedirs(data_dir, exist_ok=True)
         
-        file_path = os.path.join(data_dir, file.filename)
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        # Stream to disk in blocks rather than reading the whole upload into memory
+        part_path, file_hash, size = await run_in_threadpool(
+            receive_upload, file.file, data_dir, int(MAX_UPLOAD_MB * 1024 * 1024)
+        )
+        file_size_mb = size / (1024 * 1024)
         
-        file_size_mb = len(content) / (1024 * 1024)
+        # Identical content under the same name is already indexed
+        file_path = os.path.join(data_dir, filename)
+        if snapshot.document_hashes.get(filename) == file_hash and os.path.exists(file_path):
+            os.remove(part_path)
+            return DocumentUploadResponse(
+                message=f"Document '{filename}' is unchanged",
+                documents_processed=0,
+                filename=filename,
+                file_size_mb=round(file_size_mb, 2),
+                supported_formats=[".txt", ".pdf", ".md", ".docx"],
+                status="unchanged",
+                sha256=file_hash
+            )
         
-        # Reload documents and rebuild index
-        load_documents()
+        # The indexing slot is claimed before the file lands in data/, so a full queue
+        # rejects the upload with nothing saved or queued
+        try:
+            slot = indexing_queue.reserve()
+        except QueueFullError:
+            os.remove(part_path)
+            raise
+        with slot:
+            os.replace(part_path, file_path)
+            job_id = indexing_jobs.submit(slot, apply_queued_writes, queue_write(filename), filename=filename)
         
         return DocumentUploadResponse(
-            message=f"Document '{file.filename}' uploaded successfully",
+            message=f"Document '{filename}' uploaded successfully, indexing queued",
             documents_processed=1,
-            filename=file.filename,
+            filename=filename,
             file_size_mb=round(file_size_mb, 2),
-            supported_formats=[".txt", ".pdf", ".md", ".docx"]
+            supported_formats=[".txt", ".pdf", ".md", ".docx"],
+            status="queued",
+            sha256=file_hash,
+            job_id=job_id
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error uploading document: {e}")
         raise HTTPException(status_code=500, detail=f"Error uploading document: {str(e)}")
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status of a background indexing job"""
+    job = indexing_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    return job
+
 @app.get("/documents")
 async def list_documents():
-    """List all documents in the data directory"""
-    data_dir = "data"
-    if not os.path.exists(data_dir):
-        return {"documents": []}
+    """List all documents in the data directory, as of the served index
     
+    Files without text are listed with no chunks and status "empty", and
+    files whose extraction failed with status "failed" and the error.
+    """
     documents = []
-    for filename in os.listdir(data_dir):
-        if filename.endswith(('.txt', '.pdf', '.md', '.docx')):
-            file_path = os.path.join(data_dir, filename)
-            file_size = os.path.getsize(file_path)
-            documents.append({
-                "filename": filename,
-                "size_bytes": file_size,
-                "size_mb": round(file_size / (1024 * 1024), 2),
-                "upload_date": datetime.fromtimestamp(os.path.getctime(file_path)).isoformat()
-            })
+    for filename, entry in snapshot.catalog.entries.items():
+        documents.append({
+            "filename": filename,
+            "size_bytes": entry.size_bytes,
+            "size_mb": round(entry.size_bytes / (1024 * 1024), 2),
+            "upload_date": datetime.fromtimestamp(entry.uploaded).isoformat(),
+            "sha256": entry.file_hash,
+            "chunk_count": entry.chunk_count,
+            "term_count": entry.term_count,
+            "index_bytes": entry.index_bytes,
+            "status": entry.status,
+            "error": entry.error
+        })
     
     return {"documents": documents}
 
+@app.get("/documents/{filename}/chunks/{chunk_index}")
+async def get_document_chunk(filename: str, chunk_index: int):
+    """Full text of one chunk, for results returned in compact response mode"""
+    await ensure_index_loaded()
+    content = snapshot.index.document_chunk(filename, chunk_index)
+    if content is None:
+        raise HTTPException(status_code=404, detail=f"Chunk {chunk_index} of '{filename}' not found")
+    return {"filename": filename, "chunk_index": chunk_index, "content": content}
+
 @app.post("/rebuild-index")
 async def rebuild_index():
     """Manually rebuild the index from all documents"""
     global index_initialized
     
     try:
-        load_documents()
-        if not documents_data:
+        await indexing_queue.run(load_documents, False)
+        if not snapshot.index.document_count:
             return {"message": "No documents found to build index"}
         
         return {"message": "Index rebuilt successfully"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error rebuilding index: {e}")
         raise HTTPException(status_code=500, detail=f"Error rebuilding index: {str(e)}")
@@ -531,7 +1631,7 @@ async def rebuild_index():
 @app.delete("/documents/{filename}")
 async def delete_document(filename: str):
     """Delete a specific document"""
-    global documents_data, index_initialized
+    global index_initialized
     
     try:
         data_dir = "data"
@@ -540,78 +1640,90 @@ async def delete_document(filename: str):
         if not os.path.exists(file_path):
             raise HTTPException(status_code=404, detail=f"Document '{filename}' not found")
         
-        os.remove(file_path)
-        load_documents()
+        # Claimed before the file goes, so a full queue rejects the delete with the file and its chunks still in place
+        with indexing_queue.reserve() as slot:
+            os.remove(file_path)
+            await slot.run(apply_queued_writes, queue_write(filename))
         
         return {"message": f"Document '{filename}' deleted successfully"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error deleting document: {e}")
         raise HTTPException(status_code=500, detail=f"Error deleting document: {str(e)}")
 
+REPORT_MEDIA_TYPES = {"pdf": "application/pdf", "txt": "text/plain", "json": "application/json"}
+
+def get_report_key(request: DownloadRequest, query: QueryRequest, generation: int) -> str:
+    """Cache key for a rendered download: the answer's key, corpus generation, format and options"""
+    key_data = (f"{get_cache_key(*search_for(query))}_{generation}_{request.format.lower()}_"
+                f"{request.include_sources}_{request.include_metadata}")
+    return hashlib.md5(key_data.encode()).hexdigest()
+
+def cache_report(report_key: str, blocks: Iterator[bytes], tags: set, current: IndexSnapshot) -> Iterator[bytes]:
+    """Pass a download's blocks on as they are rendered, then cache them if the corpus did not change meanwhile"""
+    sent = []
+    for block in blocks:
+        sent.append(block)
+        yield block
+    if current is snapshot:
+        report_cache.put(report_key, sent, tags=tags)
+
 @app.post("/download-answer")
 async def download_answer(request: DownloadRequest):
-    """Download query answer in various formats"""
+    """Download query answer in various formats
+    
+    The answer comes from the query cache when it is there, and rendered
+    files are cached per corpus generation until the documents behind them
+    change. PDFs are rendered in a worker process; TXT and JSON files are
+    streamed in blocks as they are written.
+    """
+    report_format = request.format.lower()
+    if report_format not in REPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Unsupported format. Use 'pdf', 'txt', or 'json'")
+    headers = {"Content-Disposition": f"attachment; filename=rag_answer_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{report_format}"}
+    
     try:
-        sources, answer, document_specific_answers, query_time = perform_search(
-            request.query, 3, None
-        )
+        query = QueryRequest(query=request.query, top_k=3)
+        current = snapshot
+        report_key = get_report_key(request, query, current.generation)
+        blocks = report_cache.get(report_key)
+        if blocks is not None:
+            return StreamingResponse(iter(blocks), media_type=REPORT_MEDIA_TYPES[report_format], headers=headers)
         
+        response = await answer_query(query)
+        answer, sources = response["answer"], response["sources"]
         metadata = {
             "query": request.query,
-            "query_time": query_time,
-            "total_documents_searched": len(documents_data),
+            "query_time": response["query_time"],
+            "total_documents_searched": response["total_documents_searched"],
             "sources": sources,
             "timestamp": datetime.now().isoformat()
         }
         
-        if request.format.lower() == "pdf":
-            pdf_content = generate_pdf_report(request.query, answer, sources, metadata)
-            return StreamingResponse(
-                io.BytesIO(pdf_content),
-                media_type="application/pdf",
-                headers={"Content-Disposition": f"attachment; filename=rag_answer_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"}
-            )
-        
-        elif request.format.lower() == "txt":
-            content = f"RAG System Answer\n{'='*50}\n\n"
-            content += f"Query: {request.query}\n"
-            content += f"Timestamp: {metadata['timestamp']}\n"
-            content += f"Query Time: {query_time:.2f} seconds\n\n"
-            content += f"Answer:\n{answer}\n\n"
-            
-            if request.include_sources and sources:
-                content += f"Sources: {', '.join(sources)}\n"
-            
-            if request.include_metadata:
-                content += f"\nMetadata:\n"
-                for key, value in metadata.items():
-                    content += f"  {key}: {value}\n"
-            
-            return StreamingResponse(
-                io.BytesIO(content.encode('utf-8')),
-                media_type="text/plain",
-                headers={"Content-Disposition": f"attachment; filename=rag_answer_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"}
-            )
-        
-        elif request.format.lower() == "json":
+        if report_format == "pdf":
+            blocks = [await render_queue.run(generate_pdf_report, request.query, answer, sources, metadata)]
+        elif report_format == "txt":
+            blocks = encode_blocks(text_report(request.query, answer, sources, metadata,
+                                               request.include_sources, request.include_metadata),
+                                   REPORT_BLOCK_SIZE)
+        else:
             response_data = {
                 "query": request.query,
                 "answer": answer,
                 "sources": sources,
-                "document_specific_answers": document_specific_answers,
+                "document_specific_answers": response["document_specific_answers"],
                 "metadata": metadata
             }
-            
-            return StreamingResponse(
-                io.BytesIO(json.dumps(response_data, indent=2).encode('utf-8')),
-                media_type="application/json",
-                headers={"Content-Disposition": f"attachment; filename=rag_answer_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"}
-            )
+            blocks = encode_blocks(json_report(response_data), REPORT_BLOCK_SIZE)
         
-        else:
-            raise HTTPException(status_code=400, detail="Unsupported format. Use 'pdf', 'txt', or 'json'")
+        tags = cache_tags(current.index, request.query, sources)
+        return StreamingResponse(cache_report(report_key, blocks, tags, current),
+                                 media_type=REPORT_MEDIA_TYPES[report_format], headers=headers)
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error generating download: {e}")
         raise HTTPException(status_code=500, detail=f"Error generating download: {str(e)}")
@@ -623,33 +1735,85 @@ async def get_query_history():
 
 @app.get("/system-stats")
 async def get_system_stats():
-    """Get detailed system statistics"""
-    data_dir = "data"
-    total_documents = 0
-    total_size_mb = 0
-    
-    if os.path.exists(data_dir):
-        for filename in os.listdir(data_dir):
-            if filename.endswith(('.txt', '.pdf', '.md', '.docx')):
-                file_path = os.path.join(data_dir, filename)
-                file_size = os.path.getsize(file_path)
-                total_documents += 1
-                total_size_mb += file_size / (1024 * 1024)
-    
+    """Get detailed system statistics, from the served snapshot and its document catalog"""
+    current = snapshot
+    index = current.index
     return {
-        "total_documents": total_documents,
-        "total_size_mb": round(total_size_mb, 2),
+        "total_documents": len(current.catalog),
+        "total_size_mb": round(current.catalog.total_size_bytes / (1024 * 1024), 2),
+        "index_size_mb": round(sum(current.memory.values()) / (1024 * 1024), 2),
+        "index_memory_bytes": current.memory,
         "system_uptime": str(datetime.now() - system_start_time),
         "queries_processed": len(query_history),
-        "documents_loaded": len(documents_data),
-        "chunks_created": sum(len(chunks) for chunks in document_chunks.values()),
-        "indexed_words": len(chunk_index),
+        "documents_loaded": index.document_count,
+        "chunks_created": index.chunk_count,
+        "indexed_words": index.term_count,
+        "dense_index": index.dense.stats() if index.dense is not None else None,
         "cache_size": len(query_cache),
+        "cache": query_cache.stats(),
+        "report_cache": report_cache.stats(),
+        "candidate_cache": candidate_cache.stats(),
+        "queues": {queue.name: queue.stats() for queue in (search_queue, render_queue, indexing_queue)},
+        "ingestion": ingestion.stats(),
         "supported_formats": [".txt", ".pdf", ".md", ".docx"]
     }
 
-# Initialize on startup
-initialize_rag_system()
+def index_metrics() -> List[str]:
+    """Exposition lines for the served index, read at scrape time"""
+    current = snapshot
+    index = current.index
+    return (
+        metrics.gauge("rag_index_documents", "Documents in the served index", [({}, index.document_count)]) +
+        metrics.gauge("rag_index_chunks", "Chunks in the served index", [({}, index.chunk_count)]) +
+        metrics.gauge("rag_index_terms", "Distinct terms in the served index", [({}, index.term_count)]) +
+        metrics.gauge("rag_index_generation", "Index generation this process serves", [({}, current.generation)]) +
+        metrics.gauge("rag_index_memory_bytes", "Approximate index memory, own heap or shared mapped file",
+                      [({"area": area}, size) for area, size in index.memory_usage().items()])
+    )
+
+def cache_metrics() -> List[str]:
+    """Exposition lines for the query and report caches, from their own counters"""
+    stats = query_cache.stats()
+    lines = []
+    for name, help_text in (("hits", "Query cache hits"), ("misses", "Query cache misses"),
+                            ("evictions", "Entries evicted to stay within the cache limits"),
+                            ("expirations", "Entries dropped after MAX_CACHE_AGE"),
+                            ("invalidations", "Entries dropped because the documents behind them changed")):
+        lines += metrics.gauge(f"rag_cache_{name}_total", help_text, [({}, stats[name])], "counter")
+    lines += metrics.gauge("rag_cache_hit_ratio", "Share of query cache lookups that hit", [({}, stats["hit_ratio"])])
+    lines += metrics.gauge("rag_cache_entries", "Entries in the query cache", [({}, stats["entries"])])
+    lines += metrics.gauge("rag_cache_size_bytes", "Estimated size of the query cache", [({}, stats["size_bytes"])])
+    stats = report_cache.stats()
+    lines += metrics.gauge("rag_report_cache_hits_total", "Downloads served from the report cache",
+                           [({}, stats["hits"])], "counter")
+    lines += metrics.gauge("rag_report_cache_misses_total", "Downloads that had to be rendered",
+                           [({}, stats["misses"])], "counter")
+    lines += metrics.gauge("rag_report_cache_size_bytes", "Estimated size of the report cache",
+                           [({}, stats["size_bytes"])])
+    return lines
+
+def queue_metrics() -> List[str]:
+    """Exposition lines for the work queues, from their own counters"""
+    stats = {queue.name: queue.stats() for queue in (search_queue, render_queue, indexing_queue)}
+    return (
+        metrics.gauge("rag_queue_pending", "Jobs queued or running",
+                      [({"queue": name}, queue["pending"]) for name, queue in stats.items()]) +
+        metrics.gauge("rag_queue_capacity", "Jobs a queue accepts before rejecting with 503",
+                      [({"queue": name}, queue["max_pending"]) for name, queue in stats.items()]) +
+        metrics.gauge("rag_queue_completed_total", "Jobs finished",
+                      [({"queue": name}, queue["completed"]) for name, queue in stats.items()], "counter") +
+        metrics.gauge("rag_queue_rejected_total", "Jobs turned away because the queue was full",
+                      [({"queue": name}, queue["rejected"]) for name, queue in stats.items()], "counter")
+    )
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus metrics for this server process"""
+    lines = []
+    for metric in (QUERY_STAGE_SECONDS, SEARCH_SECONDS, SEARCHES, INDEX_DOCUMENT_SECONDS, EXTRACTION_PAGE_SECONDS):
+        lines += metric.render()
+    lines += index_metrics() + cache_metrics() + queue_metrics() + ingestion.render_metrics()
+    return PlainTextResponse("\n".join(lines) + "\n", media_type=metrics.CONTENT_TYPE)
 
 if __name__ == "__main__":
     uvicorn.run("main_optimized:app", host="127.0.0.1", port=8000, reload=False) 
\ No newline at end of file
@@ -0,0 +1,131 @@
+"""
+Prometheus metrics for the RAG API
+
+Counters and histograms rendered in the Prometheus text exposition format
+for /metrics, without a client library. Recording a value takes one lock
+and a bisect, so instrumentation can stay on in production. Figures that
+are already tracked elsewhere (cache and queue statistics, index size)
+are read when /metrics is scraped instead of on every request.
+
+Each server process keeps its own metrics; with several workers every
+scrape reports the process that answered it.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Upper bounds in seconds, from sub-millisecond search stages to multi-second builds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count per label combination"""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines += [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}" for key, value in values]
+        return lines
+
+
+class Histogram:
+    """Bucketed distribution of observed values per label combination"""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Per label combination: [count per bucket (last one is +Inf), sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str, count: int = 1):
+        """Record a value; count > 1 records that many observations of it"""
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bucket] += count
+            series[1] += value * count
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, (list(counts), total)) for key, (counts, total) in self._series.items())
+        for key, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+def gauge(name: str, help_text: str, samples: Iterable[Tuple[Dict[str, str], float]],
+          metric_type: str = "gauge") -> List[str]:
+    """Exposition lines for values read at scrape time, as ({label: value}, value) samples"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(list(labels), list(labels.values()))} {format_value(value)}")
+    return lines
+
+
+class StageTimer:
+    """Splits elapsed time between named stages
+
+    mark(stage) charges the time since the previous mark to that stage;
+    mark() with no stage just starts a new interval. Code that measures its
+    own sub-stages can add them to `stages` directly.
+    """
+
+    def __init__(self):
+        self.started = self.last = time.perf_counter()
+        self.stages: Dict[str, float] = defaultdict(float)
+
+    def mark(self, stage: Optional[str] = None):
+        now = time.perf_counter()
+        if stage is not None:
+            self.stages[stage] += now - self.last
+        self.last = now
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
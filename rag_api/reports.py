@@ -0,0 +1,102 @@
+"""
+Report rendering for the RAG API
+
+Kept apart from main_optimized so the PDF renderer can run in a worker
+process without importing the API. Text and JSON exports are generators
+of string pieces, which encode_blocks() groups into blocks to stream, so
+a long export is never assembled in one string.
+"""
+
+import io
+import json
+from typing import Any, Dict, Iterable, Iterator, List
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer
+
+
+def generate_pdf_report(query: str, answer: str, sources: List[str], metadata: Dict[str, Any]) -> bytes:
+    """Generate PDF report of the query and answer"""
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter)
+    styles = getSampleStyleSheet()
+
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=16,
+        spaceAfter=20,
+        textColor=colors.darkblue
+    )
+
+    content_style = ParagraphStyle(
+        'CustomContent',
+        parent=styles['Normal'],
+        fontSize=11,
+        spaceAfter=12,
+        leftIndent=20
+    )
+
+    story = []
+    story.append(Paragraph("RAG System Query Report", title_style))
+    story.append(Spacer(1, 20))
+    story.append(Paragraph(f"<b>Query:</b> {query}", content_style))
+    story.append(Spacer(1, 15))
+    story.append(Paragraph("<b>Answer:</b>", content_style))
+    story.append(Paragraph(answer.replace('\n', '<br/>'), content_style))
+    story.append(Spacer(1, 15))
+
+    if sources:
+        story.append(Paragraph(f"<b>Sources:</b> {', '.join(sources)}", content_style))
+        story.append(Spacer(1, 15))
+
+    if metadata:
+        story.append(Paragraph("<b>Metadata:</b>", content_style))
+        for key, value in metadata.items():
+            story.append(Paragraph(f"• {key}: {value}", content_style))
+
+    doc.build(story)
+    buffer.seek(0)
+    return buffer.getvalue()
+
+
+def text_report(query: str, answer: str, sources: List[str], metadata: Dict[str, Any],
+                include_sources: bool = True, include_metadata: bool = True) -> Iterator[str]:
+    """Plain-text report of the query and answer, a piece at a time"""
+    yield f"RAG System Answer\n{'=' * 50}\n\n"
+    yield f"Query: {query}\n"
+    yield f"Timestamp: {metadata['timestamp']}\n"
+    yield f"Query Time: {metadata['query_time']:.2f} seconds\n\n"
+    yield "Answer:\n"
+    yield answer
+    yield "\n\n"
+
+    if include_sources and sources:
+        yield f"Sources: {', '.join(sources)}\n"
+
+    if include_metadata:
+        yield "\nMetadata:\n"
+        for key, value in metadata.items():
+            yield f"  {key}: {value}\n"
+
+
+def json_report(data: Dict[str, Any]) -> Iterator[str]:
+    """Indented JSON, encoded a token at a time"""
+    return json.JSONEncoder(indent=2).iterencode(data)
+
+
+def encode_blocks(parts: Iterable[str], block_size: int = 64 * 1024) -> Iterator[bytes]:
+    """UTF-8 blocks of about block_size characters from a stream of string pieces"""
+    pending = []
+    size = 0
+    for part in parts:
+        pending.append(part)
+        size += len(part)
+        if size >= block_size:
+            yield "".join(pending).encode("utf-8")
+            pending = []
+            size = 0
+    if pending:
+        yield "".join(pending).encode("utf-8")
@@ -0,0 +1,1102 @@
+"""
+Compact inverted index for the RAG API
+
+Chunks are addressed by integer ids. A chunk table maps each id to its
+document and position, and every term keeps its postings as two parallel
+``array('I')`` columns (chunk ids and term frequencies) instead of one
+string per occurrence. Chunks are ranked with BM25; chunk-length
+normalisation is precomputed whenever the corpus changes and IDF follows
+from each term's posting count.
+
+Postings also record where in the chunk each term occurs, as token
+positions delta-encoded into varint bytes, so phrase and proximity checks
+intersect position lists instead of scanning chunk text. Positions are kept
+apart from the chunk ids and frequencies that ranking reads, and nothing
+locates a posting's positions until a phrase or proximity check first asks.
+
+The term dictionary is kept in sorted order, which lets a query word be
+expanded to the terms it is a prefix of, or to the terms within a few
+edits of it, by binary search instead of a scan of the vocabulary.
+"""
+
+import math
+import re
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from functools import partial
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'\b\w+\b')
+WORD_PATTERN = re.compile(r'\w+')
+# ChunkedText.tokens() marks chunk boundaries with a character no token contains
+BOUNDARY_MARK = "\x00"
+MARKED_TOKEN_PATTERN = re.compile(r'\w+|\x00')
+MIN_TERM_LENGTH = 3  # Skip short words
+
+# BM25 defaults
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Multi-term scores are summed in a dense per-chunk array instead of by sorting
+# once the matched postings reach this fraction of the corpus (1/4)
+DENSE_ACCUMULATOR_RATIO = 4
+
+# A posting list is cut to a chunk set's runs by binary search while it has at
+# least this many postings per run, and tested against the set's bitmap otherwise
+RUN_SEARCH_RATIO = 16
+
+# Compiled document filters kept per index state
+CHUNK_SET_CACHE_SIZE = 256
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase word tokens"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def index_terms(text: str) -> List[str]:
+    """Tokens long enough to be indexed or searched for"""
+    return [word for word in tokenize(text) if len(word) >= MIN_TERM_LENGTH]
+
+
+def term_offsets(text: str) -> List[Tuple[str, int]]:
+    """(term, token position) for every indexed term, in text order
+
+    Positions count every token, including words too short to index, so
+    gaps between terms match the gaps recorded in the index.
+    """
+    return [(word, position) for position, word in enumerate(tokenize(text)) if len(word) >= MIN_TERM_LENGTH]
+
+
+def term_positions(text: str) -> Dict[str, List[int]]:
+    """Sorted token positions of each indexed term in the text"""
+    return token_positions(tokenize(text))
+
+
+def token_positions(tokens: List[str]) -> Dict[str, List[int]]:
+    """Sorted positions of each indexed term in a token list"""
+    positions = {}
+    for position, word in enumerate(tokens):
+        if len(word) >= MIN_TERM_LENGTH:
+            if word in positions:
+                positions[word].append(position)
+            else:
+                positions[word] = [position]
+    return positions
+
+
+def token_occurrences(tokens: List[str]) -> Dict[str, Union[int, List[int]]]:
+    """Position of each indexed term in a token list, or its sorted positions if it occurs more than once
+
+    Most terms occur once per chunk, so they get a bare int rather than a
+    list of their own.
+    """
+    occurrences = {}
+    for position, word in enumerate(tokens):
+        if len(word) >= MIN_TERM_LENGTH:
+            if word not in occurrences:
+                occurrences[word] = position
+                continue
+            found = occurrences[word]
+            if type(found) is int:
+                occurrences[word] = [found, position]
+            else:
+                found.append(position)
+    return occurrences
+
+
+def splits_word(text: str, position: int) -> bool:
+    """Whether cutting the text at this position would fall inside a word"""
+    match = WORD_PATTERN.match(text, position - 1, position + 1) if 0 < position < len(text) else None
+    return match is not None and match.end() == position + 1
+
+
+class ChunkedText:
+    """A document's chunks as (start, end) character offsets into one text buffer
+
+    Neighbouring chunks overlap, so slicing them out of the shared buffer on
+    demand keeps each character once rather than once per chunk holding it.
+    """
+    __slots__ = ('text', 'starts', 'ends')
+
+    def __init__(self, text: str, starts: Iterable[int], ends: Iterable[int]):
+        self.text = text
+        self.starts = array('Q', starts)
+        self.ends = array('Q', ends)
+
+    @classmethod
+    def from_chunks(cls, chunks: Iterable[str]) -> "ChunkedText":
+        """Separate chunk strings laid end to end, one space apart
+
+        The text is copied, so while the caller still holds the strings it
+        is in memory twice.
+        """
+        chunks = list(chunks)
+        starts = array('Q')
+        ends = array('Q')
+        position = 0
+        for chunk in chunks:
+            starts.append(position)
+            position += len(chunk)
+            ends.append(position)
+            position += 1
+        return cls(" ".join(chunks), starts, ends)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __getitem__(self, number: int) -> str:
+        return self.text[self.starts[number]:self.ends[number]]
+
+    def __iter__(self) -> Iterator[str]:
+        text = self.text
+        for start, end in zip(self.starts, self.ends):
+            yield text[start:end]
+
+    def tokens(self) -> List[List[str]]:
+        """Lowercase tokens of each chunk, as tokenize() would return them
+
+        The buffer is lowercased and tokenized once however many overlapping
+        chunks contain each part of it: a marker goes in at every chunk
+        boundary, one findall() pass yields the tokens with the markers
+        among them, and each chunk's tokens are one slice of the token list.
+        """
+        text = self.text
+        lowered = text.lower()
+        boundaries = sorted(set(self.starts) | set(self.ends))
+        if (len(lowered) != len(text) or BOUNDARY_MARK in lowered or
+                any(splits_word(lowered, boundary) for boundary in boundaries)):
+            # Lowercasing moved offsets, or a boundary falls inside a word
+            return [tokenize(chunk) for chunk in self]
+
+        cuts = [0] + boundaries + [len(lowered)]
+        items = MARKED_TOKEN_PATTERN.findall(BOUNDARY_MARK.join(lowered[start:end]
+                                                                for start, end in zip(cuts, cuts[1:])))
+        # Token index at each boundary: its marker's place in the list, less the markers before it
+        token_index = {}
+        place = -1
+        for number, boundary in enumerate(boundaries):
+            place = items.index(BOUNDARY_MARK, place + 1)
+            token_index[boundary] = place - number
+        tokens = [item for item in items if item != BOUNDARY_MARK]
+        return [tokens[token_index[start]:token_index[end]] for start, end in zip(self.starts, self.ends)]
+
+
+class ChunkTexts:
+    """Chunk text by chunk id for an index built in memory
+
+    Each document's chunks are kept as the ChunkedText they were added as,
+    so overlapping text is held once per document.
+    """
+
+    def __init__(self):
+        self._documents: List[Optional[ChunkedText]] = []
+        self._first_chunks: List[int] = []  # Chunk id of each document's first chunk
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _entry(self, chunk_id: int) -> int:
+        return bisect_right(self._first_chunks, chunk_id) - 1
+
+    def __getitem__(self, chunk_id: int) -> Optional[str]:
+        # Every returned hit comes through here, so the lookups are inlined
+        entry = bisect_right(self._first_chunks, chunk_id) - 1
+        chunked = self._documents[entry]
+        if chunked is None:
+            return None
+        number = chunk_id - self._first_chunks[entry]
+        return chunked.text[chunked.starts[number]:chunked.ends[number]]
+
+    def __iter__(self) -> Iterator[Optional[str]]:
+        for chunked in self._documents:
+            yield from chunked if chunked is not None else ()
+
+    def extend(self, chunked: ChunkedText):
+        """Add a document's chunks as the next chunk ids"""
+        self._documents.append(chunked)
+        self._first_chunks.append(self._count)
+        self._count += len(chunked)
+
+    def clear(self, chunk_ids: range):
+        """Drop a removed document's text"""
+        if chunk_ids:
+            self._documents[self._entry(chunk_ids.start)] = None
+
+    def document(self, chunk_ids: range) -> ChunkedText:
+        """The ChunkedText a document's chunks were added as"""
+        if not chunk_ids:
+            return ChunkedText("", (), ())
+        return self._documents[self._entry(chunk_ids.start)]
+
+    def document_bytes(self, chunk_ids: range) -> Tuple[bytes, List[int], List[int]]:
+        """A document's text as UTF-8 with the byte offsets of each chunk, for saving"""
+        chunked = self.document(chunk_ids)
+        data = chunked.text.encode('utf-8')
+        if len(data) == len(chunked.text):
+            return data, list(chunked.starts), list(chunked.ends)
+        # Byte offsets of every boundary, encoding the stretches between them in order
+        boundaries = sorted(set(chunked.starts) | set(chunked.ends))
+        byte_offsets = {}
+        position = previous = 0
+        for boundary in boundaries:
+            position += len(chunked.text[previous:boundary].encode('utf-8'))
+            byte_offsets[boundary] = position
+            previous = boundary
+        return (data, [byte_offsets[start] for start in chunked.starts],
+                [byte_offsets[end] for end in chunked.ends])
+
+    @property
+    def heap_size(self) -> int:
+        """Characters of chunk text held in memory"""
+        return sum(len(chunked.text) for chunked in self._documents if chunked is not None)
+
+
+# Most terms occur once per chunk, early enough to encode as one byte
+_SINGLE_POSITIONS = [bytes((position,)) for position in range(0x80)]
+
+
+def encode_positions(positions: List[int]) -> bytes:
+    """Delta-encode sorted positions as varints (one byte per gap below 128)"""
+    if len(positions) == 1 and positions[0] < 0x80:
+        return _SINGLE_POSITIONS[positions[0]]
+    deltas = [position - previous for previous, position in zip([0] + positions, positions)]
+    if max(deltas) < 0x80:
+        return bytes(deltas)
+    encoded = bytearray()
+    for delta in deltas:
+        while delta >= 0x80:
+            encoded.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        encoded.append(delta)
+    return bytes(encoded)
+
+
+def decode_positions(data, start: int, stop: int) -> List[int]:
+    positions = []
+    position = value = shift = 0
+    for byte in data[start:stop]:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            position += value
+            positions.append(position)
+            value = shift = 0
+    return positions
+
+
+def position_starts(positions, freqs) -> np.ndarray:
+    """Where each posting's encoded positions start, given how many positions each posting holds"""
+    freqs = np.frombuffer(freqs, dtype=np.uint32)
+    if not len(freqs):
+        return np.empty(0, dtype=np.int64)
+    # Every varint ends with the first byte below 0x80, so posting i starts after the end
+    # of the sum(freqs[:i])-th one
+    ends = np.flatnonzero(np.frombuffer(positions, dtype=np.uint8) < 0x80)
+    starts = np.zeros(len(freqs), dtype=np.int64)
+    starts[1:] = ends[np.cumsum(freqs[:-1], dtype=np.int64) - 1] + 1
+    return starts
+
+
+def phrase_starts(terms: List[Tuple[str, int]], positions: Dict[str, List[int]]) -> Set[int]:
+    """Positions where every (term, offset) occurs at start + offset - first offset"""
+    if not terms:
+        return set()
+    first_offset = terms[0][1]
+    starts = None
+    for term, offset in terms:
+        shifted = {position - (offset - first_offset) for position in positions.get(term, ())}
+        starts = shifted if starts is None else starts & shifted
+        if not starts:
+            return set()
+    return starts
+
+
+def pair_distance(first: List[int], second: List[int], gap: int) -> Optional[int]:
+    """1 + how far the closest occurrences are from being exactly `gap` tokens apart"""
+    if not first or not second:
+        return None
+    best = None
+    for position in first:
+        target = position + gap
+        index = bisect_left(second, target)
+        for candidate in second[max(index - 1, 0):index + 1]:
+            distance = abs(candidate - target) + 1
+            if best is None or distance < best:
+                best = distance
+                if best == 1:
+                    return best
+    return best
+
+
+def prefix_end(prefix: str) -> str:
+    """Smallest string that sorts after every string starting with prefix"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def fuzzy_matches(terms, lower_bound: Callable[[str, int], int], word: str, max_edits: int,
+                  prefix_length: int = 0) -> Iterator[Tuple[str, int]]:
+    """(term, edits) for every term within max_edits of word sharing its first prefix_length characters
+
+    `terms` is a sorted sequence and lower_bound(key, low) the index of its
+    first element from `low` on that does not sort below key. The sorted
+    terms are walked as a trie: edit distance rows are shared by terms with
+    a common prefix, and as soon as a prefix is more than max_edits from
+    every prefix of the word, all terms starting with it are skipped with
+    one binary search. An adjacent transposition counts as a single edit.
+    """
+    width = len(word) + 1
+    cap = max_edits + 1
+    rows = [[min(column, cap) for column in range(width)]]  # rows[depth]: distances after `depth` characters of the term
+    previous = ""
+    index, stop = 0, len(terms)
+    prefix = word[:prefix_length]
+    if prefix:
+        index, stop = lower_bound(prefix), lower_bound(prefix_end(prefix))
+    while index < stop:
+        term = terms[index]
+        depth = 0
+        limit = min(len(term), len(previous), len(rows) - 1)
+        while depth < limit and term[depth] == previous[depth]:
+            depth += 1
+        del rows[depth + 1:]
+        previous = term
+
+        pruned = False
+        for depth in range(depth, len(term)):
+            char = term[depth]
+            above = rows[-1]
+            # Cells more than max_edits off the diagonal cannot be within reach; they stay at the cap
+            row = [cap] * width
+            first = max(depth + 1 - max_edits, 1)
+            last = min(depth + 1 + max_edits, width - 1)
+            best = cap
+            if first == 1 and depth < max_edits:
+                row[0] = best = depth + 1
+            for column in range(first, last + 1):
+                value = above[column - 1] if word[column - 1] == char else above[column - 1] + 1
+                if row[column - 1] < value:
+                    value = row[column - 1] + 1
+                if above[column] < value:
+                    value = above[column] + 1
+                if (column > 1 and depth > 0 and word[column - 2] == char and word[column - 1] == term[depth - 1]
+                        and word[column - 1] != char and rows[-2][column - 2] < value):
+                    value = rows[-2][column - 2] + 1
+                row[column] = value
+                if value < best:
+                    best = value
+            rows.append(row)
+            if best > max_edits:
+                pruned = True
+                break
+
+        if pruned:
+            index = lower_bound(prefix_end(term[:depth + 1]), index)
+            continue
+        if rows[-1][-1] <= max_edits:
+            yield term, rows[-1][-1]
+        index += 1
+
+
+def best_alternative(parts: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge (chunk ids, scores) pairs, keeping each chunk's highest score"""
+    if not parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    if len(parts) == 1:
+        return parts[0]
+    chunk_ids, inverse = np.unique(np.concatenate([ids for ids, _ in parts]), return_inverse=True)
+    best = np.zeros(len(chunk_ids), dtype=np.float32)
+    np.maximum.at(best, inverse, np.concatenate([scores for _, scores in parts]))
+    return chunk_ids, best
+
+
+class Postings:
+    """Sorted chunk ids, term frequencies and token positions for one term
+
+    ``positions`` holds each posting's encoded positions back to back.
+    Where each posting's bytes start is not stored: it follows from the
+    frequencies, and is worked out the first time a phrase or proximity
+    check needs this term's positions, then kept until postings are added
+    or removed. Postings loaded from disk hold read-only memoryviews into
+    the mapped index file; they are copied the first time they change.
+    """
+    __slots__ = ('chunk_ids', 'freqs', 'positions', 'read_only', '_starts')
+
+    def __init__(self, chunk_ids=None, freqs=None, positions=None):
+        self.read_only = chunk_ids is not None
+        self.chunk_ids = chunk_ids if chunk_ids is not None else array('I')
+        self.freqs = freqs if freqs is not None else array('I')
+        self.positions = positions if positions is not None else bytearray()
+        self._starts = None
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    def append(self, chunk_id: int, freq: int, encoded_positions: bytes):
+        self.chunk_ids.append(chunk_id)
+        self.freqs.append(freq)
+        self.positions += encoded_positions
+
+    def make_writable(self):
+        if self.read_only:
+            chunk_ids, freqs = array('I'), array('I')
+            chunk_ids.frombytes(self.chunk_ids.cast('B'))
+            freqs.frombytes(self.freqs.cast('B'))
+            self.chunk_ids, self.freqs = chunk_ids, freqs
+            self.positions = bytearray(self.positions)
+            self.read_only = False
+
+    def _position_starts(self) -> np.ndarray:
+        # Postings are only ever appended to between removals, which reset this
+        if self._starts is None or len(self._starts) != len(self.chunk_ids):
+            self._starts = position_starts(self.positions, self.freqs)
+        return self._starts
+
+    def _position_range(self, index: int) -> Tuple[int, int]:
+        starts = self._position_starts()
+        stop = int(starts[index + 1]) if index + 1 < len(starts) else len(self.positions)
+        return int(starts[index]), stop
+
+    def positions_in(self, chunk_id: int) -> List[int]:
+        """Token positions of this term in one chunk (empty if it does not occur there)"""
+        index = bisect_left(self.chunk_ids, chunk_id)
+        if index == len(self.chunk_ids) or self.chunk_ids[index] != chunk_id:
+            return []
+        return decode_positions(self.positions, *self._position_range(index))
+
+    def remove_range(self, start: int, stop: int):
+        """Drop every posting whose chunk id falls in [start, stop)"""
+        self.make_writable()
+        lo = bisect_left(self.chunk_ids, start)
+        hi = bisect_left(self.chunk_ids, stop, lo)
+        if lo == hi:
+            return
+        byte_start = self._position_range(lo)[0]
+        byte_stop = self._position_range(hi)[0] if hi < len(self.chunk_ids) else len(self.positions)
+        del self.chunk_ids[lo:hi]
+        del self.freqs[lo:hi]
+        del self.positions[byte_start:byte_stop]
+        self._starts = None
+
+
+def top_k(chunk_ids: np.ndarray, scores: np.ndarray, k: int) -> List[Tuple[int, float]]:
+    """Highest-scoring (chunk id, score) pairs without sorting every candidate"""
+    if k <= 0 or not len(chunk_ids):
+        return []
+    if len(chunk_ids) > k:
+        selected = np.argpartition(-scores, k - 1)[:k]
+        chunk_ids, scores = chunk_ids[selected], scores[selected]
+    order = np.argsort(-scores, kind='stable')
+    return list(zip(chunk_ids[order].tolist(), scores[order].tolist()))
+
+
+def concatenated_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """np.arange(start, start + length) for each pair, back to back"""
+    first = np.cumsum(lengths) - lengths
+    return np.repeat(starts - first, lengths) + np.arange(lengths.sum())
+
+
+class ChunkSet:
+    """Chunk ids selected by a document filter
+
+    A document's chunks have consecutive ids, so the selection is kept as
+    sorted, disjoint [start, stop) runs, like the run containers of a
+    roaring bitmap. A sorted posting list is cut to a few runs by binary
+    search; against many runs a dense bitmap, built on first use, is
+    cheaper.
+    """
+
+    def __init__(self, starts: np.ndarray, stops: np.ndarray, chunk_total: int):
+        self.starts = starts
+        self.stops = stops
+        self.chunk_total = chunk_total
+        self._bitmap = None
+
+    def __len__(self) -> int:
+        return int((self.stops - self.starts).sum())
+
+    @property
+    def bitmap(self) -> np.ndarray:
+        if self._bitmap is None:
+            edges = np.zeros(self.chunk_total + 1, dtype=np.int32)
+            edges[self.starts] += 1
+            edges[self.stops] -= 1
+            self._bitmap = np.cumsum(edges[:-1]) > 0
+        return self._bitmap
+
+    def ids(self) -> np.ndarray:
+        """Every chunk id in the set, in order"""
+        return concatenated_ranges(self.starts, self.stops - self.starts)
+
+    def select(self, chunk_ids: np.ndarray) -> np.ndarray:
+        """Positions in a sorted array of chunk ids whose ids are in the set"""
+        if not len(self.starts):
+            return np.empty(0, dtype=np.int64)
+        if len(self.starts) * RUN_SEARCH_RATIO >= len(chunk_ids):
+            return np.flatnonzero(self.bitmap[chunk_ids])
+        lo = np.searchsorted(chunk_ids, self.starts)
+        return concatenated_ranges(lo, np.searchsorted(chunk_ids, self.stops) - lo)
+
+
+class SearchIndex:
+    """Inverted index over integer chunk ids with in-place document updates"""
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+
+        # Document table
+        self.doc_names: List[Optional[str]] = []
+        self.doc_ids: Dict[str, int] = {}
+        self.doc_chunks: Dict[int, range] = {}
+        self.doc_uploaded = array('d')  # Upload time of each document, in seconds since the epoch
+        # (distinct terms, approximate bytes) by doc id, for documents added since the index was loaded
+        self.doc_footprint: Dict[int, Tuple[int, int]] = {}
+
+        # Chunk table, indexed by chunk id
+        self.chunk_doc = array('I')
+        self.chunk_offset = array('I')
+        self.chunk_text = ChunkTexts()  # or index_store.MappedChunkText for a loaded index
+        self.chunk_length = array('I')
+
+        self.postings: Dict[str, Postings] = {}
+        self.live_chunks = 0
+
+        # dense_index.DenseIndex with a row per chunk id, when dense retrieval is enabled
+        self.dense = None
+
+        # Postings of an index loaded from disk stay in the mapped file until a
+        # term is first used. The sorted term table is searched in place, so no
+        # per-process dict of the whole vocabulary is built.
+        self._mapped_terms = None  # index_store.MappedTerms: term -> row in the mapped columns
+        self._mapped_columns = None
+        # Mapped terms whose postings all went away; kept as empty Postings so
+        # the mapped row does not resurface
+        self._emptied_terms: Set[str] = set()
+        self._term_total = 0
+        self._sorted_terms = None  # Sorted keys of self.postings, rebuilt on demand
+        self.total_length = 0
+
+        # (BM25 length normalisation by chunk id, doc id by chunk id),
+        # rebuilt by refresh_statistics() after the corpus changes
+        self._statistics = None
+        self._chunk_sets: Dict[Hashable, ChunkSet] = {}  # Compiled document filters, dropped on any change
+        self.mapped_bytes = 0  # Size of the index file a loaded index is served from
+
+    @property
+    def chunk_count(self) -> int:
+        return self.live_chunks
+
+    @property
+    def term_count(self) -> int:
+        return self._term_total - len(self._emptied_terms)
+
+    @property
+    def document_count(self) -> int:
+        return len(self.doc_ids)
+
+    def documents(self) -> List[str]:
+        return list(self.doc_ids)
+
+    @property
+    def average_chunk_length(self) -> float:
+        return self.total_length / self.live_chunks if self.live_chunks else 0.0
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.doc_ids
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Approximate bytes behind the index
+
+        "heap" is what this process holds itself: postings and chunk table
+        rows written since the index was loaded (or all of them for an index
+        that was never saved), chunk text and writable embeddings. "mapped"
+        is the index file a loaded index reads from, shared with every other
+        process mapping it.
+        """
+        heap = sum(len(postings.chunk_ids) * 8 + len(postings.positions)
+                   for postings in list(self.postings.values()) if not postings.read_only)
+        heap += sum(column.itemsize * len(column) for column in (self.chunk_doc, self.chunk_offset, self.chunk_length)
+                    if isinstance(column, array))
+        heap += self.chunk_text.heap_size
+        if self.dense is not None:
+            heap += self.dense.heap_bytes
+        return {"heap": heap, "mapped": self.mapped_bytes}
+
+    def add_document(self, filename: str, chunks: Union[ChunkedText, List[str]], uploaded: float = 0.0) -> Set[str]:
+        """Append a document's chunks and postings, returning the terms it contains
+
+        A ChunkedText is tokenized in one pass over its buffer; a list of
+        chunk strings is first copied into one (ChunkedText.from_chunks).
+        """
+        if not isinstance(chunks, ChunkedText):
+            chunks = ChunkedText.from_chunks(chunks)
+
+        if filename in self.doc_ids:
+            self.remove_document(filename)
+
+        doc_id = len(self.doc_names)
+        self.doc_names.append(filename)
+        self.doc_uploaded.append(uploaded)
+        self.doc_ids[filename] = doc_id
+
+        if not isinstance(self.chunk_doc, array):
+            # The chunk table of a loaded index is a view of the mapped file until it grows
+            for name in ("chunk_doc", "chunk_offset", "chunk_length"):
+                column = array('I')
+                column.frombytes(getattr(self, name).cast('B'))
+                setattr(self, name, column)
+
+        first_chunk = len(self.chunk_text)
+        terms = set()
+        all_postings = self.postings
+        total_length = self.total_length
+        posting_rows = 0
+
+        self.chunk_text.extend(chunks)
+
+        for offset, tokens in enumerate(chunks.tokens()):
+            # New chunk ids are always the largest so far, so postings stay sorted
+            chunk_id = first_chunk + offset
+            self.chunk_doc.append(doc_id)
+            self.chunk_offset.append(offset)
+
+            occurrences_by_term = token_occurrences(tokens)
+            chunk_length = 0
+            posting_rows += len(occurrences_by_term)
+
+            for term, occurrences in occurrences_by_term.items():
+                postings = all_postings.get(term)
+                if postings is None:
+                    postings = self.get_postings(term)
+                    if postings is None:
+                        postings = all_postings[term] = Postings()
+                        self._term_total += 1
+                        self._sorted_terms = None
+                if postings.read_only:
+                    postings.make_writable()
+                # Postings.append() inlined: this loop runs once per distinct term per chunk
+                postings.chunk_ids.append(chunk_id)
+                if type(occurrences) is int:
+                    chunk_length += 1
+                    postings.freqs.append(1)
+                    if occurrences < 0x80:
+                        postings.positions.append(occurrences)
+                    else:
+                        postings.positions += encode_positions([occurrences])
+                else:
+                    chunk_length += len(occurrences)
+                    postings.freqs.append(len(occurrences))
+                    postings.positions += encode_positions(occurrences)
+            self.chunk_length.append(chunk_length)
+            self.total_length += chunk_length
+            terms.update(occurrences_by_term)
+
+        if self._emptied_terms:
+            self._emptied_terms -= terms
+
+        if self.dense is not None:
+            self.dense.add(first_chunk, chunks)
+
+        self.doc_chunks[doc_id] = range(first_chunk, first_chunk + len(chunks))
+        self.live_chunks += len(chunks)
+        # Text, 28 bytes of chunk table and offsets per chunk, 8 bytes per posting
+        # and about one byte per token position
+        self.doc_footprint[doc_id] = (len(terms), len(chunks.text) + 28 * len(chunks) + 8 * posting_rows +
+                                      self.total_length - total_length)
+        self._statistics = None
+        self._chunk_sets.clear()
+        return terms
+
+    def remove_document(self, filename: str) -> Set[str]:
+        """Drop a document's postings, returning the terms it contained"""
+        doc_id = self.doc_ids.pop(filename, None)
+        if doc_id is None:
+            return set()
+
+        chunk_ids = self.doc_chunks.pop(doc_id)
+        self.doc_footprint.pop(doc_id, None)
+
+        # Re-deriving the term set costs one pass over this document, which is
+        # far cheaper than keeping a term set per document in memory
+        terms = {term for tokens in self.chunk_text.document(chunk_ids).tokens()
+                 for term in tokens if len(term) >= MIN_TERM_LENGTH}
+
+        # Only the posting lists of terms this document contained can change
+        for term in terms:
+            postings = self.get_postings(term)
+            postings.remove_range(chunk_ids.start, chunk_ids.stop)
+            if not postings:
+                if self._mapped_terms is not None and self._mapped_terms.find(term) is not None:
+                    self._emptied_terms.add(term)
+                else:
+                    del self.postings[term]
+                    self._sorted_terms = None
+                    self._term_total -= 1
+
+        self.chunk_text.clear(chunk_ids)
+        for chunk_id in chunk_ids:
+            self.total_length -= self.chunk_length[chunk_id]
+        if self.dense is not None:
+            self.dense.remove(chunk_ids)
+        self.doc_names[doc_id] = None
+        self.live_chunks -= len(chunk_ids)
+        self._statistics = None
+        self._chunk_sets.clear()
+        return terms
+
+    def refresh_statistics(self):
+        """Precompute BM25 chunk-length normalisation for the current corpus
+
+        IDF only depends on a term's posting count, so it is derived when a
+        term is scored rather than kept per term.
+        """
+        lengths = np.asarray(self.chunk_length, dtype=np.float32)
+        average = self.average_chunk_length or 1.0
+        length_norm = self.k1 * (1 - self.b + self.b * lengths / average)
+        if isinstance(self.chunk_doc, array):
+            # Copied: a numpy view would stop the array from growing
+            chunk_doc = np.array(self.chunk_doc, dtype=np.int64)
+        else:
+            chunk_doc = np.frombuffer(self.chunk_doc, dtype=np.uint32)
+        self._statistics = (length_norm, chunk_doc)
+
+    def idf(self, document_frequency: int) -> float:
+        total_chunks = self.live_chunks
+        return math.log(1 + (total_chunks - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def _current_statistics(self):
+        if self._statistics is None:
+            self.refresh_statistics()
+        return self._statistics
+
+    def select_documents(self, doc_ids: Iterable[int]) -> ChunkSet:
+        """The chunks of the given documents; ids of removed documents are ignored"""
+        runs = sorted((chunk_ids.start, chunk_ids.stop) for chunk_ids in map(self.doc_chunks.get, doc_ids)
+                      if chunk_ids)
+        bounds = np.array(runs, dtype=np.int64).reshape(-1, 2)
+        return ChunkSet(bounds[:, 0], bounds[:, 1], len(self.chunk_doc))
+
+    def cached_chunk_set(self, key: Hashable, documents: Callable[[], Iterable[int]]) -> ChunkSet:
+        """select_documents(documents()), compiled once per corpus state for each key"""
+        chunk_set = self._chunk_sets.get(key)
+        if chunk_set is None:
+            if len(self._chunk_sets) >= CHUNK_SET_CACHE_SIZE:
+                self._chunk_sets.clear()
+            chunk_set = self._chunk_sets[key] = self.select_documents(documents())
+        return chunk_set
+
+    def score(self, terms: List[str],
+              document_filter: Union[ChunkSet, Callable[[str], bool], None] = None
+              ) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25 scores for every chunk containing at least one query term
+
+        Returns parallel arrays of chunk ids and scores. A document filter,
+        either a ChunkSet or a predicate on filenames, limits scoring to the
+        chunks of the documents it accepts.
+        """
+        return self.score_batch([terms], [document_filter])[0]
+
+    def score_batch(self, queries: List[List[str]],
+                    document_filters: Optional[List[Union[ChunkSet, Callable[[str], bool], None]]] = None,
+                    required_phrases: Optional[List[List[List[Tuple[str, int]]]]] = None,
+                    expansions: Optional[List[Dict[str, List[Tuple[str, float]]]]] = None,
+                    stage_times: Optional[Dict[str, float]] = None
+                    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """BM25 scores for several queries at once, as score() would return them
+
+        Each distinct term's postings are fetched and weighted once for the
+        whole batch (once per distinct filter for filtered queries); every
+        query then only sums the contributions it needs. Postings are cut to
+        a query's filter before they are scored, so a narrow filter costs
+        little more than the chunks it lets through.
+        A query's required phrases (term_offsets() lists) drop every chunk
+        that does not contain all of them. A query word listed in the
+        query's expansions is scored as its (term, weight) alternatives
+        instead, each chunk counting its best weighted alternative.
+        Seconds spent reading postings and scoring them are added to
+        stage_times["postings"] and stage_times["scoring"] when it is given.
+        """
+        fetching = 0.0
+        started = time.perf_counter()
+        length_norm, chunk_doc = self._current_statistics()
+        k1 = self.k1
+        if document_filters is None:
+            document_filters = [None] * len(queries)
+        if required_phrases is None:
+            required_phrases = [()] * len(queries)
+        if expansions is None:
+            expansions = [{}] * len(queries)
+
+        predicates = {}
+        chunk_sets = []
+        for document_filter in document_filters:
+            if callable(document_filter):
+                if document_filter not in predicates:
+                    predicates[document_filter] = self.select_documents(
+                        doc_id for doc_id, name in enumerate(self.doc_names)
+                        if name is not None and document_filter(name))
+                document_filter = predicates[document_filter]
+            chunk_sets.append(document_filter)
+
+        # BM25 contribution of each distinct term to each chunk it occurs in, per filter
+        term_scores = {}
+        for terms, chunk_set, alternatives in zip(queries, chunk_sets, expansions):
+            query_terms = set(terms)
+            query_terms.update(term for expanded in alternatives.values() for term, _ in expanded)
+            for term in query_terms:
+                if (term, chunk_set) in term_scores:
+                    continue
+                fetch_started = time.perf_counter()
+                postings = self.get_postings(term)
+                if postings is None:
+                    fetching += time.perf_counter() - fetch_started
+                    continue
+                if chunk_set is None:
+                    chunk_ids = np.array(postings.chunk_ids, dtype=np.int64)
+                    freqs = np.array(postings.freqs, dtype=np.float32)
+                else:
+                    # Indexing copies, so no view of a growable array outlives this loop
+                    selected = chunk_set.select(np.frombuffer(postings.chunk_ids, dtype=np.uint32))
+                    chunk_ids = np.frombuffer(postings.chunk_ids, dtype=np.uint32)[selected].astype(np.int64)
+                    freqs = np.frombuffer(postings.freqs, dtype=np.uint32)[selected].astype(np.float32)
+                fetching += time.perf_counter() - fetch_started
+                term_scores[term, chunk_set] = (chunk_ids, self.idf(len(postings)) * freqs * (k1 + 1) /
+                                                (freqs + length_norm[chunk_ids]))
+
+        results = []
+        for terms, chunk_set, phrases, alternatives in zip(queries, chunk_sets, required_phrases, expansions):
+            id_parts = []
+            score_parts = []
+            for term, query_freq in Counter(terms).items():
+                if term in alternatives:
+                    chunk_ids, scores = best_alternative(
+                        [(term_scores[expanded, chunk_set][0], term_scores[expanded, chunk_set][1] * weight)
+                         for expanded, weight in alternatives[term] if (expanded, chunk_set) in term_scores])
+                elif (term, chunk_set) in term_scores:
+                    chunk_ids, scores = term_scores[term, chunk_set]
+                else:
+                    continue
+                id_parts.append(chunk_ids)
+                score_parts.append(scores * query_freq if query_freq > 1 else scores)
+
+            if not id_parts:
+                results.append((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)))
+                continue
+
+            chunk_ids = np.concatenate(id_parts)
+            scores = np.concatenate(score_parts).astype(np.float64)
+            if len(id_parts) > 1:
+                if len(chunk_ids) * DENSE_ACCUMULATOR_RATIO >= len(chunk_doc):
+                    # BM25 contributions are always positive, so a non-zero total marks a match
+                    totals = np.bincount(chunk_ids, weights=scores, minlength=len(chunk_doc))
+                    chunk_ids = np.flatnonzero(totals)
+                    scores = totals[chunk_ids]
+                else:
+                    chunk_ids, inverse = np.unique(chunk_ids, return_inverse=True)
+                    scores = np.bincount(inverse, weights=scores)
+
+            for phrase in phrases:
+                keep = np.isin(chunk_ids, self.phrase_chunks(phrase), assume_unique=True)
+                chunk_ids, scores = chunk_ids[keep], scores[keep]
+
+            results.append((chunk_ids, scores))
+
+        if stage_times is not None:
+            stage_times["postings"] = stage_times.get("postings", 0.0) + fetching
+            stage_times["scoring"] = stage_times.get("scoring", 0.0) + time.perf_counter() - started - fetching
+        return results
+
+    def attach_mapped_postings(self, terms, term_start, term_count, chunk_ids, freqs,
+                               term_position_start, positions):
+        """Serve postings from mapped columns, materialising each term on first use
+
+        `terms` is the sorted term table (a sequence of str with a find(term)
+        method returning the term's row, or None).
+        """
+        self._mapped_terms = terms
+        self._term_total = len(terms)
+        self._mapped_columns = (term_start, term_count, chunk_ids, freqs, term_position_start, positions)
+
+    def get_postings(self, term: str) -> Optional[Postings]:
+        postings = self.postings.get(term)
+        if postings is None and self._mapped_terms is not None:
+            row = self._mapped_terms.find(term)
+            if row is None:
+                return None
+            term_start, term_count, chunk_ids, freqs, term_position_start, positions = self._mapped_columns
+            start, stop = term_start[row], term_start[row] + term_count[row]
+            postings = self.postings[term] = Postings(
+                chunk_ids[start:stop], freqs[start:stop],
+                positions[term_position_start[row]:term_position_start[row + 1]])
+        return postings
+
+    def chunk_positions(self, chunk_id: int, terms) -> Dict[str, List[int]]:
+        """Token positions of each of the terms in one chunk"""
+        positions = {}
+        for term in terms:
+            postings = self.get_postings(term)
+            if postings is not None:
+                positions[term] = postings.positions_in(chunk_id)
+        return positions
+
+    def phrase_chunks(self, phrase: List[Tuple[str, int]]) -> np.ndarray:
+        """Sorted ids of the chunks containing the phrase, given as term_offsets() pairs
+
+        Candidates come from intersecting the terms' chunk ids; positions
+        are only decoded for chunks that contain every term.
+        """
+        all_postings = [self.get_postings(term) for term in dict(phrase)]
+        if not all_postings or any(postings is None for postings in all_postings):
+            return np.empty(0, dtype=np.int64)
+
+        candidates = np.array(all_postings[0].chunk_ids, dtype=np.int64)
+        for postings in all_postings[1:]:
+            candidates = np.intersect1d(candidates, np.array(postings.chunk_ids, dtype=np.int64),
+                                        assume_unique=True)
+        if len(phrase) == 1:
+            return candidates
+
+        terms = list(dict(phrase))
+        matches = [chunk_id for chunk_id in candidates.tolist()
+                   if phrase_starts(phrase, self.chunk_positions(chunk_id, terms))]
+        return np.array(matches, dtype=np.int64)
+
+    def _term_list(self) -> List[str]:
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings)
+        return self._sorted_terms
+
+    def document_frequency(self, term: str) -> int:
+        """Number of chunks containing the term"""
+        postings = self.postings.get(term)
+        if postings is not None:
+            return len(postings)
+        if self._mapped_terms is not None:
+            row = self._mapped_terms.find(term)
+            if row is not None:
+                return self._mapped_columns[1][row]
+        return 0
+
+    def _most_frequent(self, terms, limit: int) -> List[str]:
+        ranked = sorted((-self.document_frequency(term), term) for term in terms)
+        return [term for negative_frequency, term in ranked if negative_frequency][:limit]
+
+    def prefix_terms(self, prefix: str, limit: int) -> List[str]:
+        """Up to `limit` indexed terms starting with prefix, those in the most chunks first"""
+        end = prefix_end(prefix)
+        terms = self._term_list()
+        in_memory = terms[bisect_left(terms, prefix):bisect_left(terms, end)]
+        candidates = set(in_memory)
+        mapped = self._mapped_terms
+        if mapped is not None and limit > 0:
+            start, stop = mapped.lower_bound(prefix), mapped.lower_bound(end)
+            rows = range(start, stop)
+            if len(rows) > limit:
+                # Decode only the `limit` most frequent rows, ties in term order like the final ranking;
+                # rows edited in memory are among the candidates already, with their current counts
+                counts = np.array(self._mapped_columns[1][start:stop], dtype=np.int64)
+                for term in in_memory:
+                    row = mapped.find(term) if not self.postings[term].read_only else None
+                    if row is not None:
+                        counts[row - start] = 0
+                threshold = np.partition(counts, len(counts) - limit)[len(counts) - limit]
+                above = np.flatnonzero(counts > threshold)
+                ties = np.flatnonzero(counts == threshold)[:limit - len(above)]
+                rows = (start + np.concatenate([above, ties])).tolist()
+            candidates.update(mapped[row] for row in rows)
+        return self._most_frequent(candidates, limit)
+
+    def fuzzy_terms(self, word: str, max_edits: int, limit: int,
+                    prefix_length: int = 0) -> List[Tuple[str, int]]:
+        """Up to `limit` (term, edits) within max_edits of word, closest then most frequent first
+
+        Only terms sharing the word's first prefix_length characters are
+        considered, which keeps the lookup cheap on a large vocabulary.
+        """
+        matches = {}
+        if self._mapped_terms is not None:
+            matches.update(fuzzy_matches(self._mapped_terms, self._mapped_terms.lower_bound,
+                                         word, max_edits, prefix_length))
+        terms = self._term_list()
+        matches.update(fuzzy_matches(terms, partial(bisect_left, terms), word, max_edits, prefix_length))
+        ranked = sorted((edits, -self.document_frequency(term), term) for term, edits in matches.items())
+        return [(term, edits) for edits, negative_frequency, term in ranked if negative_frequency][:limit]
+
+    @property
+    def mapped_postings(self):
+        """(term table, columns) given to attach_mapped_postings(), or None for an index built in memory"""
+        return None if self._mapped_terms is None else (self._mapped_terms, self._mapped_columns)
+
+    def saved_postings(self) -> Iterator[Union[range, Tuple[str, Postings]]]:
+        """Every term's postings in sorted term order, for saving
+
+        Runs of mapped terms whose postings have not changed come as the
+        range of their rows in the mapped columns, to be copied from there
+        as they are; every other term with postings comes as (term, postings).
+        """
+        mapped = self._mapped_terms
+        row = 0
+        for term in sorted(term for term, postings in self.postings.items() if not postings.read_only):
+            if mapped is not None:
+                found = mapped.lower_bound(term, row)
+                if found > row:
+                    yield range(row, found)
+                row = found + 1 if found < len(mapped) and mapped[found] == term else found
+            postings = self.postings[term]
+            if postings:
+                yield term, postings
+        if mapped is not None and row < len(mapped):
+            yield range(row, len(mapped))
+
+    def all_terms(self) -> List[str]:
+        """Every indexed term, in sorted order"""
+        terms = set(self.postings)
+        if self._mapped_terms is not None:
+            terms.update(self._mapped_terms)
+        return sorted(terms - self._emptied_terms)
+
+    def chunk_filename(self, chunk_id: int) -> str:
+        return self.doc_names[self.chunk_doc[chunk_id]]
+
+    def get_chunk(self, chunk_id: int) -> Tuple[str, int, str]:
+        """Return (filename, chunk offset within the document, chunk text)"""
+        return (self.doc_names[self.chunk_doc[chunk_id]],
+                self.chunk_offset[chunk_id],
+                self.chunk_text[chunk_id])
+
+    def document_chunks(self, filename: str) -> List[str]:
+        doc_id = self.doc_ids.get(filename)
+        if doc_id is None:
+            return []
+        return [self.chunk_text[chunk_id] for chunk_id in self.doc_chunks[doc_id]]
+
+    def document_footprint(self, filename: str) -> Optional[Tuple[int, int]]:
+        """(distinct terms, approximate bytes) of a document added since the index was loaded"""
+        return self.doc_footprint.get(self.doc_ids.get(filename))
+
+    def document_chunk(self, filename: str, chunk_index: int) -> Optional[str]:
+        """Text of a document's chunk_index-th chunk, or None if there is no such chunk"""
+        chunk_ids = self.doc_chunks.get(self.doc_ids.get(filename))
+        if chunk_ids is None or not 0 <= chunk_index < len(chunk_ids):
+            return None
+        return self.chunk_text[chunk_ids[chunk_index]]
+
+    def memory_bytes(self) -> int:
+        """Approximate footprint of the term dictionary, postings and chunk table"""
+        size = sys.getsizeof(self.postings) + sys.getsizeof(self._emptied_terms)
+        for term, postings in self.postings.items():
+            size += sys.getsizeof(term) + sys.getsizeof(postings)
+            size += sys.getsizeof(postings.chunk_ids) + sys.getsizeof(postings.freqs)
+            size += sys.getsizeof(postings.positions)
+        size += sys.getsizeof(self.chunk_doc) + sys.getsizeof(self.chunk_offset)
+        size += sys.getsizeof(self.chunk_length)
+        size += sys.getsizeof(self.chunk_text)
+        return size
@@ -0,0 +1,60 @@
+"""
+Query-focused snippets with highlight offsets
+
+A snippet is the window of a chunk holding the most query matches, cut at
+word boundaries. Which tokens match comes from the token positions the
+index already returned for the hit (prefix and typo expansions included),
+so the query is never compared with the text again; the chunk is only
+scanned for where its words start and end. Highlights are [start, end)
+character offsets into the snippet string.
+"""
+
+from itertools import islice
+from typing import Iterable, List, Tuple
+
+from search_index import WORD_PATTERN
+
+ELLIPSIS = "…"
+
+
+def best_window(matches: List[int], window: int) -> Tuple[int, int]:
+    """(first, last) indexes into sorted match positions, fitting the most matches in `window` tokens"""
+    best = (0, 0)
+    last = 0
+    for first in range(len(matches)):
+        while last + 1 < len(matches) and matches[last + 1] < matches[first] + window:
+            last += 1
+        if last - first > best[1] - best[0]:
+            best = (first, last)
+    return best
+
+
+def make_snippet(text: str, positions: Iterable[int], window: int) -> Tuple[str, List[Tuple[int, int]]]:
+    """(snippet, highlights) for a chunk and the token positions that matched the query
+
+    Without matches the snippet is the start of the chunk.
+    """
+    matches = sorted(set(positions))
+    start = 0
+    if matches:
+        first, last = best_window(matches, window)
+        # Centre the matched stretch in the window
+        start = max(0, matches[first] - (window - (matches[last] - matches[first] + 1)) // 2)
+        matches = matches[first:last + 1]
+
+    # Word spans only as far as one word past the window, which tells whether the chunk goes on
+    spans = [match.span() for match in islice(WORD_PATTERN.finditer(text), start + window + 1)]
+    if len(spans) <= start + window:
+        start = max(0, min(start, len(spans) - window))  # The chunk ends first; pull the window back
+    stop = min(start + window, len(spans))
+    if stop <= start:
+        return text, []
+
+    text_start = spans[start][0] if start else 0
+    text_end = spans[stop - 1][1] if stop < len(spans) else len(text)
+    prefix = ELLIPSIS if text_start else ""
+    suffix = ELLIPSIS if text_end < len(text) else ""
+    offset = len(prefix) - text_start
+    highlights = [(spans[position][0] + offset, spans[position][1] + offset)
+                  for position in matches if start <= position < stop]
+    return prefix + text[text_start:text_end] + suffix, highlights
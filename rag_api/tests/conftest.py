@@ -0,0 +1,9 @@
+import os
+import sys
+
+RAG_API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The modules import each other by name, and main_optimized mounts static/
+# relative to the working directory, as when the server runs from rag_api/
+sys.path.insert(0, RAG_API_DIR)
+os.chdir(RAG_API_DIR)
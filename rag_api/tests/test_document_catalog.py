@@ -0,0 +1,17 @@
+"""Document catalog: totals, manifest round trips and the files whose extraction failed"""
+
+from document_catalog import DocumentCatalog, DocumentEntry
+
+
+def test_failed_and_empty_files_round_trip_through_the_manifest():
+    catalog = DocumentCatalog({
+        "report.pdf": DocumentEntry("aa", 2000, 1.0, 4, 300, 9000),
+        "blank.txt": DocumentEntry("bb", 0, 2.0, 0, 0, 0, "empty"),
+        "broken.pdf": DocumentEntry("cc", 500, 3.0, 0, 0, 0, "failed", "Text extraction failed"),
+    })
+    assert (len(catalog), catalog.total_size_bytes, catalog.total_chunks) == (3, 2500, 4)
+    assert catalog.failures() == {"broken.pdf": ("cc", "Text extraction failed")}
+
+    loaded = DocumentCatalog.from_manifest(catalog.to_manifest())
+    assert loaded.entries == catalog.entries
+    assert loaded.total_index_bytes == catalog.total_index_bytes == 9000
@@ -0,0 +1,50 @@
+"""Saving and loading indexes: a saved edit must read back like an index built from scratch"""
+
+import random
+
+import index_store
+from search_index import SearchIndex
+
+WORDS = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "theta", "iota", "kappa", "lambda", "sigma", "omega"]
+
+
+def random_document(rng: random.Random, marker: str) -> list:
+    """Chunks of shared words, plus a word only this document has so its terms come and go with it"""
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 60))) + f" {marker}"
+            for _ in range(rng.randint(1, 5))]
+
+
+def postings_by_term(index: SearchIndex) -> dict:
+    return {term: (list(index.get_postings(term).chunk_ids), list(index.get_postings(term).freqs),
+                   bytes(index.get_postings(term).positions))
+            for term in index.all_terms()}
+
+
+def test_saved_edits_match_an_index_built_from_scratch(tmp_path):
+    rng = random.Random(3)
+    documents = {f"doc_{number}.txt": random_document(rng, f"only{number}") for number in range(12)}
+    index = SearchIndex()
+    for filename, chunks in documents.items():
+        index.add_document(filename, chunks)
+    path = index_store.save_index(index, str(tmp_path), {filename: filename for filename in documents}, 1)
+
+    # Edit the loaded index, so most postings stay in the mapped file and are copied from it in runs
+    for generation in range(2, 6):
+        loaded, _ = index_store.load_index(path)
+        for filename in rng.sample(sorted(documents), 2):
+            loaded.remove_document(filename)
+            del documents[filename]
+        for number in range(2):
+            filename = f"new_{generation}_{number}.txt"
+            documents[filename] = random_document(rng, f"new{generation}x{number}")
+            loaded.add_document(filename, documents[filename])
+        path = index_store.save_index(loaded, str(tmp_path), {filename: filename for filename in documents},
+                                      generation)
+
+        saved, _ = index_store.load_index(path)
+        expected = SearchIndex()
+        for filename in saved.documents():
+            expected.add_document(filename, documents[filename])
+        assert sorted(saved.documents()) == sorted(documents)
+        assert postings_by_term(saved) == postings_by_term(expected)
+        assert saved.term_count == expected.term_count
@@ -0,0 +1,53 @@
+"""Request validation for the query endpoints; no index is loaded for a rejected request"""
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+import main_optimized
+from main_optimized import QueryRequest
+
+client = TestClient(main_optimized.app)
+
+
+@pytest.mark.parametrize("top_k", [None, 0, -1, -5])
+def test_query_request_rejects_top_k_below_one(top_k):
+    with pytest.raises(ValidationError):
+        QueryRequest(query="retrieval", top_k=top_k)
+
+
+def test_query_request_top_k_defaults_to_three():
+    assert QueryRequest(query="retrieval").top_k == 3
+
+
+@pytest.mark.parametrize("top_k", [None, 0, -1])
+def test_query_endpoints_reject_top_k_below_one(top_k):
+    assert client.post("/query", json={"query": "retrieval", "top_k": top_k}).status_code == 422
+    assert client.post("/query?stream=sse", json={"query": "retrieval", "top_k": top_k}).status_code == 422
+    batch = {"queries": [{"query": "retrieval"}, {"query": "search", "top_k": top_k}]}
+    assert client.post("/query/batch", json=batch).status_code == 422
+
+
+@pytest.mark.parametrize("top_k", [0, -2])
+def test_paginated_query_rejects_top_k_below_one(top_k):
+    # A zero page size would hand back the same cursor forever, a negative one a cursor that moves backwards
+    assert client.post("/query", json={"query": "retrieval", "top_k": top_k, "paginate": True}).status_code == 422
+
+
+def test_cursor_round_trips():
+    cursor = main_optimized.encode_cursor("key", 4, 30)
+    assert main_optimized.decode_cursor(cursor) == ("key", 4, 30)
+
+
+@pytest.mark.parametrize("cursor", [
+    main_optimized.encode_cursor("key", 4, -3),
+    main_optimized.encode_cursor("key", 4, 2.5),
+    "not a cursor",
+    "",
+])
+def test_invalid_cursors_are_refused(cursor):
+    with pytest.raises(HTTPException) as raised:
+        main_optimized.decode_cursor(cursor)
+    assert raised.value.status_code == 400
+    assert client.post("/query", json={"query": "retrieval", "cursor": cursor}).status_code == 400
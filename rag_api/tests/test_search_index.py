@@ -0,0 +1,158 @@
+"""Search index encodings and lookups, checked against brute-force references on random inputs"""
+
+import random
+from array import array
+from bisect import bisect_left
+from functools import partial
+
+import pytest
+
+import index_store
+from search_index import (SearchIndex, decode_positions, encode_positions, fuzzy_matches, position_starts,
+                          token_positions, tokenize)
+
+WORDS = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta", "iota", "kappa", "of", "to"]
+
+
+def random_positions(rng: random.Random) -> list:
+    """Sorted distinct positions, mixing one-byte gaps with gaps that need two to five varint bytes"""
+    position = rng.choice([0, 0, 1, 127, 128, 16383, 16384])
+    positions = [position]
+    for _ in range(rng.randint(0, 20)):
+        position += rng.choice([1, 1, 2, 127, 128, 300, 16384, 2 ** 21, 2 ** 28])
+        positions.append(position)
+    return positions
+
+
+def random_chunks(rng: random.Random, count: int) -> list:
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 200))) for _ in range(count)]
+
+
+def random_terms(rng: random.Random, count: int, shortest: int = 1) -> list:
+    """Words over a small alphabet, so many share prefixes and lie a few edits apart"""
+    return [("".join(rng.choice("abcd") for _ in range(rng.randint(shortest, 7)))) for _ in range(count)]
+
+
+def edit_distance(first: str, second: str) -> int:
+    """Edits between two strings, counting an adjacent transposition as one"""
+    rows = [list(range(len(second) + 1))]
+    for i in range(1, len(first) + 1):
+        row = [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            row[j] = min(rows[-1][j] + 1, row[j - 1] + 1, rows[-1][j - 1] + (first[i - 1] != second[j - 1]))
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]:
+                row[j] = min(row[j], rows[-2][j - 2] + 1)
+        rows.append(row)
+    return rows[-1][-1]
+
+
+def brute_force_fuzzy(distances: dict, word: str, max_edits: int, prefix_length: int) -> dict:
+    """Terms within max_edits of word sharing its prefix, from every term's distance to the word"""
+    return {term: edits for term, edits in distances.items()
+            if edits <= max_edits and term.startswith(word[:prefix_length])}
+
+
+def assert_positions_match(index: SearchIndex, chunks_by_id: dict):
+    """Every term's positions in every chunk, against the chunk's own tokens"""
+    for chunk_id, chunk in chunks_by_id.items():
+        expected = token_positions(tokenize(chunk))
+        for term in {word for word in WORDS if len(word) >= 3}:
+            assert index.chunk_positions(chunk_id, [term]).get(term, []) == expected.get(term, [])
+
+
+@pytest.mark.parametrize("positions", [[0], [127], [128], [0, 1], [0, 128, 129], [2 ** 32 - 1], [5, 2 ** 35]])
+def test_position_edge_cases_round_trip(positions):
+    encoded = encode_positions(positions)
+    assert decode_positions(encoded, 0, len(encoded)) == positions
+
+
+def test_positions_round_trip_and_posting_starts():
+    rng = random.Random(12)
+    for _ in range(200):
+        lists = [random_positions(rng) for _ in range(rng.randint(1, 30))]
+        encoded = [encode_positions(positions) for positions in lists]
+        data = b"".join(encoded)
+        starts = position_starts(data, array('I', map(len, lists)))
+        expected_start = 0
+        for number, (positions, chunk) in enumerate(zip(lists, encoded)):
+            assert starts[number] == expected_start
+            assert decode_positions(data, expected_start, expected_start + len(chunk)) == positions
+            expected_start += len(chunk)
+
+
+def test_chunk_positions_follow_adds_removes_and_saving(tmp_path):
+    rng = random.Random(7)
+    index = SearchIndex()
+    documents = {f"doc_{number}.txt": random_chunks(rng, rng.randint(1, 6)) for number in range(8)}
+    for filename, chunks in documents.items():
+        index.add_document(filename, chunks)
+    # Long enough that positions need more than one varint byte
+    documents["long.txt"] = [" ".join(rng.choice(WORDS) for _ in range(5000))]
+    index.add_document("long.txt", documents["long.txt"])
+    index.remove_document("doc_3.txt")
+    del documents["doc_3.txt"]
+
+    def chunks_by_id(index: SearchIndex) -> dict:
+        return {chunk_id: documents[filename][offset]
+                for filename in index.documents()
+                for offset, chunk_id in enumerate(index.doc_chunks[index.doc_ids[filename]])}
+
+    assert_positions_match(index, chunks_by_id(index))
+
+    path = index_store.save_index(index, str(tmp_path), {filename: filename for filename in documents}, 1)
+    loaded, _ = index_store.load_index(path)
+    assert_positions_match(loaded, chunks_by_id(loaded))
+
+    # Mapped postings are copied out on their first change
+    loaded.remove_document("doc_5.txt")
+    del documents["doc_5.txt"]
+    documents["doc_new.txt"] = random_chunks(rng, 3)
+    loaded.add_document("doc_new.txt", documents["doc_new.txt"])
+    assert_positions_match(loaded, chunks_by_id(loaded))
+
+
+def test_fuzzy_matches_agree_with_brute_force():
+    rng = random.Random(14)
+    terms = sorted(set(random_terms(rng, 400)))
+    lower_bound = partial(bisect_left, terms)
+    words = random_terms(rng, 60) + rng.sample(terms, 20) + ["", "a", "dcba", "abcdabcdab"]
+    for word in words:
+        distances = {term: edit_distance(term, word) for term in terms}
+        for max_edits in range(4):
+            # Beyond the word's length the prefix is the whole word
+            for prefix_length in range(len(word) + 3):
+                found = dict(fuzzy_matches(terms, lower_bound, word, max_edits, prefix_length))
+                assert found == brute_force_fuzzy(distances, word, max_edits, prefix_length), \
+                    (word, max_edits, prefix_length)
+
+
+def test_term_lookups_agree_with_brute_force_in_memory_mapped_and_edited(tmp_path):
+    rng = random.Random(15)
+    vocabulary = sorted(set(random_terms(rng, 300, shortest=3)))
+    documents = {f"doc_{number}.txt": [" ".join(rng.choices(vocabulary, k=rng.randint(1, 40)))
+                                        for _ in range(rng.randint(1, 4))]
+                 for number in range(30)}
+    index = SearchIndex()
+    for filename, chunks in documents.items():
+        index.add_document(filename, chunks)
+    path = index_store.save_index(index, str(tmp_path), {filename: filename for filename in documents}, 1)
+    mapped, _ = index_store.load_index(path)
+    edited, _ = index_store.load_index(path)
+    for filename in rng.sample(sorted(documents), 8):
+        edited.remove_document(filename)
+    edited.add_document("new.txt", [" ".join(rng.choices(vocabulary, k=60)) + " dddddd"])
+
+    for current in (index, mapped, edited):
+        frequencies = {term: current.document_frequency(term) for term in current.all_terms()}
+        for word in rng.sample(vocabulary, 25) + random_terms(rng, 15, shortest=3):
+            distances = {term: edit_distance(term, word) for term in frequencies}
+            for max_edits in range(3):
+                for prefix_length in (0, 1, 2, len(word), len(word) + 1):
+                    matches = brute_force_fuzzy(distances, word, max_edits, prefix_length)
+                    expected = sorted(matches.items(), key=lambda item: (item[1], -frequencies[item[0]], item[0]))
+                    assert current.fuzzy_terms(word, max_edits, 5, prefix_length) == expected[:5]
+            for prefix in {word[:1], word[:2], word, word + "a"}:
+                expected = sorted((term for term in frequencies if term.startswith(prefix)),
+                                  key=lambda term: (-frequencies[term], term))
+                for limit in (1, 4):
+                    assert current.prefix_terms(prefix, limit) == expected[:limit]
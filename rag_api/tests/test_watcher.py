@@ -0,0 +1,55 @@
+"""Watching data/ with several worker processes: one watcher, and changes another worker indexed are not redone"""
+
+import time
+
+import pytest
+
+import index_store
+import main_optimized
+from ingestion import FileChange
+
+
+def test_only_one_worker_process_watches_data(tmp_path, monkeypatch):
+    started = []
+    monkeypatch.setattr(main_optimized.ingestion, "start", lambda: started.append(True))
+    monkeypatch.setattr(main_optimized, "watching", False)
+    monkeypatch.setattr(main_optimized, "watcher_lock",
+                        index_store.StorageLock(str(tmp_path), index_store.WATCHER_LOCK_FILE))
+    # flock() locks belong to the open file, so a second lock object stands in for another process
+    other_worker = index_store.StorageLock(str(tmp_path), index_store.WATCHER_LOCK_FILE)
+    assert other_worker.acquire(blocking=False)
+
+    assert not main_optimized.watch_data_dir()
+    assert started == []
+
+    other_worker.release()
+    assert main_optimized.watch_data_dir()
+    assert started == [True]
+    assert not other_worker.acquire(blocking=False)
+    main_optimized.watcher_lock.release()
+
+
+@pytest.fixture
+def scratch_corpus(tmp_path, monkeypatch):
+    """An empty data/ and storage/ in a scratch directory, served from an empty snapshot"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    monkeypatch.setattr(main_optimized, "snapshot", main_optimized.snapshot)
+    monkeypatch.setattr(main_optimized, "index_initialized", True)
+    yield tmp_path / "data"
+    main_optimized.query_cache.clear()
+
+
+def test_a_change_another_worker_indexed_is_not_extracted_again(scratch_corpus, monkeypatch):
+    (scratch_corpus / "alpha.txt").write_text("alpha retrieval notes")
+    behind = main_optimized.snapshot
+    main_optimized.add_document("alpha.txt")
+    generation = main_optimized.snapshot.generation
+    # This worker has not looked at storage/ since the other one published
+    monkeypatch.setattr(main_optimized, "snapshot", behind)
+
+    change = FileChange("alpha.txt", time.monotonic())
+    main_optimized.extract_change(change)
+    assert change.outcome == "unchanged"
+    assert change.content is None
+    assert main_optimized.snapshot.generation == generation
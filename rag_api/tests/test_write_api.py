@@ -0,0 +1,113 @@
+"""Uploads and deletes against a full indexing queue: rejected before data/ or the index is touched"""
+
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main_optimized
+from executors import BoundedQueue, QueueFullError
+
+client = TestClient(main_optimized.app)
+
+
+def test_reservation_holds_a_slot_until_used_or_released():
+    queue = BoundedQueue("test", ThreadPoolExecutor(max_workers=1), max_pending=1)
+    with queue.reserve() as slot:
+        with pytest.raises(QueueFullError):
+            queue.submit(lambda: None)
+    # Given back unused
+    with queue.reserve() as slot:
+        assert slot.submit(lambda: 5).result() == 5
+    assert queue.stats()["pending"] == 0
+    assert queue.stats()["rejected"] == 1
+
+
+@pytest.fixture
+def full_indexing_queue(tmp_path, monkeypatch):
+    """A scratch data/ and an indexing queue whose only slot is taken by a blocked job"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    queue = BoundedQueue("indexing", ThreadPoolExecutor(max_workers=1), max_pending=1)
+    release = threading.Event()
+    queue.submit(release.wait)
+    monkeypatch.setattr(main_optimized, "indexing_queue", queue)
+    yield tmp_path / "data"
+    release.set()
+
+
+def test_upload_rejected_by_a_full_queue_saves_and_queues_nothing(full_indexing_queue):
+    response = client.post("/upload-documents", files={"file": ("notes.txt", b"retrieval notes", "text/plain")})
+    assert response.status_code == 503
+    assert list(full_indexing_queue.iterdir()) == []
+    assert main_optimized.queued_writes == []
+
+
+def test_delete_rejected_by_a_full_queue_keeps_the_file(full_indexing_queue):
+    (full_indexing_queue / "notes.txt").write_text("retrieval notes")
+    assert client.delete("/documents/notes.txt").status_code == 503
+    assert (full_indexing_queue / "notes.txt").exists()
+    assert main_optimized.queued_writes == []
+
+
+@pytest.fixture
+def scratch_corpus(tmp_path, monkeypatch):
+    """An empty data/ and storage/ in a scratch directory, served from an empty snapshot"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    # Extraction workers resolve data/ against the directory they started in
+    pool = ProcessPoolExecutor(max_workers=1)
+    monkeypatch.setattr(main_optimized, "process_pool", pool)
+    monkeypatch.setattr(main_optimized, "snapshot", main_optimized.snapshot)
+    monkeypatch.setattr(main_optimized, "index_initialized", True)
+    main_optimized.query_cache.clear()
+    yield tmp_path / "data"
+    main_optimized.query_cache.clear()
+    pool.shutdown()
+
+
+def cached_answer(query: str):
+    return main_optimized.query_cache.get(main_optimized.get_cache_key(
+        *main_optimized.search_for(main_optimized.QueryRequest(query=query))))
+
+
+def test_documents_are_added_replaced_and_removed_one_at_a_time(scratch_corpus):
+    (scratch_corpus / "alpha.txt").write_text("alpha retrieval notes")
+    (scratch_corpus / "beta.txt").write_text("beta ranking notes")
+    assert main_optimized.add_document("alpha.txt")
+    assert main_optimized.add_document("beta.txt")
+    assert client.post("/query", json={"query": "ranking"}).json()["sources"] == ["beta.txt"]
+    generation = main_optimized.snapshot.generation
+
+    (scratch_corpus / "alpha.txt").write_text("alpha gamma")
+    assert main_optimized.replace_document("alpha.txt")
+    assert main_optimized.snapshot.generation == generation + 1
+    assert client.post("/query", json={"query": "gamma"}).json()["sources"] == ["alpha.txt"]
+    # Answers alpha.txt's old and new terms cannot affect stay cached
+    assert cached_answer("ranking") is not None
+
+    assert main_optimized.remove_document("alpha.txt")
+    assert "alpha.txt" not in main_optimized.snapshot.index
+    assert not main_optimized.remove_document("alpha.txt")
+    assert (scratch_corpus / "alpha.txt").exists()
+    assert main_optimized.snapshot.index.document_count == 1
+
+
+def test_an_edit_that_cannot_be_saved_still_retires_old_cursors(scratch_corpus, monkeypatch):
+    for name in ("alpha.txt", "beta.txt"):
+        (scratch_corpus / name).write_text(f"{name[:-4]} retrieval notes")
+        main_optimized.add_document(name)
+    first_page = client.post("/query", json={"query": "notes", "top_k": 1, "paginate": True}).json()
+    generation = main_optimized.snapshot.generation
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(main_optimized.index_store, "save_index", fail)
+    (scratch_corpus / "gamma.txt").write_text("gamma notes")
+    assert main_optimized.add_document("gamma.txt")
+    assert main_optimized.snapshot.path is None
+    assert main_optimized.snapshot.generation == generation + 1
+    next_page = {"query": "notes", "top_k": 1, "cursor": first_page["next_cursor"]}
+    assert client.post("/query", json=next_page).status_code == 410